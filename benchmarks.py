@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+benchmarks.py - Performance benchmarks for templatemaker
+
+Times make_template(), Template.learn(), Template.learn_batch(),
+Template.extract(), Template.extract_spans() and HTMLTemplate.clean() over
+synthetic and HTML-like corpora of various sizes, measures their peak memory
+with tracemalloc and compares both to a stored baseline. Any benchmark that
+got slower or hungrier than the baseline allows is reported, and the script
+exits with status 1.
+
+Usage:
+    python benchmarks.py                  # Run and compare to the baseline
+    python benchmarks.py --quick          # Only the small cases
+    python benchmarks.py --save-baseline  # Run and store a new baseline
+    python benchmarks.py --scaling        # Also time parallel learning
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from templatemaker import (
+    AlignmentCache,
+    HTMLTemplate,
+    Template,
+    make_template,
+    make_template_hierarchical,
+)
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmarks_baseline.json"
+)
+
+WORDS = (
+    "product price color size stock shipping review rating brand model "
+    "warranty details description features specs weight height width"
+).split()
+
+
+def random_text(rng: random.Random, size: int) -> str:
+    """Returns about size characters of space-separated words."""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def synthetic_corpus(size: int, holes: int, samples: int, seed: int = 0) -> List[str]:
+    """
+    Returns samples documents of about size characters each. They share the
+    same literal text and differ in holes places.
+    """
+    rng = random.Random(seed)
+    chunk = max(1, size // (holes + 1))
+    literals = [random_text(rng, chunk) for _ in range(holes + 1)]
+    docs = []
+    for _ in range(samples):
+        parts = [literals[0]]
+        for literal in literals[1:]:
+            parts.append("<%s%d>" % (rng.choice(WORDS), rng.randint(0, 10**6)))
+            parts.append(literal)
+        docs.append("".join(parts))
+    return docs
+
+
+def html_corpus(size: int, holes: int, samples: int, seed: int = 0) -> List[str]:
+    """
+    Returns samples HTML-like pages of about size characters each, made of
+    one element per line plus <script> and <style> blocks. The pages differ
+    in holes table cells.
+    """
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        i = len(lines)
+        if i % 40 == 0:
+            line = "<script>var x%d = %d; // %s</script>\n" % (
+                i,
+                i,
+                random_text(rng, 60),
+            )
+        elif i % 40 == 20:
+            line = "<style>.row-%d { color: #%06x; }</style>\n" % (i, i)
+        else:
+            line = '<div class="row-%d"><span>%s</span></div>\n' % (
+                i,
+                random_text(rng, 40),
+            )
+        lines.append(line)
+        length += len(line)
+    step = max(1, len(lines) // max(1, holes))
+    docs = []
+    for _ in range(samples):
+        page = list(lines)
+        for i in range(0, len(page), step)[:holes]:
+            page[i] = "<td>%s %d</td>\r\n" % (rng.choice(WORDS), rng.randint(0, 10**6))
+        docs.append("".join(page))
+    return docs
+
+
+CORPORA = {"synthetic": synthetic_corpus, "html": html_corpus}
+
+
+def bench_make_template(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    a, b = docs[0], docs[1]
+    return lambda: make_template(a, b, tolerance)
+
+
+def bench_make_template_hierarchical(
+    docs: List[str], tolerance: int
+) -> Callable[[], Any]:
+    a, b = docs[0], docs[1]
+    return lambda: make_template_hierarchical(a, b, tolerance)
+
+
+def bench_learn(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    def run() -> Template:
+        t = Template(tolerance)
+        for doc in docs:
+            t.learn(doc)
+        return t
+
+    return run
+
+
+def bench_learn_indexed(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    def run() -> Template:
+        t = Template(tolerance, keep_index=True)
+        for doc in docs:
+            t.learn(doc)
+        return t
+
+    return run
+
+
+def bench_learn_batch(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    def run() -> Template:
+        t = Template(tolerance)
+        t.learn_batch(docs)
+        return t
+
+    return run
+
+
+def bench_learn_cached(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    # Two templates share the first half of the samples and an AlignmentCache,
+    # like templates for different sections of the same site.
+    def run() -> AlignmentCache:
+        cache = AlignmentCache()
+        half = len(docs) // 2
+        for rest in (docs[half::2], docs[half + 1 :: 2]):
+            t = Template(tolerance, alignment_cache=cache)
+            for doc in docs[:half] + rest:
+                t.learn(doc)
+        return cache
+
+    return run
+
+
+def learned(docs: List[str], tolerance: int, engine: str) -> Template:
+    t = Template(tolerance, engine=engine)
+    for doc in docs:
+        t.learn(doc)
+    t.compile()
+    return t
+
+
+def bench_extract_regex(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    t = learned(docs, tolerance, "regex")
+    return lambda: [t.extract(doc) for doc in docs]
+
+
+def bench_extract_find(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    t = learned(docs, tolerance, "find")
+    return lambda: [t.extract(doc) for doc in docs]
+
+
+def bench_extract_bytes(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    # What extract_spans() saves: decoding each page before extracting.
+    t = learned(docs, tolerance, "regex")
+    data = [doc.encode("utf-8") for doc in docs]
+    return lambda: [t.extract(doc.decode("utf-8")) for doc in data]
+
+
+def bench_extract_spans(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    t = learned(docs, tolerance, "regex")
+    data = [doc.encode("utf-8") for doc in docs]
+    return lambda: [t.extract_spans(doc) for doc in data]
+
+
+def bench_clean(docs: List[str], tolerance: int) -> Callable[[], Any]:
+    t = HTMLTemplate(tolerance)
+    return lambda: [t.clean(doc) for doc in docs]
+
+
+BENCHMARKS = {
+    "make_template": bench_make_template,
+    "make_template_hierarchical": bench_make_template_hierarchical,
+    "learn": bench_learn,
+    "learn_indexed": bench_learn_indexed,
+    "learn_batch": bench_learn_batch,
+    "learn_cached": bench_learn_cached,
+    "extract_regex": bench_extract_regex,
+    "extract_find": bench_extract_find,
+    "extract_bytes": bench_extract_bytes,
+    "extract_spans": bench_extract_spans,
+    "html_clean": bench_clean,
+}
+
+
+def case(
+    name: str,
+    corpus: str,
+    size: int,
+    holes: int = 10,
+    samples: int = 2,
+    tolerance: int = 0,
+) -> Dict[str, Any]:
+    return dict(
+        name=name,
+        corpus=corpus,
+        size=size,
+        holes=holes,
+        samples=samples,
+        tolerance=tolerance,
+    )
+
+
+def cases(quick: bool) -> List[Dict[str, Any]]:
+    """Returns the benchmark cases to run, as keyword arguments for run_case()."""
+    sizes = [1000, 10000] if quick else [1000, 10000, 100000]
+    result = []
+    for size in sizes:
+        for corpus in CORPORA:
+            result.append(case("make_template", corpus, size))
+            result.append(case("make_template_hierarchical", corpus, size))
+            result.append(case("extract_regex", corpus, size, samples=20))
+            result.append(case("extract_find", corpus, size, samples=20))
+            result.append(case("extract_bytes", corpus, size, samples=20))
+            result.append(case("extract_spans", corpus, size, samples=20))
+        result.append(case("html_clean", "html", size, samples=20))
+    for holes in (1, 50):
+        result.append(case("make_template", "synthetic", 10000, holes=holes))
+    for tolerance in (1, 5):
+        result.append(case("make_template", "synthetic", 10000, tolerance=tolerance))
+    for samples in (5, 20):
+        result.append(case("learn", "html", 10000, samples=samples))
+        result.append(case("learn_indexed", "html", 10000, samples=samples))
+        result.append(case("learn_batch", "html", 10000, samples=samples))
+        result.append(case("learn_cached", "html", 10000, samples=samples))
+    if not quick:
+        # Long enough for the template to converge.
+        result.append(case("learn", "html", 10000, samples=100))
+        result.append(case("learn_indexed", "html", 10000, samples=100))
+    return result
+
+
+def case_key(params: Dict[str, Any]) -> str:
+    return (
+        "{name}[{corpus},size={size},holes={holes},"
+        "samples={samples},tolerance={tolerance}]"
+    ).format(**params)
+
+
+def run_case(
+    name: str,
+    corpus: str,
+    size: int,
+    holes: int,
+    samples: int,
+    tolerance: int,
+    repeat: int,
+) -> Dict[str, float]:
+    """
+    Runs one benchmark, returning its best time out of repeat runs and the
+    peak memory allocated by a separate, traced run.
+    """
+    docs = CORPORA[corpus](size, holes, samples)
+    run = BENCHMARKS[name](docs, tolerance)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_bytes": peak}
+
+
+def compare(
+    key: str,
+    result: Dict[str, float],
+    baseline: Dict[str, Any],
+    time_tolerance: float,
+    memory_tolerance: float,
+) -> List[str]:
+    """
+    Returns a description of each way result regressed from the baseline.
+    Timing differences under a millisecond are ignored as noise.
+    """
+    base = baseline.get(key)
+    if base is None:
+        return []
+    problems = []
+    if (
+        result["seconds"] > base["seconds"] * (1 + time_tolerance)
+        and result["seconds"] - base["seconds"] > 0.001
+    ):
+        problems.append(
+            "time %.4fs > baseline %.4fs" % (result["seconds"], base["seconds"])
+        )
+    if result["peak_bytes"] > base["peak_bytes"] * (1 + memory_tolerance):
+        problems.append(
+            "peak memory %d > baseline %d bytes"
+            % (result["peak_bytes"], base["peak_bytes"])
+        )
+    return problems
+
+
+def run_scaling(size: int = 20000, samples: int = 64) -> None:
+    """
+    Prints the wall-clock time of Template.from_directory() on the same
+    samples for each worker count from 1 to the number of CPUs.
+    """
+    docs = html_corpus(size, 10, samples)
+    with tempfile.TemporaryDirectory() as dirname:
+        for i, doc in enumerate(docs):
+            with open(os.path.join(dirname, "%04d.html" % i), "w") as f:
+                f.write(doc)
+        start = time.perf_counter()
+        Template.from_directory(dirname, verbose=False)
+        serial = time.perf_counter() - start
+        print("from_directory serial: %.3fs" % serial)
+        for workers in range(1, (os.cpu_count() or 1) + 1):
+            start = time.perf_counter()
+            Template.from_directory(dirname, workers=workers, chunksize=4)
+            elapsed = time.perf_counter() - start
+            print(
+                "from_directory workers=%d: %.3fs (%.2fx)"
+                % (workers, elapsed, serial / elapsed)
+            )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--quick", action="store_true", help="only run the small cases")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per case; the best time counts"
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON file")
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=1.0,
+        help="allowed slowdown, as a fraction of the baseline time",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.25,
+        help="allowed peak memory growth, as a fraction of the baseline",
+    )
+    parser.add_argument(
+        "--scaling",
+        action="store_true",
+        help="also time parallel learning for each worker count",
+    )
+    args = parser.parse_args()
+
+    baseline: Dict[str, Any] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    for params in cases(args.quick):
+        key = case_key(params)
+        result = run_case(repeat=args.repeat, **params)
+        results[key] = result
+        problems = compare(
+            key, result, baseline, args.time_tolerance, args.memory_tolerance
+        )
+        status = "REGRESSED" if problems else "ok"
+        print(
+            "%-100s %9.4fs %12d B  %s"
+            % (key, result["seconds"], result["peak_bytes"], status)
+        )
+        regressions.extend("%s: %s" % (key, problem) for problem in problems)
+
+    if args.scaling:
+        run_scaling()
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Saved baseline to %s" % args.baseline)
+        return 0
+
+    if regressions:
+        print("\nPERFORMANCE REGRESSIONS:", file=sys.stderr)
+        for regression in regressions:
+            print("  " + regression, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
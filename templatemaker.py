@@ -13,14 +13,64 @@ License: BSD
 Original: https://github.com/adrianholovaty/templatemaker
 """
 
-import re
+import argparse
+import asyncio
+import fnmatch
+import glob
+import hashlib
+import json
+import math
 import os
-from typing import List, Tuple, Dict, Optional, Union, Any
+import re
+import struct
+import sys
+import tarfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, wait
+from datetime import date, datetime, time as time_of_day
+from itertools import islice
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Sequence,
+    Tuple,
+    Dict,
+    Optional,
+    Union,
+    Any,
+)
 
 
 # Use the same marker character as the original C code
 MARKER = "\x1f"
 
+_MARKER_RUN_RE = re.compile(re.escape(MARKER) + "{2,}")
+
+# Saved templates start with _FORMAT_MAGIC, followed by _FORMAT_HEADER
+# (the format version and the size of the JSON header), the JSON header and
+# the UTF-8 encoded brain.
+_FORMAT_MAGIC = b"TMPL"
+_FORMAT_HEADER = struct.Struct(">BI")
+_FORMAT_VERSION = 1
+
+# The most Sample String digests a Template remembers as not changing its
+# current brain.
+_MAX_UNCHANGED_DIGESTS = 100000
+
+# Runs of whitespace that HTMLTemplate.clean() collapses to a newline, and
+# those (without newlines) it collapses to a space.
+_NEWLINE_RUN_RE = re.compile(r"[ \t\r\f\v]*\n[ \t\n\r\f\v]*")
+_SPACE_RUN_RE = re.compile(r"[ \t\r\f\v]{2,}|[\t\r\f\v]")
+
 
 class NoMatch(Exception):
     """Raised when text doesn't match the template."""
@@ -28,46 +78,694 @@ class NoMatch(Exception):
     pass
 
 
-def longest_common_substring(a: str, b: str) -> Tuple[int, int, int]:
+class TrainingStats(NamedTuple):
+    """Convergence statistics returned by Template.train()."""
+
+    # Number of Sample Strings learned
+    samples: int
+    # Why training stopped: "converged", "max_samples", "max_seconds" or
+    # "exhausted" (the samples ran out first)
+    stop_reason: str
+    # Number of consecutive Sample Strings, at the end, that didn't change
+    # the number of holes
+    unchanged_run: int
+    # Number of holes in the final template
+    num_holes: int
+    # Wall-clock seconds spent training
+    elapsed: float
+
+    @property
+    def converged(self) -> bool:
+        return self.stop_reason == "converged"
+
+
+class _SuffixAutomaton:
+    """
+    Suffix automaton over s[start:end].
+
+    The automaton recognizes every substring of s[start:end] and is built in
+    linear time. It has at most 2 * (end - start) states, each holding one
+    transition dict, so its memory is bounded by the length of the indexed
+    string rather than by the product of the two lengths being compared.
+
+    first_end[v] is the index in s right after the first occurrence of the
+    substrings recognized by state v.
+    """
+
+    __slots__ = ("length", "link", "next", "first_end")
+
+    def __init__(self, s: str, start: int = 0, end: Optional[int] = None):
+        if end is None:
+            end = len(s)
+        length = [0]
+        link = [-1]
+        nexts: List[Dict[str, int]] = [{}]
+        first_end = [start]
+        last = 0
+        for i in range(start, end):
+            c = s[i]
+            cur = len(length)
+            length.append(length[last] + 1)
+            link.append(0)
+            nexts.append({})
+            first_end.append(i + 1)
+            p = last
+            while p != -1 and c not in nexts[p]:
+                nexts[p][c] = cur
+                p = link[p]
+            if p != -1:
+                q = nexts[p][c]
+                if length[p] + 1 == length[q]:
+                    link[cur] = q
+                else:
+                    clone = len(length)
+                    length.append(length[p] + 1)
+                    link.append(link[q])
+                    nexts.append(nexts[q].copy())
+                    first_end.append(first_end[q])
+                    while p != -1 and nexts[p].get(c) == q:
+                        nexts[p][c] = clone
+                        p = link[p]
+                    link[q] = clone
+                    link[cur] = clone
+            last = cur
+        self.length = length
+        self.link = link
+        self.next = nexts
+        self.first_end = first_end
+
+    def longest_match_end(self, s: str, start: int, end: int) -> Tuple[int, int]:
+        """
+        Scans s[start:end] and returns (length, end_index) of the longest
+        substring of it that the automaton recognizes.
+
+        Ties are resolved in favor of the match that ends first in s. If
+        nothing matches, returns (0, start).
+        """
+        length = self.length
+        link = self.link
+        nexts = self.next
+        v = 0
+        size = 0
+        best_size = 0
+        best_end = start
+        for i in range(start, end):
+            c = s[i]
+            while v and c not in nexts[v]:
+                v = link[v]
+                size = length[v]
+            t = nexts[v].get(c)
+            if t is None:
+                size = 0
+            else:
+                v = t
+                size += 1
+                if size > best_size:
+                    best_size = size
+                    best_end = i + 1
+        return best_size, best_end
+
+    def longest_common_substring(
+        self, s: str, start: int, end: int
+    ) -> Tuple[int, int, int]:
+        """
+        Like longest_match_end(), but returns (length, indexed_end, s_end):
+        the end of the match both in the indexed string, at its first
+        occurrence there, and in s. Ties are resolved in favor of the match
+        whose first occurrence in the indexed string ends first.
+        """
+        length = self.length
+        link = self.link
+        nexts = self.next
+        first_end = self.first_end
+        v = 0
+        size = 0
+        best_size = 0
+        best_indexed_end = best_end = -1
+        for i in range(start, end):
+            c = s[i]
+            while v and c not in nexts[v]:
+                v = link[v]
+                size = length[v]
+            t = nexts[v].get(c)
+            if t is None:
+                size = 0
+            else:
+                v = t
+                size += 1
+                if size > best_size or (
+                    size == best_size and first_end[v] < best_indexed_end
+                ):
+                    best_size = size
+                    best_indexed_end = first_end[v]
+                    best_end = i + 1
+        return best_size, best_indexed_end, best_end
+
+    def states_by_length(self) -> List[int]:
+        """Returns the states other than the initial one, longest first."""
+        length = self.length
+        return sorted(range(1, len(length)), key=length.__getitem__, reverse=True)
+
+    def match_lengths(
+        self, s: str, start: int, end: int, order: List[int]
+    ) -> List[int]:
+        """
+        Scans s[start:end] and returns, for each state, the length of the
+        longest substring recognized by that state that occurs in it.
+
+        order must be the result of states_by_length().
+        """
+        length = self.length
+        link = self.link
+        nexts = self.next
+        best = [0] * len(length)
+        v = 0
+        size = 0
+        for i in range(start, end):
+            c = s[i]
+            while v and c not in nexts[v]:
+                v = link[v]
+                size = length[v]
+            t = nexts[v].get(c)
+            if t is None:
+                size = 0
+            else:
+                v = t
+                size += 1
+                if size > best[v]:
+                    best[v] = size
+        # A match in a state is also a match of every shorter suffix, which
+        # are the whole of the states up its suffix links.
+        for v in order:
+            if best[v] and best[link[v]] < length[link[v]]:
+                best[link[v]] = length[link[v]]
+        return best
+
+
+def longest_common_substring(
+    a: str,
+    b: str,
+    a_start: int = 0,
+    a_end: Optional[int] = None,
+    b_start: int = 0,
+    b_end: Optional[int] = None,
+) -> Tuple[int, int, int]:
     """
     Find the longest common substring between two strings.
 
+    A suffix automaton is built over b and a is scanned against it, so this
+    runs in O(len(a) + len(b)) time and the working memory is at most
+    2 * len(b) automaton states.
+
+    If several common substrings share the maximum length, the one that ends
+    first in a wins, and b_offset is its first occurrence in b.
+
     Args:
         a: First string to compare
         b: Second string to compare
+        a_start, a_end: Optional range of a to compare (defaults to all of a)
+        b_start, b_end: Optional range of b to compare (defaults to all of b)
 
     Returns:
-        Tuple of (length, a_offset, b_offset)
-    """
-    # Create a matrix of zeros
-    matrix = [[0 for _ in range(len(b) + 1)] for _ in range(len(a) + 1)]
-
-    # Track best match
-    max_length = 0
-    a_end_pos = 0
-
-    # Fill the matrix
-    for i in range(1, len(a) + 1):
-        for j in range(1, len(b) + 1):
-            if a[i - 1] == b[j - 1]:
-                matrix[i][j] = matrix[i - 1][j - 1] + 1
-                if matrix[i][j] > max_length:
-                    max_length = matrix[i][j]
-                    a_end_pos = i
-            else:
-                matrix[i][j] = 0
+        Tuple of (length, a_offset, b_offset). The offsets are relative to
+        the whole strings, not to the compared ranges.
+    """
+    if a_end is None:
+        a_end = len(a)
+    if b_end is None:
+        b_end = len(b)
+    if a_start >= a_end or b_start >= b_end:
+        return 0, -1, -1
+
+    automaton = _SuffixAutomaton(b, b_start, b_end)
+    max_length, a_end_pos = automaton.longest_match_end(a, a_start, a_end)
 
     if max_length == 0:
         return 0, -1, -1
 
     a_start_pos = a_end_pos - max_length
     # Find b_start_pos by matching the substring found in a
-    b_start_pos = b.find(a[a_start_pos:a_end_pos])
+    b_start_pos = b.find(a[a_start_pos:a_end_pos], b_start, b_end)
 
     return max_length, a_start_pos, b_start_pos
 
 
-def make_template(template_str: str, new_str: str, tolerance: int = 0) -> str:
+class AlignmentCacheInfo(NamedTuple):
+    """Usage statistics returned by AlignmentCache.info()."""
+
+    # Number of sub-alignments found in the cache
+    hits: int
+    # Number of sub-alignments that had to be computed (and were then cached)
+    misses: int
+    # Number of cached sub-alignments dropped to make room for newer ones
+    evictions: int
+    # Number of sub-alignments in the cache
+    size: int
+    # Most sub-alignments the cache holds
+    maxsize: int
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class AlignmentCache:
+    """
+    A bounded, least-recently-used cache of sub-alignments.
+
+    make_template() splits the two strings around their longest common
+    substring and aligns what's left on either side. Pages built from the
+    same fragments (navigation bars, footers, product cards) lead to the
+    same pairs of fragments being aligned over and over, across Sample
+    Strings and across templates. With a cache, each such pair is aligned
+    once. Pairs are looked up by a digest of their contents and the
+    tolerance, so a cache can be shared by any number of templates and
+    make_template() calls, including from several threads.
+
+    Fragment pairs shorter than min_size characters (both fragments
+    together) are cheaper to align than to look up, and aren't cached.
+    """
+
+    def __init__(self, maxsize: int = 4096, min_size: int = 64):
+        """
+        Args:
+            maxsize: Most sub-alignments to keep; the least recently used
+                one is dropped to make room for a new one
+            min_size: Smallest combined length of a fragment pair to cache
+
+        Raises:
+            ValueError: If maxsize is less than 1
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.min_size = min_size
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._evictions = 0
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Cached alignments are only worth keeping within a process.
+        return type(self), (self.maxsize, self.min_size)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def info(self) -> AlignmentCacheInfo:
+        """Returns the cache's hit, miss and eviction counts and its size."""
+        with self._lock:
+            return AlignmentCacheInfo(
+                self._hits,
+                self._misses,
+                self._evictions,
+                len(self._entries),
+                self.maxsize,
+            )
+
+    def clear(self) -> None:
+        """Empties the cache and resets its statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._hits = self._misses = self._evictions = 0
+
+    def _get(self, key: Tuple[bytes, bytes, int]) -> Any:
+        """Returns the cached value for key, or None, counting a hit or miss."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def _put(self, key: Tuple[bytes, bytes, int], value: Any) -> None:
+        """Caches value under key, evicting the least recently used entry."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+
+class LearnMetrics(NamedTuple):
+    """Metrics of one Template.learn() call, passed to the template's observer."""
+
+    # What learn() returned
+    result: Optional[bool]
+    # How the Sample String was learned: "first" (it became the template),
+    # "seen" (it's known not to change the template), "matched" (fast_learn
+    # found the template already matches it) or "aligned"
+    path: str
+    # Seconds spent in clean(), and then learning the cleaned text
+    clean_seconds: float
+    learn_seconds: float
+    # Deepest level the alignment recursed to, the number of longest common
+    # substring searches it ran, and the number of characters those scanned
+    depth: int
+    lcs_calls: int
+    chars_compared: int
+    # Number of holes in the template afterwards
+    num_holes: int
+
+
+class ExtractMetrics(NamedTuple):
+    """Metrics of one Template.extract() call, passed to the template's observer."""
+
+    # Whether the text matched the template (if not, NoMatch was raised)
+    matched: bool
+    # Seconds spent in clean(), and then matching the cleaned text
+    clean_seconds: float
+    match_seconds: float
+    # Length of the cleaned text
+    length: int
+
+
+class _AlignmentCounters:
+    """Work done by _make_template_into(), reported in LearnMetrics."""
+
+    __slots__ = ("depth", "lcs_calls", "chars_compared")
+
+    def __init__(self) -> None:
+        self.depth = self.lcs_calls = self.chars_compared = 0
+
+
+class _PendingAlignment(NamedTuple):
+    """
+    Stack entry of _make_template_into() marking where the output for a
+    fragment pair ends, so that output can then be cached under key.
+    """
+
+    key: Tuple[bytes, bytes, int]
+    a_start: int
+    pieces_start: int
+    holes_start: int
+
+
+def _make_template_into(
+    pieces: List[str],
+    a: str,
+    b: str,
+    tolerance: int,
+    a_start: int,
+    a_end: int,
+    b_start: int,
+    b_end: int,
+    holes: Optional[List[Tuple[int, int]]] = None,
+    a_index: Optional[_SuffixAutomaton] = None,
+    cache: Optional[AlignmentCache] = None,
+    counters: Optional[_AlignmentCounters] = None,
+) -> None:
+    """
+    Appends the template for a[a_start:a_end] and b[b_start:b_end] to pieces.
+
+    This is the algorithm of make_template(), run with an explicit stack
+    over index ranges (like templatemaker.c), so it never copies the input
+    strings and can't hit the recursion limit on heavily fragmented input.
+
+    If holes is given, the range of a that each new hole replaces is
+    appended to it, in order. If a_index, a suffix automaton over all of a,
+    is given, it's used instead of building one whenever the whole of a is
+    being aligned. If cache is given, fragment pairs are looked up in it
+    before being aligned, and stored in it afterwards. If counters is given,
+    the work done is added to it.
+    """
+    if cache is not None and holes is None:
+        holes = []
+    # Each stack entry is either a range tuple still to be aligned (with its
+    # recursion depth), a finished string to emit or a _PendingAlignment to
+    # cache. Entries are pushed right-to-left so they are popped, and
+    # emitted, left-to-right.
+    stack: List[Union[str, Tuple[int, int, int, int, int], _PendingAlignment]] = [
+        (a_start, a_end, b_start, b_end, 1)
+    ]
+    while stack:
+        task = stack.pop()
+        if type(task) is str:
+            pieces.append(task)
+            continue
+        if type(task) is _PendingAlignment:
+            text = "".join(pieces[task.pieces_start :])
+            # Later _PendingAlignments further up then have less to join.
+            pieces[task.pieces_start :] = [text]
+            cache._put(
+                task.key,
+                (
+                    text,
+                    tuple(
+                        (start - task.a_start, end - task.a_start)
+                        for start, end in holes[task.holes_start :]
+                    ),
+                ),
+            )
+            continue
+        a_start, a_end, b_start, b_end, depth = task
+        if counters is not None and depth > counters.depth:
+            counters.depth = depth
+
+        # Base cases
+        if a_start == a_end and b_start == b_end:
+            continue
+        if a_start == a_end or b_start == b_end:
+            pieces.append(MARKER)
+            if holes is not None:
+                holes.append((a_start, a_end))
+            continue
+
+        if cache is not None and a_end - a_start + b_end - b_start >= cache.min_size:
+            key = (_digest(a[a_start:a_end]), _digest(b[b_start:b_end]), tolerance)
+            cached = cache._get(key)
+            if cached is not None:
+                pieces.append(cached[0])
+                holes.extend(
+                    (start + a_start, end + a_start) for start, end in cached[1]
+                )
+                continue
+            stack.append(_PendingAlignment(key, a_start, len(pieces), len(holes)))
+
+        if a_index is not None and a_start == 0 and a_end == len(a):
+            best_size, a_common_end, b_common_end = a_index.longest_common_substring(
+                b, b_start, b_end
+            )
+            a_offset = a_common_end - best_size
+            b_offset = b_common_end - best_size
+            if best_size:
+                # Like longest_common_substring(), use the first occurrence.
+                b_offset = b.find(a[a_offset:a_common_end], b_start, b_end)
+            if counters is not None:
+                counters.lcs_calls += 1
+                counters.chars_compared += b_end - b_start
+        else:
+            best_size, a_offset, b_offset = longest_common_substring(
+                a, b, a_start, a_end, b_start, b_end
+            )
+            if counters is not None:
+                counters.lcs_calls += 1
+                counters.chars_compared += a_end - a_start + b_end - b_start
+
+        # No common substring, or it's no longer than the tolerance.
+        if best_size == 0 or best_size <= tolerance:
+            pieces.append(MARKER)
+            if holes is not None:
+                holes.append((a_start, a_end))
+            continue
+
+        a_common_end = a_offset + best_size
+        b_common_end = b_offset + best_size
+        stack.append((a_common_end, a_end, b_common_end, b_end, depth + 1))
+        stack.append(a[a_offset:a_common_end])
+        stack.append((a_start, a_offset, b_start, b_offset, depth + 1))
+
+
+def _longest_common_substring_multi(
+    strings: List[str], ranges: Tuple[Tuple[int, int], ...]
+) -> str:
+    """
+    Returns the longest substring common to every strings[i][start:end],
+    where (start, end) is ranges[i], or "" if there is none.
+
+    A suffix automaton is built over the shortest range and each other one
+    is scanned against it once. If several common substrings share the
+    maximum length, the smallest one wins, so the result doesn't depend on
+    the order of strings.
+    """
+    base = min(range(len(strings)), key=lambda i: ranges[i][1] - ranges[i][0])
+    base_start, base_end = ranges[base]
+    automaton = _SuffixAutomaton(strings[base], base_start, base_end)
+    order = automaton.states_by_length()
+    common = automaton.length
+    for i, (start, end) in enumerate(ranges):
+        if i != base:
+            best = automaton.match_lengths(strings[i], start, end, order)
+            common = list(map(min, common, best))
+    size = max(common)
+    if size == 0:
+        return ""
+    s = strings[base]
+    first_end = automaton.first_end
+    return min(
+        s[first_end[v] - size : first_end[v]]
+        for v, common_size in enumerate(common)
+        if common_size == size
+    )
+
+
+def _make_template_multi_into(
+    pieces: List[str],
+    strings: List[str],
+    tolerance: int,
+    holes: Optional[List[Tuple[int, int]]] = None,
+) -> None:
+    """
+    Appends the template for all of strings, aligned together, to pieces.
+
+    This is _make_template_into() for any number of strings: each step
+    splits every string around the first occurrence of their longest common
+    substring, and a hole is left wherever the strings have nothing longer
+    than tolerance in common. If holes is given, the range of strings[0]
+    that each hole replaces is appended to it, in order.
+    """
+    stack: List[Union[str, Tuple[Tuple[int, int], ...]]] = [
+        tuple((0, len(s)) for s in strings)
+    ]
+    while stack:
+        task = stack.pop()
+        if type(task) is str:
+            pieces.append(task)
+            continue
+
+        empty = [start == end for start, end in task]
+        if all(empty):
+            continue
+        common = "" if any(empty) else _longest_common_substring_multi(strings, task)
+        if len(common) <= tolerance:
+            pieces.append(MARKER)
+            if holes is not None:
+                holes.append(task[0])
+            continue
+
+        size = len(common)
+        offsets = [s.find(common, start, end) for s, (start, end) in zip(strings, task)]
+        stack.append(tuple((i + size, end) for i, (_, end) in zip(offsets, task)))
+        stack.append(common)
+        stack.append(tuple((start, i) for i, (start, _) in zip(offsets, task)))
+
+
+def char_tokenizer(text: str) -> List[str]:
+    """Splits text into single characters; this is the default."""
+    return list(text)
+
+
+_WORD_TOKEN_RE = re.compile(r"\w+|\s+|[^\w\s]")
+_HTML_TOKEN_RE = re.compile(r"<[^<>]*>|\w+|\s+|[^\w\s]")
+
+
+def word_tokenizer(text: str) -> List[str]:
+    """
+    Splits text into words, runs of whitespace and single punctuation
+    characters.
+    """
+    return _WORD_TOKEN_RE.findall(text)
+
+
+def html_tokenizer(text: str) -> List[str]:
+    """
+    Splits HTML into whole tags, and the text between them into words, runs
+    of whitespace and single punctuation characters.
+    """
+    return _HTML_TOKEN_RE.findall(text)
+
+
+# Built-in tokenizers, which can also be passed to Template by name.
+TOKENIZERS: Dict[str, Callable[[str], List[str]]] = {
+    "char": char_tokenizer,
+    "word": word_tokenizer,
+    "html": html_tokenizer,
+}
+
+
+def _resolve_tokenizer(
+    tokenizer: Union[None, str, Callable[[str], List[str]]],
+) -> Optional[Callable[[str], List[str]]]:
+    """
+    Returns the tokenizer function for a tokenizer name or function, or None
+    if alignment should run directly over characters.
+    """
+    if isinstance(tokenizer, str):
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f"Unknown tokenizer: {tokenizer!r}")
+        tokenizer = TOKENIZERS[tokenizer]
+    if tokenizer is char_tokenizer:
+        return None
+    return tokenizer
+
+
+class _TokenCodec:
+    """
+    Encodes strings as one character per token, so that the character-level
+    alignment can run over tokens. Each distinct token is assigned its own
+    code point; MARKER is kept as-is and never assigned to a token.
+    """
+
+    def __init__(self, tokenizer: Callable[[str], List[str]]):
+        self.tokenizer = tokenizer
+        self.codes: Dict[str, str] = {}
+        self.tokens: List[str] = []
+
+    def encode(self, text: str) -> str:
+        codes = self.codes
+        encoded = []
+        for i, segment in enumerate(text.split(MARKER)):
+            if i:
+                encoded.append(MARKER)
+            for token in self.tokenizer(segment):
+                code = codes.get(token)
+                if code is None:
+                    number = len(self.tokens)
+                    if number >= ord(MARKER):
+                        number += 1
+                    if number > sys.maxunicode:
+                        raise ValueError("Too many distinct tokens to align")
+                    code = codes[token] = chr(number)
+                    self.tokens.append(token)
+                encoded.append(code)
+        return "".join(encoded)
+
+    def offsets(self, encoded: str) -> List[int]:
+        """
+        Returns the offset in the original string at which each character
+        of encoded starts, followed by the original string's length.
+        """
+        tokens = self.tokens
+        marker = ord(MARKER)
+        offsets = [0]
+        pos = 0
+        for code in encoded:
+            if code == MARKER:
+                pos += 1
+            else:
+                pos += len(tokens[ord(code) - (ord(code) > marker)])
+            offsets.append(pos)
+        return offsets
+
+    def decode(self, encoded: str) -> str:
+        tokens = self.tokens
+        marker = ord(MARKER)
+        return "".join(
+            MARKER if code == MARKER else tokens[ord(code) - (ord(code) > marker)]
+            for code in encoded
+        )
+
+
+def make_template(
+    template_str: str,
+    new_str: str,
+    tolerance: int = 0,
+    tokenizer: Union[None, str, Callable[[str], List[str]]] = None,
+    cache: Optional[AlignmentCache] = None,
+) -> str:
     """
     Creates a template from comparing template_str and new_str, with a given tolerance.
 
@@ -75,57 +773,518 @@ def make_template(template_str: str, new_str: str, tolerance: int = 0) -> str:
         template_str: Current template string
         new_str: New string to learn
         tolerance: Minimum allowed length of text between holes
+        tokenizer: Optional tokenizer function, or the name of one in
+            TOKENIZERS. The strings are then compared token by token instead
+            of character by character, and tolerance counts tokens. A
+            tokenizer must return tokens that join back into its input.
+        cache: Optional AlignmentCache to reuse the alignments of fragment
+            pairs already aligned by earlier calls
 
     Returns:
         The template string with markers for differences
     """
-    # Base cases
-    if not template_str and not new_str:
-        return ""
-    if not template_str or not new_str:
-        return MARKER
-
-    # Find longest common substring
-    best_size, a_offset, b_offset = longest_common_substring(template_str, new_str)
-
-    if best_size == 0:
-        # No common substring found
-        return MARKER
-
-    # If the common part is shorter than tolerance, treat as if no match
-    if tolerance > 0 and best_size <= tolerance:
-        return MARKER
-
-    # Process left parts
-    left_template = ""
-    if a_offset > 0 or b_offset > 0:
-        if a_offset > 0 and b_offset > 0:
-            # Both strings have content on the left
-            left_template = make_template(
-                template_str[:a_offset], new_str[:b_offset], tolerance
-            )
+    return _make_template(template_str, new_str, tolerance, tokenizer, cache=cache)
+
+
+def _make_template(
+    template_str: str,
+    new_str: str,
+    tolerance: int,
+    tokenizer: Union[None, str, Callable[[str], List[str]]],
+    holes: Optional[List[Tuple[int, int]]] = None,
+    cache: Optional[AlignmentCache] = None,
+    counters: Optional[_AlignmentCounters] = None,
+) -> str:
+    """
+    make_template(), optionally appending to holes the range of template_str
+    that each hole of the result replaces, and to counters the work done.
+    """
+    tokenizer = _resolve_tokenizer(tokenizer)
+    if tokenizer is not None:
+        codec = _TokenCodec(tokenizer)
+        encoded_a = codec.encode(template_str)
+        token_holes: Optional[List[Tuple[int, int]]] = None
+        if holes is not None:
+            token_holes = []
+        encoded = _make_template(
+            encoded_a,
+            codec.encode(new_str),
+            tolerance,
+            None,
+            token_holes,
+            cache,
+            counters,
+        )
+        if token_holes:
+            offsets = codec.offsets(encoded_a)
+            holes.extend((offsets[start], offsets[end]) for start, end in token_holes)
+        return codec.decode(encoded)
+
+    pieces: List[str] = []
+    _make_template_into(
+        pieces,
+        template_str,
+        new_str,
+        tolerance,
+        0,
+        len(template_str),
+        0,
+        len(new_str),
+        holes,
+        cache=cache,
+        counters=counters,
+    )
+    return "".join(pieces)
+
+
+def _line_offsets(s: str) -> List[int]:
+    """
+    Returns the offsets at which each line of s starts, followed by len(s).
+    Lines keep their trailing newline.
+    """
+    offsets = [0]
+    pos = s.find("\n")
+    while pos != -1:
+        offsets.append(pos + 1)
+        pos = s.find("\n", pos + 1)
+    if offsets[-1] != len(s):
+        offsets.append(len(s))
+    return offsets
+
+
+def _unique_line_anchors(
+    a_lines: List[str], b_lines: List[str]
+) -> List[Tuple[int, int]]:
+    """
+    Patience-diff style anchoring: pairs up lines that occur exactly once in
+    both a_lines and b_lines, and keeps the longest run of those pairs that
+    appears in the same order in both.
+
+    Returns a list of (a_line_index, b_line_index) pairs, in order.
+    """
+    counts: Dict[str, List[int]] = {}
+    for i, line in enumerate(a_lines):
+        entry = counts.get(line)
+        if entry is None:
+            counts[line] = [1, 0, i, -1]
         else:
-            # Only one string has content on the left
-            left_template = MARKER
-
-    # Process right parts
-    right_template = ""
-    a_end = a_offset + best_size
-    b_end = b_offset + best_size
-
-    if a_end < len(template_str) or b_end < len(new_str):
-        if a_end < len(template_str) and b_end < len(new_str):
-            # Both strings have content on the right
-            right_template = make_template(
-                template_str[a_end:], new_str[b_end:], tolerance
-            )
+            entry[0] += 1
+    for j, line in enumerate(b_lines):
+        entry = counts.get(line)
+        if entry is not None:
+            entry[1] += 1
+            entry[3] = j
+    pairs = sorted(
+        (entry[2], entry[3])
+        for entry in counts.values()
+        if entry[0] == 1 and entry[1] == 1
+    )
+
+    # Longest increasing subsequence of b indexes, by patience sorting.
+    tails: List[int] = []
+    tail_index: List[int] = []
+    previous = [-1] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        pile = bisect_left(tails, j)
+        if pile == len(tails):
+            tails.append(j)
+            tail_index.append(k)
         else:
-            # Only one string has content on the right
-            right_template = MARKER
+            tails[pile] = j
+            tail_index[pile] = k
+        previous[k] = tail_index[pile - 1] if pile else -1
+
+    anchors = []
+    k = tail_index[-1] if tail_index else -1
+    while k != -1:
+        anchors.append(pairs[k])
+        k = previous[k]
+    anchors.reverse()
+    return anchors
+
+
+def make_template_hierarchical(
+    template_str: str,
+    new_str: str,
+    tolerance: int = 0,
+    tokenizer: Union[None, str, Callable[[str], List[str]]] = None,
+    cache: Optional[AlignmentCache] = None,
+) -> str:
+    """
+    Creates a template like make_template(), aligning coarse-to-fine.
+
+    Lines that are unique in both strings are aligned first, patience-diff
+    style, and grown into blocks of identical lines. Those blocks are kept
+    as-is, and the character-level make_template() only runs on the windows
+    between them. On large, mostly identical documents this is much cheaper
+    than aligning the whole strings, though the result can differ slightly
+    from make_template() because the blocks are fixed before the
+    characters around them are aligned.
+
+    Args:
+        template_str: Current template string
+        new_str: New string to learn
+        tolerance: Minimum allowed length of text between holes
+        tokenizer: Optional tokenizer for the alignment between the blocks
+            of lines; see make_template()
+        cache: Optional AlignmentCache for the alignment between the blocks
+            of lines; see make_template()
+
+    Returns:
+        The template string with markers for differences
+    """
+    return _make_template_hierarchical(
+        template_str, new_str, tolerance, tokenizer, cache=cache
+    )
+
+
+def _make_template_hierarchical(
+    template_str: str,
+    new_str: str,
+    tolerance: int,
+    tokenizer: Union[None, str, Callable[[str], List[str]]],
+    holes: Optional[List[Tuple[int, int]]] = None,
+    cache: Optional[AlignmentCache] = None,
+    counters: Optional[_AlignmentCounters] = None,
+) -> str:
+    """
+    make_template_hierarchical(), optionally appending to holes the range
+    of template_str that each hole of the result replaces, and to counters
+    the work done.
+    """
+    tokenizer = _resolve_tokenizer(tokenizer)
+    a_offsets = _line_offsets(template_str)
+    b_offsets = _line_offsets(new_str)
+    a_lines = [
+        template_str[a_offsets[i] : a_offsets[i + 1]] for i in range(len(a_offsets) - 1)
+    ]
+    b_lines = [
+        new_str[b_offsets[j] : b_offsets[j + 1]] for j in range(len(b_offsets) - 1)
+    ]
+
+    # Grow each anchor into a block of identical lines, without crossing the
+    # neighbouring blocks. Blocks are (a_line, b_line, line_count).
+    blocks: List[List[int]] = []
+    for i, j in _unique_line_anchors(a_lines, b_lines):
+        if blocks and i < blocks[-1][0] + blocks[-1][2]:
+            continue
+        a_floor = blocks[-1][0] + blocks[-1][2] if blocks else 0
+        b_floor = blocks[-1][1] + blocks[-1][2] if blocks else 0
+        start_i, start_j = i, j
+        while (
+            start_i > a_floor
+            and start_j > b_floor
+            and a_lines[start_i - 1] == b_lines[start_j - 1]
+        ):
+            start_i -= 1
+            start_j -= 1
+        end_i, end_j = i + 1, j + 1
+        while (
+            end_i < len(a_lines)
+            and end_j < len(b_lines)
+            and a_lines[end_i] == b_lines[end_j]
+        ):
+            end_i += 1
+            end_j += 1
+        blocks.append([start_i, start_j, end_i - start_i])
+
+    pieces: List[str] = []
+
+    def align_gap(a_start: int, a_end: int, b_start: int, b_end: int) -> None:
+        if tokenizer is None:
+            _make_template_into(
+                pieces,
+                template_str,
+                new_str,
+                tolerance,
+                a_start,
+                a_end,
+                b_start,
+                b_end,
+                holes,
+                cache=cache,
+                counters=counters,
+            )
+            return
+        gap_holes: Optional[List[Tuple[int, int]]] = None
+        if holes is not None:
+            gap_holes = []
+        pieces.append(
+            _make_template(
+                template_str[a_start:a_end],
+                new_str[b_start:b_end],
+                tolerance,
+                tokenizer,
+                gap_holes,
+                cache,
+                counters,
+            )
+        )
+        if gap_holes:
+            holes.extend((start + a_start, end + a_start) for start, end in gap_holes)
+
+    a_pos = b_pos = 0
+    for i, j, count in blocks:
+        a_start, a_end = a_offsets[i], a_offsets[i + count]
+        b_start, b_end = b_offsets[j], b_offsets[j + count]
+        if a_end - a_start <= tolerance:
+            # Too short to stand on its own; leave it to the gap alignment.
+            continue
+        align_gap(a_pos, a_start, b_pos, b_start)
+        pieces.append(template_str[a_start:a_end])
+        a_pos, b_pos = a_end, b_end
+    align_gap(a_pos, len(template_str), b_pos, len(new_str))
+    return "".join(pieces)
+
+
+def _digest(text: str) -> bytes:
+    """Returns a collision-resistant digest of text."""
+    return hashlib.blake2b(
+        text.encode("utf-8", "surrogatepass"), digest_size=16
+    ).digest()
+
+
+class Matcher:
+    """
+    A template brain compiled for extraction.
+
+    Two engines are available. "regex" compiles the brain into a single
+    regular expression with a lazy (.*?) group per hole. "find" locates the
+    literal segments between the holes one after another with str.find(),
+    so it never backtracks; it returns exactly the same values as "regex".
+    """
+
+    ENGINES = ("regex", "find")
+
+    def __init__(
+        self,
+        brain: str,
+        engine: str = "regex",
+        segments: Optional[Tuple[str, ...]] = None,
+    ):
+        """
+        Compile a template brain.
+
+        Args:
+            brain: The template string, with MARKER for each hole
+            engine: Either "regex" or "find"
+            segments: Optional precomputed brain.split(MARKER)
+        """
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown matching engine: {engine!r}")
+        self.brain = brain
+        self.engine = engine
+        if segments is None:
+            segments = tuple(brain.split(MARKER))
+        self.segments = segments
+        self._regex = None
+        # Regexes for spans(), by whether they match bytes; built on demand.
+        self._span_regexes: Dict[bool, Any] = {}
+        if engine == "regex":
+            pattern = re.escape(brain).replace(re.escape(MARKER), "(.*?)")
+            self._regex = re.compile(f"(?s)^{pattern}$")
+
+    def match(self, text: str) -> Tuple[str, ...]:
+        """
+        Returns the hole values of text, which should already be cleaned.
+
+        Raises:
+            NoMatch: If the text doesn't match the template
+        """
+        if self._regex is not None:
+            m = self._regex.search(text)
+            if m:
+                return m.groups()
+            raise NoMatch
+        return self._find(text)
+
+    def _find(self, text: str) -> Tuple[str, ...]:
+        segments = self.segments
+        first = segments[0]
+        if not text.startswith(first):
+            raise NoMatch
+        end = len(text)
+        # Like "$" in the regex engine, the template may end either at the
+        # end of the text or right before a trailing newline; the latter
+        # gives the shorter last hole, so it's tried first.
+        ends = (end - 1, end) if end and text[-1] == "\n" else (end,)
+        if len(segments) == 1:
+            if len(first) in ends:
+                return ()
+            raise NoMatch
+
+        pos = len(first)
+        values = []
+        for segment in segments[1:-1]:
+            i = text.find(segment, pos)
+            if i == -1:
+                raise NoMatch
+            values.append(text[pos:i])
+            pos = i + len(segment)
+        last = segments[-1]
+        for stop in ends:
+            i = stop - len(last)
+            if i >= pos and text.startswith(last, i, stop):
+                values.append(text[pos:i])
+                return tuple(values)
+        raise NoMatch
 
-    # Build the complete template
-    common_part = template_str[a_offset:a_end]
-    return left_template + common_part + right_template
+    def spans(self, data: Any) -> Tuple[Tuple[int, int], ...]:
+        """
+        Returns the (start, end) offsets of the hole values in data, which
+        is used as is rather than cleaned; a "\\r\\n" in data matches a
+        "\\n" in the template, so the line ending normalization done by
+        Template.clean() isn't needed.
+
+        data may be a str, or any bytes-like object such as bytes, a
+        memoryview or an mmap, in which case it's matched against the
+        template encoded as UTF-8 and the offsets count bytes. Nothing is
+        decoded or copied.
+
+        Raises:
+            NoMatch: If the data doesn't match the template
+        """
+        binary = not isinstance(data, str)
+        regex = self._span_regexes.get(binary)
+        if regex is None:
+            regex = self._span_regexes[binary] = _span_regex(self.segments, binary)
+        m = regex.match(data)
+        if m is None:
+            raise NoMatch
+        return m.regs[1:]
+
+
+def _span_regex(segments: Tuple[str, ...], binary: bool) -> Any:
+    """
+    Compiles the regex used by Matcher.spans(), for str or, if binary, for
+    UTF-8 encoded bytes.
+    """
+    newline = r"\r?\n"
+    hole = "(.*?)"
+    end = r"(?:\r?\n)?\Z"
+    parts = [newline.join(map(re.escape, segment.split("\n"))) for segment in segments]
+    pattern = "(?s)" + hole.join(parts) + end
+    if binary:
+        return re.compile(pattern.encode("utf-8", "surrogatepass"))
+    return re.compile(pattern)
+
+
+class _Cleaner:
+    """
+    The clean() method of a template class, configured with its constructor
+    options but without any learned state, so that it pickles to a few bytes.
+
+    The empty template that actually cleans the text is made on first use,
+    in whichever process that happens.
+    """
+
+    __slots__ = ("cls", "options", "_clean")
+
+    def __init__(self, cls: type, options: Dict[str, Any]):
+        self.cls = cls
+        self.options = options
+        self._clean: Optional[Callable[[str], str]] = None
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (self.cls, self.options))
+
+    def __call__(self, text: str) -> str:
+        clean = self._clean
+        if clean is None:
+            clean = self._clean = self.cls(**self.options).clean
+        return clean(text)
+
+
+class TemplateSnapshot:
+    """
+    An immutable, compiled copy of a Template, returned by
+    Template.snapshot(), for extracting data from many threads at once.
+    """
+
+    __slots__ = ("brain", "version", "matcher", "_clean")
+
+    brain: str
+    version: int
+    matcher: Matcher
+
+    def __init__(self, brain: str, version: int, matcher: Matcher, clean: _Cleaner):
+        object.__setattr__(self, "brain", brain)
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "matcher", matcher)
+        object.__setattr__(self, "_clean", clean)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("TemplateSnapshot is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("TemplateSnapshot is immutable")
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self), (self.brain, self.version, self.matcher, self._clean))
+
+    def as_text(self, custom_marker: str = "{{ HOLE }}") -> str:
+        """Returns a display-friendly version of the template; see Template."""
+        return self.brain.replace(MARKER, custom_marker)
+
+    def num_holes(self) -> int:
+        """Returns the number of holes in the template."""
+        return len(self.matcher.segments) - 1
+
+    def extract(self, text: str) -> Tuple[str, ...]:
+        """
+        Extract data from text that matches the template.
+
+        Raises:
+            NoMatch: If the text doesn't match the template
+        """
+        return self.matcher.match(self._clean(text))
+
+    def extract_dict(
+        self, text: str, field_names: Tuple[Optional[str], ...]
+    ) -> Dict[str, str]:
+        """
+        Extract data as a dictionary from text that matches the template.
+
+        Raises:
+            NoMatch: If the text doesn't match the template
+        """
+        data = self.extract(text)
+        return {
+            name: value for name, value in zip(field_names, data) if name is not None
+        }
+
+
+def _hole_recipes(
+    brain: str, holes: List[Tuple[int, int]]
+) -> Tuple[Tuple[Union[int, str], ...], ...]:
+    """
+    Returns, for each hole of a template made from brain, how to build its
+    value from the old template's: a tuple of literal strings and indexes of
+    the old holes, to be concatenated.
+
+    holes is the range of brain that each new hole replaced, as recorded by
+    _make_template_into(). The text between those ranges is common to both
+    inputs, so it holds no markers, and every old hole falls in exactly one
+    of the ranges.
+    """
+    recipes = []
+    old_hole = 0
+    for start, end in holes:
+        recipe: List[Union[int, str]] = []
+        pos = start
+        while True:
+            marker = brain.find(MARKER, pos, end)
+            if marker == -1:
+                break
+            if marker > pos:
+                recipe.append(brain[pos:marker])
+            recipe.append(old_hole)
+            old_hole += 1
+            pos = marker + 1
+        if end > pos:
+            recipe.append(brain[pos:end])
+        recipes.append(tuple(recipe))
+    return tuple(recipes)
 
 
 class Template:
@@ -133,17 +1292,83 @@ class Template:
     Template class that can learn patterns from example strings and extract data.
     """
 
-    def __init__(self, tolerance: int = 0, brain: Optional[str] = None):
+    def __init__(
+        self,
+        tolerance: int = 0,
+        brain: Optional[str] = None,
+        hierarchical: bool = False,
+        engine: str = "regex",
+        fast_learn: bool = False,
+        tokenizer: Union[None, str, Callable[[str], List[str]]] = None,
+        keep_index: bool = False,
+        alignment_cache: Optional[AlignmentCache] = None,
+        observer: Optional[Callable[[Any], None]] = None,
+    ):
         """
         Initialize a new template.
 
         Args:
             tolerance: Minimum allowed length of text between holes
             brain: Optional pre-existing template string
+            hierarchical: Align unique lines first and only run the
+                character-level alignment between them (see
+                make_template_hierarchical)
+            engine: Extraction engine, "regex" or "find" (see Matcher)
+            fast_learn: Skip the alignment in learn() for Sample Strings
+                that the template can already extract data from
+            tokenizer: Optional tokenizer function, or the name of one in
+                TOKENIZERS, to compare Sample Strings token by token; see
+                make_template()
+            keep_index: Keep a suffix automaton over the template between
+                learn() calls, so it's only rebuilt when the template
+                changes. This speeds up learning many Sample Strings, at the
+                cost of about 400 bytes of memory per template character.
+            alignment_cache: Optional AlignmentCache, which may be shared
+                with other templates, to reuse the alignments of fragments
+                that repeat across Sample Strings. It isn't saved by dumps().
+            observer: Optional function called with a LearnMetrics after
+                each learn() call and an ExtractMetrics after each extract()
+                call. It isn't saved by dumps() or pickled.
         """
+        if engine not in Matcher.ENGINES:
+            raise ValueError(f"Unknown matching engine: {engine!r}")
+        _resolve_tokenizer(tokenizer)
         self._brain = brain
         self._tolerance = tolerance
+        self._hierarchical = hierarchical
+        self._engine = engine
+        self._fast_learn = fast_learn
+        self._tokenizer = tokenizer
+        self._keep_index = keep_index
+        self.alignment_cache = alignment_cache
+        self.observer = observer
+        self._matcher: Optional[Matcher] = None
+        # Digests of Sample Strings known to leave the current brain as-is.
+        self._unchanged_digests: set = set()
+        self.fast_path_counts = {"seen": 0, "matched": 0}
         self.version = 0
+        # How the last learn() changed the holes; see remap_values().
+        self.last_change: Dict[int, str] = {}
+        self.last_remap: Optional[Tuple[Tuple[Union[int, str], ...], ...]] = None
+        # Suffix automaton over _index_brain; see _brain_index().
+        self._index: Optional[_SuffixAutomaton] = None
+        self._index_brain: Optional[str] = None
+        # Serializes learn() calls and the publication of snapshots.
+        self._lock = threading.Lock()
+        self._snapshot: Optional[TemplateSnapshot] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_snapshot"] = None
+        state["_index"] = state["_index_brain"] = None
+        state["_unchanged_digests"] = set()
+        state["observer"] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
 
     def clean(self, text: str) -> str:
         """
@@ -155,12 +1380,31 @@ class Template:
         Returns:
             Cleaned text
         """
-        return re.sub(r"\r\n", "\n", text)
+        return text.replace("\r\n", "\n")
 
     def learn(self, text: str) -> Optional[bool]:
         """
         Learns the given Sample String.
 
+        Alignment is skipped when the Sample String can't change the
+        template: when an identical string has already been learned since
+        the template last changed, or, with fast_learn, when the template
+        can already extract data from it. fast_path_counts records how many
+        Sample Strings took each of those shortcuts ("seen" and "matched").
+
+        If the template changes, last_change maps each new hole that
+        replaced literal text to that text, which is the value the hole had
+        in every earlier Sample String, and last_remap records how to turn
+        values extracted before the change into values for the new holes
+        (see remap_values). Both are worked out from the alignment itself,
+        in time proportional to the changed regions of the template.
+
+        Calls from several threads are serialized. Once snapshot() has been
+        called, each call also publishes a new snapshot when it's done.
+
+        If the template has an observer, it's then called with the
+        LearnMetrics of this call.
+
         Args:
             text: The input text to learn
 
@@ -169,106 +1413,1384 @@ class Template:
             - True if this Sample String created more holes in the template
             - False otherwise
         """
-        text = self.clean(text)
-        text = text.replace(MARKER, "")
+        observer = self.observer
+        if observer is not None:
+            return self._observed_learn(text, observer)
+        text = self.clean(text).replace(MARKER, "")
+        with self._lock:
+            result = self._learn(text)
+            if self._snapshot is not None:
+                self._publish()
+        return result
+
+    def _observed_learn(self, text: str, observer: Callable[[Any], None]) -> Any:
+        """learn(), reporting its LearnMetrics to observer."""
+        start = time.perf_counter()
+        text = self.clean(text).replace(MARKER, "")
+        clean_seconds = time.perf_counter() - start
+        counters = _AlignmentCounters()
+        with self._lock:
+            first = self._brain is None
+            seen = self.fast_path_counts["seen"]
+            matched = self.fast_path_counts["matched"]
+            start = time.perf_counter()
+            result = self._learn(text, counters)
+            learn_seconds = time.perf_counter() - start
+            if self._snapshot is not None:
+                self._publish()
+            num_holes = self.num_holes()
+        if first:
+            path = "first"
+        elif self.fast_path_counts["seen"] > seen:
+            path = "seen"
+        elif self.fast_path_counts["matched"] > matched:
+            path = "matched"
+        else:
+            path = "aligned"
+        observer(
+            LearnMetrics(
+                result,
+                path,
+                clean_seconds,
+                learn_seconds,
+                counters.depth,
+                counters.lcs_calls,
+                counters.chars_compared,
+                num_holes,
+            )
+        )
+        return result
+
+    def _learn(
+        self, text: str, counters: Optional[_AlignmentCounters] = None
+    ) -> Optional[bool]:
+        """
+        learn() for a cleaned Sample String, adding the work done by the
+        alignment to counters if given.
+        """
         self.version += 1
+        self.last_change = {}
+        self.last_remap = None
 
         if self._brain is None:
             self._brain = text
+            self._matcher = None
+            self._unchanged_digests = set()
             return None
 
+        digest = _digest(text)
+        if digest in self._unchanged_digests:
+            self.fast_path_counts["seen"] += 1
+            return False
+        if self._fast_learn:
+            try:
+                self.compile().match(text)
+            except NoMatch:
+                pass
+            else:
+                self.fast_path_counts["matched"] += 1
+                return False
+
         old_holes = self.num_holes()
-        self._brain = make_template(self._brain, text, self._tolerance)
+        holes: List[Tuple[int, int]] = []
+        brain = self._align(self._brain, text, holes, counters)
+        if brain == self._brain:
+            if len(self._unchanged_digests) < _MAX_UNCHANGED_DIGESTS:
+                self._unchanged_digests.add(digest)
+            return False
+        self._set_last_change(holes)
+        self._brain = brain
+        self._matcher = None
+        self._unchanged_digests = set()
         return self.num_holes() > old_holes
 
-    def as_text(self, custom_marker: str = "{{ HOLE }}") -> str:
+    def learn_batch(self, texts: Iterable[str]) -> Optional[bool]:
         """
-        Returns a display-friendly version of the template.
+        Learns several Sample Strings at once.
+
+        Rather than being folded into the template one at a time, the
+        Sample Strings are aligned all together, along with the current
+        template if there is one: each literal segment of the result is
+        found by a single scan of every string, and the template doesn't
+        depend on the order of texts. The hierarchical option doesn't apply
+        here; a tokenizer does.
+
+        last_change and last_remap are set as by learn(), and version goes
+        up by the number of texts.
 
         Args:
-            custom_marker: The string to use to mark template holes
+            texts: The Sample Strings to learn
 
         Returns:
-            A readable template string
+            - None if the template had not learned anything before
+            - True if the batch created more holes in the template
+            - False otherwise
         """
-        if self._brain is None:
-            return ""
-        return self._brain.replace(MARKER, custom_marker)
+        texts = [self.clean(text).replace(MARKER, "") for text in texts]
+        with self._lock:
+            result = self._learn_batch(texts)
+            if self._snapshot is not None:
+                self._publish()
+        return result
+
+    def _learn_batch(self, texts: List[str]) -> Optional[bool]:
+        self.version += len(texts)
+        self.last_change = {}
+        self.last_remap = None
+        old = self._brain
+        # Duplicates can't change the result, and sorting makes it
+        # independent of the order of texts.
+        strings = sorted(set(texts))
+        if old is not None:
+            strings.insert(0, old)
+        if not strings:
+            return False
+
+        holes: List[Tuple[int, int]] = []
+        brain = self._align_many(strings, holes) if len(strings) > 1 else strings[0]
+        if brain == old:
+            return False
+        if old is not None:
+            self._set_last_change(holes)
+        self._brain = brain
+        self._matcher = None
+        self._unchanged_digests = set()
+        if old is None:
+            return None
+        return brain.count(MARKER) > old.count(MARKER)
 
-    def num_holes(self) -> int:
+    def _align_many(self, strings: List[str], holes: List[Tuple[int, int]]) -> str:
         """
-        Returns the number of holes in this template.
-
-        Returns:
-            Number of holes
+        Aligns all of strings together, appending to holes the range of
+        strings[0] that each hole of the result replaces.
         """
-        if self._brain is None:
-            return 0
-        return self._brain.count(MARKER)
+        tokenizer = _resolve_tokenizer(self._tokenizer)
+        pieces: List[str] = []
+        if tokenizer is None:
+            _make_template_multi_into(pieces, strings, self._tolerance, holes)
+            return "".join(pieces)
+        codec = _TokenCodec(tokenizer)
+        encoded = [codec.encode(s) for s in strings]
+        token_holes: List[Tuple[int, int]] = []
+        _make_template_multi_into(pieces, encoded, self._tolerance, token_holes)
+        offsets = codec.offsets(encoded[0])
+        holes.extend((offsets[start], offsets[end]) for start, end in token_holes)
+        return codec.decode("".join(pieces))
+
+    def _set_last_change(self, holes: List[Tuple[int, int]]) -> None:
+        """
+        Sets last_remap and last_change from the range of the current brain
+        that each hole of the next one replaces.
+        """
+        self.last_remap = _hole_recipes(self._brain, holes)
+        self.last_change = {
+            i: recipe[0] if recipe else ""
+            for i, recipe in enumerate(self.last_remap)
+            if not any(isinstance(part, int) for part in recipe)
+        }
 
-    def extract(self, text: str) -> Tuple[str, ...]:
+    def remap_values(self, values: Sequence[str]) -> Tuple[str, ...]:
         """
-        Extract data from text that matches this template.
+        Converts data extracted before the last learn() call into data for
+        the template as it is now, so that stored extraction results don't
+        have to be re-extracted from their documents when a hole splits.
+
+        The document is rebuilt from the values and the literal text the
+        new holes replaced, and matched against the template as it is now.
+        That takes time proportional to the document, but gives exactly
+        what extract() would return for it, even where the document can be
+        split into the new holes' values in more than one way. The one
+        thing the values can't tell is whether the document had a newline
+        at the very end beyond what the template expects, since extract()
+        ignores one; the result is for a document without it.
 
         Args:
-            text: The text to extract data from
+            values: A tuple returned by extract() before the last learn()
 
         Returns:
-            A tuple of extracted values
+            The tuple extract() would return for the same document now
 
         Raises:
-            NoMatch: If the text doesn't match the template
+            ValueError: If values has the wrong number of items
         """
-        if self._brain is None:
-            raise NoMatch("Template has not learned any patterns yet")
+        if self.last_remap is None:
+            return tuple(values)
+        expected = sum(
+            isinstance(part, int) for recipe in self.last_remap for part in recipe
+        )
+        if len(values) != expected:
+            raise ValueError(f"Expected {expected} values, got {len(values)}")
+        pieces = self._brain.split(MARKER)
+        document = [pieces[0]]
+        for recipe, piece in zip(self.last_remap, pieces[1:]):
+            document.extend(
+                values[part] if isinstance(part, int) else part for part in recipe
+            )
+            document.append(piece)
+        return self.compile().match("".join(document))
+
+    def _align(
+        self,
+        template_str: str,
+        new_str: str,
+        holes: Optional[List[Tuple[int, int]]] = None,
+        counters: Optional[_AlignmentCounters] = None,
+    ) -> str:
+        """
+        Runs the configured alignment over two strings. If holes is given,
+        the range of template_str that each hole of the result replaces is
+        appended to it. If counters is given, the work done is added to it.
+        """
+        if self._hierarchical:
+            return _make_template_hierarchical(
+                template_str,
+                new_str,
+                self._tolerance,
+                self._tokenizer,
+                holes,
+                self.alignment_cache,
+                counters,
+            )
+        if (
+            not self._keep_index
+            or template_str is not self._brain
+            or self._tokenizer is not None
+        ):
+            return _make_template(
+                template_str,
+                new_str,
+                self._tolerance,
+                self._tokenizer,
+                holes,
+                self.alignment_cache,
+                counters,
+            )
+        pieces: List[str] = []
+        _make_template_into(
+            pieces,
+            template_str,
+            new_str,
+            self._tolerance,
+            0,
+            len(template_str),
+            0,
+            len(new_str),
+            holes,
+            self._brain_index(),
+            self.alignment_cache,
+            counters,
+        )
+        return "".join(pieces)
 
-        text = self.clean(text)
-        pattern = re.escape(self._brain).replace(re.escape(MARKER), "(.*?)")
-        m = re.search(f"(?s)^{pattern}$", text)
-        if m:
-            return m.groups()
-        raise NoMatch
+    def _brain_index(self) -> _SuffixAutomaton:
+        """
+        Returns a suffix automaton over the brain, which is kept for as long
+        as the brain doesn't change. Aligning a Sample String with the whole
+        brain then only has to scan the Sample String.
 
-    def extract_dict(
-        self, text: str, field_names: Tuple[Optional[str], ...]
-    ) -> Dict[str, str]:
+        A suffix automaton can't be edited in place when a region of the
+        brain changes, so it's rebuilt, on demand, after each change; once
+        the template has mostly converged, that's rare.
         """
-        Extract data as a dictionary from text that matches this template.
+        index = self._index
+        if index is None or self._index_brain is not self._brain:
+            index = self._index = _SuffixAutomaton(self._brain)
+            self._index_brain = self._brain
+        return index
 
-        Args:
-            text: The text to extract data from
-            field_names: Names to use for each extracted field
+    def _merge(self, brain_a: str, brain_b: str) -> str:
+        """
+        Merges two templates into one that matches everything either does.
 
-        Returns:
-            Dictionary of field names to extracted values
+        Holes in both brains line up with each other during the alignment;
+        runs of adjacent holes this produces are collapsed into one.
+        """
+        return _MARKER_RUN_RE.sub(MARKER, self._align(brain_a, brain_b))
 
-        Raises:
-            NoMatch: If the text doesn't match the template
+    def _clean_key(self) -> Any:
         """
-        data = self.extract(text)
-        data_dict = {
-            name: value for name, value in zip(field_names, data) if name is not None
+        Returns a hashable value that is equal for any two templates whose
+        clean() methods give the same result.
+        """
+        return type(self)
+
+    def _options(self) -> Dict[str, Any]:
+        """Returns the constructor arguments that configure this template."""
+        return {
+            "tolerance": self._tolerance,
+            "hierarchical": self._hierarchical,
+            "engine": self._engine,
+            "fast_learn": self._fast_learn,
+            "tokenizer": self._tokenizer,
+            "keep_index": self._keep_index,
         }
-        return data_dict
 
-    @classmethod
-    def from_directory(cls, dirname: str, tolerance: int = 0) -> "Template":
+    def snapshot(self) -> "TemplateSnapshot":
+        """
+        Returns an immutable, compiled copy of the template as it is now.
+
+        A snapshot can be shared by any number of threads without locking,
+        even while another thread keeps calling learn(): learn() never
+        changes a published snapshot, but publishes a new one once it's
+        done. Call snapshot() again to pick up the latest one; it only
+        waits for learn() the very first time.
+
+        Raises:
+            NoMatch: If the template has not learned anything yet
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._publish()
+                snapshot = self._snapshot
+        return snapshot
+
+    def _publish(self) -> None:
+        """Publishes a snapshot of the template; the lock must be held."""
+        previous = self._snapshot
+        if previous is not None and previous.brain is self._brain:
+            matcher = previous.matcher
+        else:
+            matcher = self.compile()
+        if previous is not None:
+            clean = previous._clean
+        else:
+            clean = _Cleaner(type(self), self._options())
+        self._snapshot = TemplateSnapshot(self._brain, self.version, matcher, clean)
+
+    def compile(self) -> Matcher:
+        """
+        Returns the Matcher for the current template.
+
+        The Matcher is compiled on first use and reused until learn() changes
+        the template.
+
+        Raises:
+            NoMatch: If the template has not learned anything yet
+        """
+        if self._brain is None:
+            raise NoMatch("Template has not learned any patterns yet")
+        matcher = self._matcher
+        if matcher is None or matcher.brain is not self._brain:
+            matcher = self._matcher = Matcher(self._brain, self._engine)
+        return matcher
+
+    def dumps(self, **extra: Any) -> bytes:
+        """
+        Serializes this template to bytes; see loads().
+
+        The result holds the template class, its constructor options, its
+        version, the brain and the table of literal segments between holes.
+
+        Args:
+            **extra: Additional JSON-serializable values to store in the
+                header, returned by _load_with_extra()
+        """
+        brain = self._brain
+        options = self._options()
+        tokenizer = options["tokenizer"]
+        if callable(tokenizer):
+            names = [k for k, v in TOKENIZERS.items() if v is tokenizer]
+            if not names:
+                raise ValueError("Can't save a template with a custom tokenizer")
+            options["tokenizer"] = names[0]
+        header = {
+            "class": _class_name(type(self)),
+            "options": options,
+            "version": self.version,
+            "segments": None,
+            "extra": extra,
+        }
+        if brain is not None:
+            header["segments"] = [len(s) for s in brain.split(MARKER)]
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        body = b"" if brain is None else brain.encode("utf-8", "surrogatepass")
+        return b"".join(
+            [
+                _FORMAT_MAGIC,
+                _FORMAT_HEADER.pack(_FORMAT_VERSION, len(header_bytes)),
+                header_bytes,
+                body,
+            ]
+        )
+
+    @classmethod
+    def loads(cls, data: bytes) -> "Template":
+        """
+        Creates a template from the output of dumps().
+
+        The template is restored as the class it was saved as, which must
+        be cls or one of its subclasses, and its Matcher is built from the
+        stored segment table, ready for extraction.
+
+        Raises:
+            ValueError: If data isn't a saved template this version of
+                templatemaker can read
+        """
+        return cls._loads_with_extra(data)[0]
+
+    def save(self, path: str, **extra: Any) -> None:
+        """
+        Saves this template to a file, atomically replacing any existing
+        file at that path; see dumps().
+        """
+        data = self.dumps(**extra)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Template":
+        """
+        Loads a template saved with save(); see loads().
+        """
+        return cls._load_with_extra(path)[0]
+
+    @classmethod
+    def _load_with_extra(cls, path: str) -> Tuple["Template", Dict[str, Any]]:
+        with open(path, "rb") as file:
+            return cls._loads_with_extra(file.read())
+
+    @classmethod
+    def _loads_with_extra(cls, data: bytes) -> Tuple["Template", Dict[str, Any]]:
+        start = len(_FORMAT_MAGIC) + _FORMAT_HEADER.size
+        if data[: len(_FORMAT_MAGIC)] != _FORMAT_MAGIC or len(data) < start:
+            raise ValueError("Not a saved template")
+        format_version, header_size = _FORMAT_HEADER.unpack_from(
+            data, len(_FORMAT_MAGIC)
+        )
+        if format_version != _FORMAT_VERSION:
+            raise ValueError(f"Unsupported template format version {format_version}")
+        header = json.loads(data[start : start + header_size].decode("utf-8"))
+
+        klass = _find_template_class(header["class"])
+        if klass is None or not issubclass(klass, cls):
+            raise ValueError(f"Can't load a {header['class']} as {cls.__name__}")
+        t = klass(**header["options"])
+        t.version = header["version"]
+        lengths = header["segments"]
+        if lengths is not None:
+            brain = data[start + header_size :].decode("utf-8", "surrogatepass")
+            segments = []
+            pos = 0
+            for length in lengths:
+                segments.append(brain[pos : pos + length])
+                pos += length + 1
+            if pos != len(brain) + 1:
+                raise ValueError("Saved template is corrupt")
+            t._brain = brain
+            t._matcher = Matcher(brain, t._engine, tuple(segments))
+        return t, header["extra"]
+
+    def as_text(self, custom_marker: str = "{{ HOLE }}") -> str:
+        """
+        Returns a display-friendly version of the template.
+
+        Args:
+            custom_marker: The string to use to mark template holes
+
+        Returns:
+            A readable template string
+        """
+        if self._brain is None:
+            return ""
+        return self._brain.replace(MARKER, custom_marker)
+
+    def num_holes(self) -> int:
+        """
+        Returns the number of holes in this template.
+
+        Returns:
+            Number of holes
+        """
+        if self._brain is None:
+            return 0
+        return self._brain.count(MARKER)
+
+    def extract(self, text: str) -> Tuple[str, ...]:
+        """
+        Extract data from text that matches this template.
+
+        If the template has an observer, it's then called with the
+        ExtractMetrics of this call, whether or not the text matched.
+
+        Args:
+            text: The text to extract data from
+
+        Returns:
+            A tuple of extracted values
+
+        Raises:
+            NoMatch: If the text doesn't match the template
+        """
+        observer = self.observer
+        if observer is not None:
+            return self._observed_extract(text, observer)
+        matcher = self.compile()
+        return matcher.match(self.clean(text))
+
+    def _observed_extract(
+        self, text: str, observer: Callable[[Any], None]
+    ) -> Tuple[str, ...]:
+        """extract(), reporting its ExtractMetrics to observer."""
+        start = time.perf_counter()
+        text = self.clean(text)
+        cleaned = time.perf_counter()
+        try:
+            values = self.compile().match(text)
+        except NoMatch:
+            now = time.perf_counter()
+            observer(ExtractMetrics(False, cleaned - start, now - cleaned, len(text)))
+            raise
+        now = time.perf_counter()
+        observer(ExtractMetrics(True, cleaned - start, now - cleaned, len(text)))
+        return values
+
+    def extract_spans(self, data: Any) -> Tuple[Tuple[int, int], ...]:
+        """
+        Locate data in text that matches this template, without copying it.
+
+        Unlike extract(), this doesn't clean the text: it must only differ
+        from what the template learned by its line endings. That means it
+        can work on undecoded bytes, including a memoryview or an mmap of a
+        file, so that only the values actually needed have to be sliced
+        out and decoded.
+
+        Args:
+            data: A str, or a bytes-like object holding UTF-8 text
+
+        Returns:
+            A tuple of (start, end) offsets into data, one per hole. For
+            bytes-like data, they count bytes.
+
+        Raises:
+            NoMatch: If the data doesn't match the template
+            TypeError: If this template's clean() does more than normalize
+                line endings, so offsets into the raw text can't be found
+        """
+        if type(self).clean is not Template.clean:
+            raise TypeError(
+                f"{type(self).__name__} cleans text, so it can't extract spans"
+            )
+        return self.compile().spans(data)
+
+    def finditer(
+        self,
+        stream: Any,
+        chunk_size: int = 65536,
+        max_record_size: Optional[int] = None,
+    ) -> Iterator[Tuple[Any, ...]]:
+        """
+        Find every record matching this template in a stream of records.
+
+        Records are found the way re.finditer() would find them with the
+        template's regular expression, unanchored: each one starts at the
+        leftmost occurrence of the template's first literal segment that
+        can be completed, holes are as short as possible, and records
+        don't overlap. The stream is read chunk_size characters (or bytes)
+        at a time and only the record being matched is kept in memory, so
+        a record may span any number of chunks.
+
+        Like extract_spans(), this doesn't clean the text. Open files in
+        text mode to have their line endings normalized.
+
+        Args:
+            stream: A file object opened in text or binary mode, or a str,
+                bytes or mmap; binary input is matched against the template
+                encoded as UTF-8
+            chunk_size: Number of characters or bytes read at a time
+            max_record_size: If given, a record that hasn't been completed
+                within this many characters or bytes is given up on, and
+                the search resumes right after where it started. Without
+                it, an incomplete record at the end of the stream keeps the
+                rest of the stream in memory.
+
+        Returns:
+            An iterator over the hole values of each record, as tuples of
+            str for text input or of bytes for binary input
+
+        Raises:
+            ValueError: If the template doesn't start and end with literal
+                text, which records couldn't be told apart without
+            TypeError: If this template's clean() does more than normalize
+                line endings
+        """
+        if type(self).clean is not Template.clean:
+            raise TypeError(
+                f"{type(self).__name__} cleans text, so it can't find records"
+            )
+        segments: Sequence[Any] = self.compile().segments
+        if not segments[0] or not segments[-1]:
+            raise ValueError("Templates must start and end with text to find records")
+
+        read = getattr(stream, "read", None)
+        if read is None:
+            buffer, eof = stream, True
+        else:
+            buffer = read(chunk_size)
+            eof = not buffer
+        if not isinstance(buffer, str):
+            segments = [
+                segment.encode("utf-8", "surrogatepass") for segment in segments
+            ]
+
+        start = -1  # Where the record being matched starts, if any
+        scan = 0  # Where to look for the next segment
+        hole = 0  # Where the current hole's value starts
+        values: List[Any] = []
+        while True:
+            segment = segments[len(values) + 1 if start != -1 else 0]
+            i = buffer.find(segment, scan)
+            if i != -1:
+                if start == -1:
+                    start = i
+                else:
+                    values.append(buffer[hole:i])
+                hole = scan = i + len(segment)
+                if len(values) + 1 == len(segments):
+                    yield tuple(values)
+                    start, values = -1, []
+                continue
+
+            if eof:
+                # A record starting later would look for the missing segment
+                # from no earlier than here, so it couldn't be completed
+                # either.
+                return
+            if (
+                max_record_size is not None
+                and start != -1
+                and len(buffer) - start > max_record_size
+            ):
+                # Give up on this record; look for the next one.
+                scan = start + 1
+                start, values = -1, []
+                continue
+
+            # The segment may still begin in the last few characters.
+            keep = start if start != -1 else max(scan, len(buffer) - len(segment) + 1)
+            chunk = read(chunk_size)
+            if not chunk:
+                eof = True
+                continue
+            buffer = buffer[keep:] + chunk
+            scan = max(scan - keep, len(buffer) - len(chunk) - len(segment) + 1, 0)
+            hole -= keep
+            if start != -1:
+                start = 0
+
+    def extract_dict(
+        self, text: str, field_names: Tuple[Optional[str], ...]
+    ) -> Dict[str, str]:
+        """
+        Extract data as a dictionary from text that matches this template.
+
+        Args:
+            text: The text to extract data from
+            field_names: Names to use for each extracted field
+
+        Returns:
+            Dictionary of field names to extracted values
+
+        Raises:
+            NoMatch: If the text doesn't match the template
+        """
+        data = self.extract(text)
+        data_dict = {
+            name: value for name, value in zip(field_names, data) if name is not None
+        }
+        return data_dict
+
+    def extract_many(
+        self,
+        texts: Iterable[str],
+        workers: Optional[int] = None,
+        chunksize: int = 64,
+        ordered: bool = True,
+    ) -> Iterator[Any]:
+        """
+        Extract data from many texts, optionally across worker processes.
+
+        The template is sent to each worker process once, when the worker
+        starts. Texts are read from the iterable lazily and sent to the
+        workers in chunks, with at most two chunks per worker in flight, so
+        memory stays bounded even if texts is an endless generator.
+
+        A text that doesn't match the template doesn't stop the batch:
+        its result is the NoMatch exception instead of a tuple.
+
+        Args:
+            texts: The texts to extract data from
+            workers: Number of worker processes; None or 1 extracts in
+                this process
+            chunksize: Number of texts sent to a worker at a time
+            ordered: Whether to yield results in input order
+
+        Returns:
+            An iterator over the extracted tuples (or NoMatch instances), in
+            input order. If ordered is False, it yields (index, result) pairs
+            in the order the chunks finish instead.
+        """
+        self.compile()
+        if workers is None or workers <= 1:
+            for index, text in enumerate(texts):
+                result = _extract_or_nomatch(self, text)
+                yield result if ordered else (index, result)
+            return
+
+        chunks = _iter_chunks(texts, chunksize)
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(self,)
+        )
+        try:
+            pending: Any = deque() if ordered else set()
+            offsets = {}
+            offset = 0
+            while True:
+                for chunk in islice(chunks, 2 * workers - len(pending)):
+                    future = executor.submit(_extract_chunk, chunk)
+                    if ordered:
+                        pending.append(future)
+                    else:
+                        # Only unordered results need their offsets, and
+                        # they're dropped as soon as the chunk is yielded.
+                        pending.add(future)
+                        offsets[future] = offset
+                        offset += len(chunk)
+                if not pending:
+                    break
+                if ordered:
+                    yield from pending.popleft().result()
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start = offsets.pop(future)
+                    yield from enumerate(future.result(), start)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    async def aextract(
+        self,
+        texts: AsyncIterable[str],
+        executor: Optional[Executor] = None,
+        chunksize: int = 64,
+        max_pending: int = 4,
+        time_slice: float = 0.005,
+        linger: float = 0.001,
+    ) -> AsyncIterator[Any]:
+        """
+        Extract data from an asynchronous stream of texts, without blocking
+        the event loop.
+
+        Texts are cleaned and extracted in the executor, in chunks of up to
+        chunksize texts. A chunk is sent when it's full, or earlier if texts
+        produces nothing new for linger seconds, and at most max_pending
+        chunks are in the executor at a time. While they are, the next chunk
+        fills up, and once that's full, texts is no longer read, so a
+        producer feeding it is slowed down to the executor's pace. On the
+        event loop itself, aextract() yields control at least every
+        time_slice seconds, even if the consumer never awaits anything.
+
+        All the texts are extracted with the template as it was when
+        aextract() started, even if it learns more in the meantime.
+
+        A text that doesn't match the template doesn't stop the stream:
+        its result is the NoMatch exception instead of a tuple.
+
+        Args:
+            texts: The texts to extract data from
+            executor: The concurrent.futures executor to extract in;
+                defaults to the event loop's default (thread pool)
+                executor. A ProcessPoolExecutor extracts in parallel, at
+                the cost of sending a copy of the template with each chunk.
+            chunksize: Most texts sent to the executor at a time
+            max_pending: Most chunks in the executor at a time
+            time_slice: Longest time, in seconds, aextract() keeps the
+                event loop busy before yielding control
+            linger: Longest time, in seconds, to wait for another text
+                before sending a chunk that isn't full
+
+        Returns:
+            An asynchronous iterator over the extracted tuples (or NoMatch
+            instances), in input order
+
+        Raises:
+            NoMatch: If the template has not learned anything yet
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = TemplateSnapshot(
+                    self._brain,
+                    self.version,
+                    self.compile(),
+                    _Cleaner(type(self), self._options()),
+                )
+        loop = asyncio.get_running_loop()
+        iterator = texts.__aiter__()
+        next_text: Optional[asyncio.Future] = None
+        exhausted = False
+        chunk: List[str] = []
+        chunk_deadline = 0.0
+        pending: deque = deque()
+        deadline = time.perf_counter() + time_slice
+        try:
+            while True:
+                if next_text is None and not exhausted and len(chunk) < chunksize:
+                    next_text = asyncio.ensure_future(iterator.__anext__())
+                # A chunk is sent once it's full, once texts runs out, or once
+                # no new text has come for linger seconds, if there's room.
+                room = len(pending) < max_pending
+                if (
+                    chunk
+                    and room
+                    and (next_text is None or time.perf_counter() >= chunk_deadline)
+                ):
+                    pending.append(
+                        loop.run_in_executor(
+                            executor, _extract_snapshot_chunk, snapshot, chunk
+                        )
+                    )
+                    chunk = []
+                    continue
+                waiting = [next_text] if next_text is not None else []
+                if pending:
+                    waiting.append(pending[0])
+                if not waiting:
+                    return
+                timeout = None
+                if chunk and room:
+                    timeout = max(chunk_deadline - time.perf_counter(), 0.0)
+                await asyncio.wait(
+                    waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                deadline = time.perf_counter() + time_slice
+
+                if pending and pending[0].done():
+                    for result in pending.popleft().result():
+                        yield result
+                        if time.perf_counter() >= deadline:
+                            await asyncio.sleep(0)
+                            deadline = time.perf_counter() + time_slice
+                if next_text is not None and next_text.done():
+                    try:
+                        text = next_text.result()
+                    except StopAsyncIteration:
+                        exhausted = True
+                    else:
+                        chunk.append(text)
+                        chunk_deadline = time.perf_counter() + linger
+                    next_text = None
+        finally:
+            if next_text is not None:
+                next_text.cancel()
+            for future in pending:
+                future.cancel()
+
+    def extract_columns(
+        self,
+        texts: Iterable[str],
+        errors: str = "raise",
+        sample_size: int = 1000,
+        numpy: bool = False,
+        workers: Optional[int] = None,
+        chunksize: int = 64,
+    ) -> List[Any]:
+        """
+        Extract data from many texts as one typed column per hole.
+
+        The type of each column is inferred once, from its first
+        sample_size values, and then the whole column is converted in bulk:
+
+        - integers become an array.array("q") (or a NumPy int64 array);
+        - other numbers become an array.array("d") (or a NumPy float64
+          array);
+        - dates, times and date-times in one of the formats in
+          DATETIME_FORMATS become lists of date, time or datetime objects;
+        - anything else stays a list of strings.
+
+        Numbers with leading zeros, like ZIP codes, are kept as strings. If
+        a value past the sample doesn't fit the inferred type, the column
+        falls back to the next more general one (integer to float to
+        string, or date-time to string).
+
+        Args:
+            texts: The texts to extract data from
+            errors: What to do with a text that doesn't match the template:
+                "raise" raises NoMatch, "skip" leaves it out
+            sample_size: Number of values per column used to infer its type
+            numpy: Return numeric columns as NumPy arrays, which share the
+                arrays' memory; requires NumPy
+            workers: Number of worker processes (see extract_many)
+            chunksize: Number of texts sent to a worker at a time
+
+        Returns:
+            A list with one column per hole
+
+        Raises:
+            NoMatch: If a text doesn't match the template and errors is
+                "raise"
+        """
+        if errors not in ("raise", "skip"):
+            raise ValueError(f"Unknown errors mode: {errors!r}")
+        if numpy:
+            import numpy as np
+
+        rows = []
+        for result in self.extract_many(texts, workers, chunksize):
+            if isinstance(result, NoMatch):
+                if errors == "raise":
+                    raise result
+                continue
+            rows.append(result)
+        if rows:
+            columns = [list(column) for column in zip(*rows)]
+        else:
+            columns = [[] for _ in range(self.num_holes())]
+        del rows
+
+        result = []
+        for values in columns:
+            column = _convert_column(values, _infer_column_type(values[:sample_size]))
+            if numpy and isinstance(column, array):
+                column = np.frombuffer(column, dtype=column.typecode)
+            result.append(column)
+        return result
+
+    @classmethod
+    def train(
+        cls,
+        samples: Iterable[str],
+        tolerance: int = 0,
+        patience: int = 50,
+        max_samples: Optional[int] = None,
+        max_seconds: Optional[float] = None,
+        checkpoint: Optional[str] = None,
+        checkpoint_every: int = 1000,
+        **kwargs: Any,
+    ) -> Tuple["Template", TrainingStats]:
+        """
+        Create a template by learning from a stream of Sample Strings until
+        it converges.
+
+        Samples are pulled from the iterable one at a time, so it can be a
+        lazy generator over a large crawl (see iter_files()). Training stops
+        as soon as patience consecutive samples leave the number of holes
+        unchanged, max_samples samples have been learned or max_seconds
+        have passed, whichever comes first.
+
+        With checkpoint set, the template is saved to that path every
+        checkpoint_every samples and when training stops. If the file
+        already exists, training resumes from it: the template is loaded,
+        and as many samples as it had already learned are skipped, so
+        samples must yield the same sequence as in the interrupted run.
+        The options saved in the checkpoint must match tolerance and kwargs,
+        except for brain, which it already includes; observer and
+        alignment_cache aren't saved, so they're taken from kwargs.
+
+        Args:
+            samples: The Sample Strings to learn
+            tolerance: Minimum allowed length of text between holes
+            patience: Number of consecutive unchanged samples after which
+                the template counts as converged
+            max_samples: Optional maximum number of samples to learn
+            max_seconds: Optional time budget, in seconds
+            checkpoint: Optional path to save checkpoints to and resume from
+            checkpoint_every: Number of samples between checkpoints
+            **kwargs: Other arguments for the template constructor
+
+        Returns:
+            A tuple of (template, TrainingStats). The statistics only cover
+            the samples learned in this call.
+
+        Raises:
+            ValueError: If the checkpoint was saved with different options
+        """
+        unchanged_run = 0
+        if checkpoint is not None and os.path.exists(checkpoint):
+            t, extra = cls._load_with_extra(checkpoint)
+            t._resume_with(cls(tolerance, **kwargs), ["tolerance", *kwargs], checkpoint)
+            unchanged_run = extra.get("unchanged_run", 0)
+            samples = islice(samples, t.version, None)
+        else:
+            t = cls(tolerance, **kwargs)
+        stats = t._train(
+            samples,
+            patience,
+            max_samples,
+            max_seconds,
+            unchanged_run,
+            checkpoint,
+            checkpoint_every,
+        )
+        return t, stats
+
+    def _resume_with(
+        self, requested: "Template", names: List[str], checkpoint: str
+    ) -> None:
+        """
+        Checks that a template loaded from a checkpoint was saved with the
+        given options of requested, and takes its runtime-only attributes.
+        """
+        saved = self._options()
+        for name, value in requested._options().items():
+            if name not in names:
+                continue
+            if name == "tokenizer":
+                same = _resolve_tokenizer(value) is _resolve_tokenizer(saved[name])
+            else:
+                same = value == saved[name]
+            if not same:
+                raise ValueError(
+                    f"Checkpoint {checkpoint!r} was saved with "
+                    f"{name}={saved[name]!r}, not {value!r}"
+                )
+        self.alignment_cache = requested.alignment_cache
+        self.observer = requested.observer
+
+    def _train(
+        self,
+        samples: Iterable[str],
+        patience: int,
+        max_samples: Optional[int],
+        max_seconds: Optional[float],
+        unchanged_run: int = 0,
+        checkpoint: Optional[str] = None,
+        checkpoint_every: int = 1000,
+    ) -> TrainingStats:
+        """Learns samples until one of train()'s stopping conditions holds."""
+        start = time.monotonic()
+        deadline = None if max_seconds is None else start + max_seconds
+        learned = 0
+        stop_reason = "exhausted"
+        for text in samples:
+            old_holes = self.num_holes()
+            first = self.learn(text) is None
+            learned += 1
+            if first or self.num_holes() != old_holes:
+                unchanged_run = 0
+            else:
+                unchanged_run += 1
+            if checkpoint is not None and learned % checkpoint_every == 0:
+                self.save(checkpoint, unchanged_run=unchanged_run)
+
+            if unchanged_run >= patience:
+                stop_reason = "converged"
+                break
+            if max_samples is not None and learned >= max_samples:
+                stop_reason = "max_samples"
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                stop_reason = "max_seconds"
+                break
+        if checkpoint is not None:
+            self.save(checkpoint, unchanged_run=unchanged_run)
+        return TrainingStats(
+            learned,
+            stop_reason,
+            unchanged_run,
+            self.num_holes(),
+            time.monotonic() - start,
+        )
+
+    @classmethod
+    def from_directory(
+        cls,
+        dirname: str,
+        tolerance: int = 0,
+        workers: Optional[int] = None,
+        pattern: Optional[str] = None,
+        sort: bool = False,
+        ordered: bool = True,
+        chunksize: int = 16,
+        verbose: bool = True,
+        **kwargs: Any,
+    ) -> "Template":
         """
         Create a template by learning from all files in a directory.
 
+        By default the files are learned one after another, printing the
+        result of each learn() call. With workers set, the files are split
+        into chunks that worker processes learn independently, and the
+        partial templates are then merged pairwise in a reduction tree.
+        Nothing is printed in that mode, and the resulting template can
+        differ slightly from the one learned serially.
+
         Args:
             dirname: Path to the directory containing example files
             tolerance: Minimum allowed length of text between holes
+            workers: Number of worker processes for parallel learning
+            pattern: Optional glob pattern that file names must match
+            sort: Whether to learn the files sorted by name
+            ordered: Whether parallel merges always pair up the same
+                partial templates, making the result deterministic; if False,
+                partial templates are merged as soon as they're ready
+            chunksize: Number of files each worker learns serially before
+                its result is merged
+            verbose: Whether to print the result of each learn() call when
+                learning serially
+            **kwargs: Other arguments for the template constructor
 
         Returns:
             A new Template instance
         """
-        t = cls(tolerance)
-        for f in os.listdir(dirname):
-            with open(os.path.join(dirname, f), "r") as file:
-                print(t.learn(file.read()))
+        t = cls(tolerance, **kwargs)
+        paths = _list_files(dirname, pattern, sort)
+        t._learn_paths(paths, workers, ordered, chunksize, verbose)
         return t
 
+    def _learn_paths(
+        self,
+        paths: List[str],
+        workers: Optional[int] = None,
+        ordered: bool = True,
+        chunksize: int = 16,
+        verbose: bool = False,
+    ) -> None:
+        """Learns the given files; see from_directory()."""
+        if workers is None:
+            for path in paths:
+                with open(path, "r") as file:
+                    result = self.learn(file.read())
+                if verbose:
+                    print(result)
+            return
+
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(self,)
+        )
+        try:
+            futures = [
+                executor.submit(_learn_files, chunk)
+                for chunk in _iter_chunks(paths, chunksize)
+            ]
+            if ordered:
+                partials = [future.result() for future in futures]
+                while len(partials) > 1:
+                    pairs = list(zip(partials[::2], partials[1::2]))
+                    merged = list(executor.map(_merge_partials, pairs))
+                    if len(partials) % 2:
+                        merged.append(partials[-1])
+                    partials = merged
+            else:
+                pending = set(futures)
+                partials = []
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    partials.extend(future.result() for future in done)
+                    while len(partials) >= 2:
+                        pair = (partials.pop(), partials.pop())
+                        pending.add(executor.submit(_merge_partials, pair))
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        if partials:
+            self._brain, self.version = partials[0]
+
+
+def _extract_or_nomatch(template: Union[Template, TemplateSnapshot], text: str) -> Any:
+    """Returns template.extract(text), or the NoMatch it raised."""
+    try:
+        return template.extract(text)
+    except NoMatch as e:
+        return e
+
+
+# Formats tried, in order, when extract_columns() infers date and time columns,
+# with the type each is converted to.
+DATETIME_FORMATS = (
+    ("%Y-%m-%d", date),
+    ("%Y-%m-%d %H:%M:%S", datetime),
+    ("%Y-%m-%dT%H:%M:%S", datetime),
+    ("%Y-%m-%d %H:%M", datetime),
+    ("%Y-%m-%dT%H:%M", datetime),
+    ("%m/%d/%Y", date),
+    ("%d %B %Y", date),
+    ("%d %b %Y", date),
+    ("%B %d, %Y", date),
+    ("%b %d, %Y", date),
+    ("%H:%M:%S", time_of_day),
+    ("%H:%M", time_of_day),
+)
+
+# What extract_columns() takes for integers, floats and ISO dates. int(),
+# float() and date.fromisoformat() accept more (leading zeros, "_" separators,
+# non-ASCII digits, "nan", ...), so every value is checked against these first.
+_INT_RE = re.compile(r"\s*[+-]?(?:0|[1-9]\d*)\s*", re.ASCII)
+_FLOAT_RE = re.compile(
+    r"\s*[+-]?(?:(?:0|[1-9]\d*)(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?\s*", re.ASCII
+)
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}", re.ASCII)
+
+
+def _infer_column_type(sample: List[str]) -> Any:
+    """
+    Returns the type of a column judging by a sample of its values: "q" for
+    integers, "d" for floats, a (format, type) item of DATETIME_FORMATS, or
+    None for strings.
+    """
+    if not sample:
+        return None
+    if all(map(_INT_RE.fullmatch, sample)):
+        return "q"
+    if all(map(_FLOAT_RE.fullmatch, sample)):
+        return "d"
+    for fmt, kind in DATETIME_FORMATS:
+        try:
+            for value in sample:
+                datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return fmt, kind
+    return None
+
+
+def _convert_column(values: List[str], kind: Any) -> Any:
+    """
+    Converts a column of strings to the type returned by
+    _infer_column_type(), or to a more general one if some values don't
+    fit it.
+    """
+    if kind == "q":
+        if all(map(_INT_RE.fullmatch, values)):
+            try:
+                return array("q", map(int, values))
+            except OverflowError:
+                pass
+        kind = "d"
+    if kind == "d":
+        if all(map(_FLOAT_RE.fullmatch, values)):
+            return array("d", map(float, values))
+        return values
+    if kind is None:
+        return values
+    fmt, kind = kind
+    try:
+        if fmt == "%Y-%m-%d" and all(map(_ISO_DATE_RE.fullmatch, values)):
+            # Much faster than strptime(), for the most common format.
+            return list(map(date.fromisoformat, values))
+        parse = datetime.strptime
+        parsed = [parse(value, fmt) for value in values]
+    except ValueError:
+        return values
+    if kind is date:
+        return [value.date() for value in parsed]
+    if kind is time_of_day:
+        return [value.time() for value in parsed]
+    return parsed
+
+
+def _class_name(klass: type) -> str:
+    return f"{klass.__module__}.{klass.__qualname__}"
+
+
+def _find_template_class(name: str) -> Optional[type]:
+    """
+    Returns the Template subclass (or Template itself) with the given
+    _class_name(), if it has been defined.
+    """
+    classes = [Template]
+    while classes:
+        klass = classes.pop()
+        if _class_name(klass) == name:
+            return klass
+        classes.extend(klass.__subclasses__())
+    return None
+
+
+def _list_files(
+    dirname: str, pattern: Optional[str] = None, sort: bool = False
+) -> List[str]:
+    """
+    Returns the paths of the files in dirname, optionally only those whose
+    names match the glob pattern, and optionally sorted by name.
+    """
+    names = os.listdir(dirname)
+    if pattern is not None:
+        names = fnmatch.filter(names, pattern)
+    if sort:
+        names.sort()
+    paths = [os.path.join(dirname, name) for name in names]
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def iter_files(
+    dirname: str, pattern: Optional[str] = None, sort: bool = False
+) -> Iterator[str]:
+    """
+    Lazily yields the contents of the files in a directory, one at a time.
+
+    Args:
+        dirname: Path to the directory
+        pattern: Optional glob pattern that file names must match
+        sort: Whether to yield the files sorted by name
+
+    Returns:
+        An iterator over the file contents
+    """
+    for path in _list_files(dirname, pattern, sort):
+        with open(path, "r") as file:
+            yield file.read()
+
+
+def _iter_chunks(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Yields lists of up to size consecutive items."""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# The template used by extract_many() worker processes, set once per worker
+# by _init_worker().
+_worker_template: Optional[Template] = None
+
+
+def _init_worker(template: Template) -> None:
+    global _worker_template
+    _worker_template = template
+
+
+def _extract_chunk(texts: List[str]) -> List[Any]:
+    return [_extract_or_nomatch(_worker_template, text) for text in texts]
+
+
+def _extract_snapshot_chunk(snapshot: TemplateSnapshot, texts: List[str]) -> List[Any]:
+    """Extracts texts with snapshot for Template.aextract()."""
+    return [_extract_or_nomatch(snapshot, text) for text in texts]
+
+
+def _learn_files(paths: List[str]) -> Tuple[Optional[str], int]:
+    """
+    Learns the given files with a fresh copy of the worker's template and
+    returns its (brain, version).
+    """
+    t = type(_worker_template)(**_worker_template._options())
+    for path in paths:
+        with open(path, "r") as file:
+            t.learn(file.read())
+    return t._brain, t.version
+
+
+def _merge_partials(
+    pair: Tuple[Tuple[str, int], Tuple[str, int]],
+) -> Tuple[str, int]:
+    """Merges two (brain, version) results of _learn_files()."""
+    (brain_a, version_a), (brain_b, version_b) = pair
+    return _worker_template._merge(brain_a, brain_b), version_a + version_b
+
+
+_UNWANTED_TAGS_RE_REMOVED = (
+    "HTMLTemplate.clean() no longer uses unwanted_tags_re; set the "
+    "unwanted_tags class attribute to the names of the elements to remove"
+)
+
 
 class HTMLTemplate(Template):
     """
@@ -276,16 +2798,78 @@ class HTMLTemplate(Template):
     Focuses on identifying differences in the content rather than markup/script.
     """
 
-    def __init__(self, *args: Any, **kwargs: Any):
-        """Initialize a new HTML template."""
+    # Elements that are removed, contents and all, by clean().
+    unwanted_tags = ("script", "style", "noscript")
+
+    def __init_subclass__(cls, **kwargs: Any):
+        super().__init_subclass__(**kwargs)
+        if "unwanted_tags_re" in cls.__dict__:
+            raise TypeError(_UNWANTED_TAGS_RE_REMOVED)
+
+    def __init__(
+        self,
+        *args: Any,
+        collapse_whitespace: bool = False,
+        strip_comments: bool = False,
+        **kwargs: Any,
+    ):
+        """
+        Initialize a new HTML template.
+
+        Args:
+            collapse_whitespace: Have clean() replace each run of whitespace
+                with a single newline, if it contains one, or a single space
+            strip_comments: Have clean() remove <!-- comments -->
+            *args, **kwargs: See Template()
+        """
         super().__init__(*args, **kwargs)
-        self.unwanted_tags_re = re.compile(
-            r"(?si)<\s*?(script|style|noscript)\b.*?</\1>"
-        )
+        self._collapse_whitespace = collapse_whitespace
+        self._strip_comments = strip_comments
+        # What clean() removes; opening tags are group 1.
+        removed = [r"<\s*(%s)\b" % "|".join(map(re.escape, self.unwanted_tags))]
+        if strip_comments:
+            removed.append("<!--")
+        self._removed_re = re.compile("(?i)" + "|".join(removed))
+        self._close_res = {
+            tag.lower(): re.compile("(?i)</%s>" % re.escape(tag))
+            for tag in self.unwanted_tags
+        }
+
+    @property
+    def unwanted_tags_re(self) -> Any:
+        """
+        A regular expression matching the elements clean() removes.
+
+        clean() no longer uses it, so it's read-only; set unwanted_tags
+        instead.
+        """
+        tags = "|".join(map(re.escape, self.unwanted_tags))
+        return re.compile(r"(?si)<\s*?(%s)\b.*?</\1>" % tags)
+
+    @unwanted_tags_re.setter
+    def unwanted_tags_re(self, value: Any) -> None:
+        raise AttributeError(_UNWANTED_TAGS_RE_REMOVED)
+
+    def _clean_key(self) -> Any:
+        return (type(self), self._collapse_whitespace, self._strip_comments)
+
+    def _options(self) -> Dict[str, Any]:
+        options = super()._options()
+        options["collapse_whitespace"] = self._collapse_whitespace
+        options["strip_comments"] = self._strip_comments
+        return options
 
     def clean(self, text: str) -> str:
         """
-        Strips out <script>, <style> and <noscript> tags and everything within them.
+        Strips out <script>, <style> and <noscript> tags and everything within
+        them, and normalizes line endings. Optionally, also strips comments
+        and collapses whitespace.
+
+        Elements are found in a single scan over the text that never looks
+        for the same closing tag twice, so it takes linear time however the
+        tags are nested or left open; an element or comment that is never
+        closed is left alone. Line endings and whitespace are normalized
+        afterwards, in the already shortened text.
 
         Args:
             text: The HTML text to clean
@@ -293,25 +2877,749 @@ class HTMLTemplate(Template):
         Returns:
             Cleaned HTML text
         """
-        text = self.unwanted_tags_re.sub("", text)
-        return super().clean(text)
+        search = self._removed_re.search
+        close_res = self._close_res
+        pieces: List[str] = []
+        pos = scan = 0
+        # Tags (or "--" for comments) that aren't closed anywhere after scan.
+        unclosed = set()
+        while True:
+            m = search(text, scan)
+            if m is None:
+                break
+            start, end = m.span()
+            tag = m[1]
+            key = tag.lower() if tag else "--"
+            if key in unclosed:
+                end = -1
+            elif tag:
+                close = close_res[key].search(text, end)
+                end = close.end() if close else -1
+            else:
+                end = text.find("-->", end)
+                if end != -1:
+                    end += 3
+            if end == -1:
+                unclosed.add(key)
+                scan = start + 1
+                continue
+            pieces.append(text[pos:start])
+            pos = scan = end
+        if pieces:
+            pieces.append(text[pos:])
+            text = "".join(pieces)
+
+        if self._collapse_whitespace:
+            text = _NEWLINE_RUN_RE.sub("\n", text)
+            return _SPACE_RUN_RE.sub(" ", text)
+        if "\r\n" in text:
+            text = text.replace("\r\n", "\n")
+        return text
+
+
+class _AnchorIndex:
+    """
+    Finds which of a set of templates could match a document, by way of one
+    anchor per template: the substring of size characters of its literal
+    segments that the fewest other templates in the set also contain.
+
+    Templates for pages of the same site share most of their text (the
+    doctype, the navigation, the footer), so anchors are picked by how rare
+    they are across the set rather than by where they are in the template,
+    and are picked again for any template whose anchor a newly added
+    template shares. A document is then scanned once, looking up each of
+    its substrings of size characters in a dict of the anchors.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        # How many templates contain each substring of size characters.
+        self.counts: Dict[str, int] = {}
+        # name -> the template's substrings of size characters, and its anchor
+        self.grams: Dict[str, frozenset] = {}
+        self.anchor_of: Dict[str, str] = {}
+        # anchor -> names of the templates it was picked for
+        self.anchors: Dict[str, List[str]] = {}
+        # Templates without a literal segment of size characters are
+        # anchored by their longest one instead; name -> that segment.
+        self.short: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.grams) + len(self.short)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.grams
+        yield from self.short
+
+    def add(self, name: str, segments: List[str]) -> None:
+        size = self.size
+        grams = frozenset(
+            segment[i : i + size]
+            for segment in segments
+            for i in range(len(segment) - size + 1)
+        )
+        if not grams:
+            self.short[name] = max(segments, key=len)
+            return
+        stale = set()
+        for gram in grams:
+            self.counts[gram] = self.counts.get(gram, 0) + 1
+            stale.update(self.anchors.get(gram, ()))
+        self.grams[name] = grams
+        self._pick(name)
+        for other in stale:
+            self._drop_anchor(other)
+            self._pick(other)
+
+    def remove(self, name: str) -> None:
+        if self.short.pop(name, None) is not None:
+            return
+        for gram in self.grams.pop(name):
+            count = self.counts[gram] - 1
+            if count:
+                self.counts[gram] = count
+            else:
+                del self.counts[gram]
+        self._drop_anchor(name)
+
+    def _pick(self, name: str) -> None:
+        anchor = min(self.grams[name], key=self.counts.__getitem__)
+        self.anchor_of[name] = anchor
+        self.anchors.setdefault(anchor, []).append(name)
+
+    def _drop_anchor(self, name: str) -> None:
+        anchor = self.anchor_of.pop(name)
+        names = self.anchors[anchor]
+        names.remove(name)
+        if not names:
+            del self.anchors[anchor]
+
+    def candidates(self, text: str) -> List[str]:
+        """Returns the names of the templates whose anchor text contains."""
+        names = [name for name, segment in self.short.items() if segment in text]
+        anchors = self.anchors
+        if anchors:
+            size = self.size
+            found = set()
+            for i in range(len(text) - size + 1):
+                gram = text[i : i + size]
+                if gram in anchors and gram not in found:
+                    found.add(gram)
+                    names.extend(anchors[gram])
+        return names
+
+
+class TemplateRegistry:
+    """
+    Routes documents to the one of many templates that matches them.
+
+    Every literal segment of a template must occur in any document it
+    matches. The registry picks, for each template, the substring of its
+    segments that the fewest other registered templates share, and scans
+    each document once for those anchors, so even templates that share
+    almost all their text are told apart by the little that differs. The
+    few candidates found are then checked against the text they must
+    start and end with, and only the survivors are matched for real.
+
+    The registry indexes each template as it is when registered; register
+    it again after it learns something new.
+    """
+
+    def __init__(self, anchor_size: int = 8):
+        """
+        Initialize an empty registry.
 
+        Args:
+            anchor_size: Number of characters of each anchor. Longer anchors
+                are more selective, but a template needs a literal segment
+                at least this long for it to be anchored by a substring that
+                only it has.
+        """
+        self._anchor_size = anchor_size
+        # name -> (template, matcher, registration number)
+        self._entries: Dict[str, Tuple[Template, Matcher, int]] = {}
+        self._registered = 0
+        # clean key -> anchors of the templates with that clean key
+        self._index: Dict[Any, _AnchorIndex] = {}
 
-__version__ = "0.1.0"
+    def __len__(self) -> int:
+        return len(self._entries)
 
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
 
-if __name__ == "__main__":
-    # Simple usage example
-    print(f"Templatemaker v{__version__}")
+    def __getitem__(self, name: str) -> Template:
+        return self._entries[name][0]
 
-    # Create a template
-    t = Template()
-    t.learn("<b>this and that</b>")
-    t.learn("<b>alex and sue</b>")
+    def register(self, name: str, template: Template) -> None:
+        """
+        Adds a template to the registry, replacing any template already
+        registered under the same name.
 
-    # Display the template
-    print(f"Template: {t.as_text('!')}")
+        Raises:
+            ValueError: If the template has not learned anything yet
+        """
+        if template._brain is None:
+            raise ValueError("Can't register a template that hasn't learned anything")
+        if name in self._entries:
+            self.unregister(name)
+        matcher = template.compile()
+        self._entries[name] = (template, matcher, self._registered)
+        self._registered += 1
+        key = template._clean_key()
+        index = self._index.get(key)
+        if index is None:
+            index = self._index[key] = _AnchorIndex(self._anchor_size)
+        index.add(name, matcher.segments)
+
+    def unregister(self, name: str) -> None:
+        """
+        Removes the template registered under name.
 
-    # Extract data
-    data = t.extract("<b>larry and curly</b>")
-    print(f"Extracted: {data}")
+        Raises:
+            KeyError: If no template is registered under name
+        """
+        template, _, _ = self._entries.pop(name)
+        key = template._clean_key()
+        index = self._index[key]
+        index.remove(name)
+        if not index:
+            del self._index[key]
+
+    def _candidates(self, text: str) -> Iterator[Tuple[str, Matcher, str]]:
+        """
+        Yields (name, matcher, cleaned text) for each template that could
+        match text, in the order the templates were registered.
+        """
+        found = []
+        for index in self._index.values():
+            # Every template in index cleans text the same way.
+            cleaned = self._entries[next(iter(index))][0].clean(text)
+            for name in index.candidates(cleaned):
+                _, matcher, number = self._entries[name]
+                segments = matcher.segments
+                if not cleaned.startswith(segments[0]):
+                    continue
+                # "$" in templates also matches before a trailing newline.
+                suffix = segments[-1] if len(segments) > 1 else ""
+                if not (
+                    cleaned.endswith(suffix)
+                    or (cleaned.endswith("\n") and cleaned.endswith(suffix, 0, -1))
+                ):
+                    continue
+                found.append((number, name, matcher, cleaned))
+        found.sort()
+        for _, name, matcher, cleaned in found:
+            yield name, matcher, cleaned
+
+    def candidates(self, text: str) -> List[str]:
+        """
+        Returns the names of the templates that could match text, without
+        fully matching any of them.
+        """
+        return [name for name, _, _ in self._candidates(text)]
+
+    def match(self, text: str) -> Tuple[str, Tuple[str, ...]]:
+        """
+        Finds the template that matches text and extracts data with it.
+
+        If several templates match, the one registered first wins.
+
+        Returns:
+            A tuple of (template name, extracted values)
+
+        Raises:
+            NoMatch: If no registered template matches text
+        """
+        for name, matcher, cleaned in self._candidates(text):
+            try:
+                return name, matcher.match(cleaned)
+            except NoMatch:
+                pass
+        raise NoMatch
+
+
+# Number of length histogram buckets in HoleStats: one for empty values,
+# then one per power of two, the last one open-ended.
+_LENGTH_BUCKETS = 33
+
+
+class HoleStats:
+    """
+    Statistics about the values of each hole of a template, gathered in a
+    single streaming pass over any number of documents, in fixed memory.
+
+    For each hole it keeps:
+
+    - a HyperLogLog sketch of the distinct values, for an estimate of their
+      number that is accurate to about 1.04 / sqrt(2 ** precision);
+    - the top_k most frequent values and their counts (Space-Saving), which
+      are exact as long as the hole never had more than top_k distinct
+      values;
+    - a histogram of value lengths, by power of two.
+
+    Statistics gathered separately, e.g. by worker processes, can be
+    combined with merge().
+    """
+
+    def __init__(self, num_holes: int, precision: int = 12, top_k: int = 10):
+        """
+        Initialize empty statistics.
+
+        Args:
+            num_holes: Number of holes in the template
+            precision: log2 of the number of HyperLogLog registers per hole,
+                from 4 to 16
+            top_k: Number of most frequent values tracked per hole
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        if top_k < 1:
+            raise ValueError("top_k must be at least 1")
+        self.num_holes = num_holes
+        self.precision = precision
+        self.top_k = top_k
+        self.documents = 0
+        self.nomatch = 0
+        self._registers = [bytearray(1 << precision) for _ in range(num_holes)]
+        # Per hole: value -> [count, maximum overestimate of count]
+        self._counters: List[Dict[str, List[int]]] = [{} for _ in range(num_holes)]
+        # Per hole: whether the counters are exact, i.e. none was evicted.
+        self._exact = [True] * num_holes
+        self._lengths = [[0] * _LENGTH_BUCKETS for _ in range(num_holes)]
+
+    @classmethod
+    def collect(
+        cls,
+        template: Template,
+        texts: Iterable[str],
+        workers: Optional[int] = None,
+        chunksize: int = 256,
+        precision: int = 12,
+        top_k: int = 10,
+    ) -> "HoleStats":
+        """
+        Extracts data from each text with template and gathers statistics
+        about the values. Texts that don't match are only counted.
+
+        With workers, each worker process gathers statistics for the chunks
+        of texts it is sent, and those are merged; as in extract_many(), at
+        most two chunks per worker are in flight at a time.
+
+        Args:
+            template: The template to extract data with
+            texts: The texts to extract data from
+            workers: Number of worker processes; None or 1 gathers the
+                statistics in this process
+            chunksize: Number of texts sent to a worker at a time
+            precision: See HoleStats()
+            top_k: See HoleStats()
+
+        Returns:
+            A HoleStats instance
+        """
+        stats = cls(template.num_holes(), precision, top_k)
+        matcher = template.compile()
+        if workers is None or workers <= 1:
+            for text in texts:
+                stats._add_text(template, matcher, text)
+            return stats
+
+        chunks = _iter_chunks(texts, chunksize)
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(template,)
+        )
+        try:
+            pending: Any = set()
+            while True:
+                for chunk in islice(chunks, 2 * workers - len(pending)):
+                    pending.add(
+                        executor.submit(_hole_stats_chunk, chunk, precision, top_k)
+                    )
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stats.merge(future.result())
+        finally:
+            executor.shutdown(cancel_futures=True)
+        return stats
+
+    def _add_text(self, template: Template, matcher: Matcher, text: str) -> None:
+        try:
+            values = matcher.match(template.clean(text))
+        except NoMatch:
+            self.nomatch += 1
+        else:
+            self.add(values)
+
+    def add(self, values: Sequence[str]) -> None:
+        """
+        Adds the values extracted from one document.
+
+        Raises:
+            ValueError: If values has the wrong number of items
+        """
+        if len(values) != self.num_holes:
+            raise ValueError(f"Expected {self.num_holes} values, got {len(values)}")
+        self.documents += 1
+        precision = self.precision
+        shift = 64 - precision
+        mask = (1 << shift) - 1
+        top_k = self.top_k
+        for hole, value in enumerate(values):
+            digest = hashlib.blake2b(
+                value.encode("utf-8", "surrogatepass"), digest_size=8
+            ).digest()
+            hashed = int.from_bytes(digest, "big")
+            registers = self._registers[hole]
+            index = hashed >> shift
+            rank = shift - (hashed & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+            counters = self._counters[hole]
+            counter = counters.get(value)
+            if counter is not None:
+                counter[0] += 1
+            elif len(counters) < top_k:
+                counters[value] = [1, 0]
+            else:
+                # Replace the least frequent value, which may have been the
+                # new one all along.
+                evicted = min(counters, key=lambda v: counters[v][0])
+                count = counters.pop(evicted)[0]
+                counters[value] = [count + 1, count]
+                self._exact[hole] = False
+
+            self._lengths[hole][min(len(value).bit_length(), _LENGTH_BUCKETS - 1)] += 1
+
+    def merge(self, other: "HoleStats") -> "HoleStats":
+        """
+        Adds the statistics gathered by other, which must have been created
+        with the same number of holes, precision and top_k.
+
+        Returns:
+            This instance
+        """
+        if (other.num_holes, other.precision, other.top_k) != (
+            self.num_holes,
+            self.precision,
+            self.top_k,
+        ):
+            raise ValueError("Can't merge statistics with different settings")
+        self.documents += other.documents
+        self.nomatch += other.nomatch
+        for hole in range(self.num_holes):
+            self._registers[hole] = bytearray(
+                map(max, self._registers[hole], other._registers[hole])
+            )
+            lengths = self._lengths[hole]
+            for i, count in enumerate(other._lengths[hole]):
+                lengths[i] += count
+            self._merge_counters(hole, other._counters[hole], other._exact[hole])
+        return self
+
+    def _merge_counters(
+        self, hole: int, other: Dict[str, List[int]], other_exact: bool
+    ) -> None:
+        # A value missing from an inexact summary may still have occurred up
+        # to as many times as its least frequent tracked value.
+        mine = self._counters[hole]
+        floor = 0 if self._exact[hole] else min(c[0] for c in mine.values())
+        other_floor = 0 if other_exact else min(c[0] for c in other.values())
+        merged = {}
+        for value in mine.keys() | other.keys():
+            count, error = mine.get(value, (floor, floor))
+            other_count, other_error = other.get(value, (other_floor, other_floor))
+            merged[value] = [count + other_count, error + other_error]
+        exact = self._exact[hole] and other_exact and len(merged) <= self.top_k
+        if len(merged) > self.top_k:
+            keep = sorted(merged, key=lambda v: merged[v][0], reverse=True)
+            merged = {value: merged[value] for value in keep[: self.top_k]}
+        self._counters[hole] = merged
+        self._exact[hole] = exact
+
+    def cardinality(self, hole: int) -> int:
+        """
+        Returns the number of distinct values of a hole: exact if it had at
+        most top_k of them, a HyperLogLog estimate otherwise.
+        """
+        if self._exact[hole]:
+            return len(self._counters[hole])
+        registers = self._registers[hole]
+        m = len(registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m
+        estimate /= sum(2.0**-rank for rank in registers)
+        zeros = registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return max(round(estimate), len(self._counters[hole]))
+
+    def top(self, hole: int, n: Optional[int] = None) -> List[Tuple[str, int]]:
+        """
+        Returns the n (default: top_k) most frequent values of a hole, as
+        (value, count) pairs, most frequent first. The counts are exact if
+        the hole had at most top_k distinct values, and upper bounds
+        otherwise.
+        """
+        counters = self._counters[hole]
+        ranked = sorted(counters.items(), key=lambda item: (-item[1][0], item[0]))
+        return [(value, counter[0]) for value, counter in ranked[:n]]
+
+    def length_histogram(self, hole: int) -> List[int]:
+        """
+        Returns the number of values of a hole by length: item 0 counts
+        empty values and item i counts values of 2 ** (i - 1) to
+        2 ** i - 1 characters. The last item also counts anything longer.
+        """
+        return list(self._lengths[hole])
+
+    def pointless_holes(self) -> List[int]:
+        """Returns the holes that had the same value in every document."""
+        return [
+            hole
+            for hole in range(self.num_holes)
+            if self._exact[hole] and len(self._counters[hole]) == 1
+        ]
+
+    def option_holes(self, max_values: int = 5) -> List[int]:
+        """
+        Returns the holes that had between 2 and max_values distinct values,
+        which max_values must not exceed top_k.
+        """
+        if max_values > self.top_k:
+            raise ValueError("max_values can't be larger than top_k")
+        return [
+            hole
+            for hole in range(self.num_holes)
+            if self._exact[hole] and 2 <= len(self._counters[hole]) <= max_values
+        ]
+
+    def varying_holes(self, max_values: int = 5) -> List[int]:
+        """Returns the holes that are neither pointless nor option holes."""
+        special = set(self.pointless_holes()) | set(self.option_holes(max_values))
+        return [hole for hole in range(self.num_holes) if hole not in special]
+
+
+def _hole_stats_chunk(texts: List[str], precision: int, top_k: int) -> HoleStats:
+    """Returns the HoleStats of texts extracted with the worker's template."""
+    template = _worker_template
+    stats = HoleStats(template.num_holes(), precision, top_k)
+    matcher = template.compile()
+    for text in texts:
+        stats._add_text(template, matcher, text)
+    return stats
+
+
+def _source_paths(source: str, pattern: Optional[str] = None) -> List[str]:
+    """
+    Returns the files named by source, which is a directory (optionally
+    filtered by the glob pattern) or a glob, sorted by name.
+    """
+    if os.path.isdir(source):
+        return _list_files(source, pattern, sort=True)
+    return sorted(path for path in glob.glob(source) if os.path.isfile(path))
+
+
+def _iter_source(
+    source: str, pattern: Optional[str] = None
+) -> Iterator[Tuple[str, str]]:
+    """
+    Lazily yields (name, text) for each file in source: a directory, a glob
+    or a tar archive, optionally compressed. Archive members are read in one
+    streaming pass, and decoded as UTF-8.
+    """
+    if os.path.isfile(source) and tarfile.is_tarfile(source):
+        with tarfile.open(source, "r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if pattern is not None and not fnmatch.fnmatch(
+                    os.path.basename(member.name), pattern
+                ):
+                    continue
+                data = archive.extractfile(member).read()
+                yield member.name, data.decode("utf-8", "replace")
+        return
+    for path in _source_paths(source, pattern):
+        with open(path, "r") as file:
+            yield path, file.read()
+
+
+def _report(message: str) -> None:
+    print(f"templatemaker: {message}", file=sys.stderr)
+
+
+def _cli_learn(args: argparse.Namespace) -> int:
+    paths = _source_paths(args.samples, args.pattern)
+    if not paths:
+        _report(f"no samples found in {args.samples}")
+        return 1
+    cls = HTMLTemplate if args.html else Template
+    t = cls(
+        args.tolerance,
+        hierarchical=args.hierarchical,
+        fast_learn=args.fast_learn,
+        tokenizer=args.tokenizer,
+    )
+    start = time.perf_counter()
+    t._learn_paths(paths, args.workers, chunksize=args.chunksize)
+    elapsed = time.perf_counter() - start
+    extra = {}
+    if args.fields is not None:
+        extra["fields"] = args.fields.split(",")
+    t.save(args.output, **extra)
+    _report(
+        f"learned {len(paths)} samples in {elapsed:.2f}s "
+        f"({len(paths) / max(elapsed, 1e-9):.1f}/s); "
+        f"the template has {t.num_holes()} holes"
+    )
+    return 0
+
+
+def _cli_extract(args: argparse.Namespace) -> int:
+    t, extra = Template._load_with_extra(args.template)
+    fields = extra.get("fields")
+    if args.fields is not None:
+        fields = args.fields.split(",")
+    if fields is None:
+        fields = [f"hole{i}" for i in range(t.num_holes())]
+    if len(fields) != t.num_holes():
+        _report(f"{len(fields)} field names given for {t.num_holes()} holes")
+        return 1
+    # An empty field name leaves that hole out, like None in extract_dict().
+    field_names = tuple(name or None for name in fields)
+
+    # extract_many() reads the texts in order and, with at most two chunks
+    # per worker in flight, names holds the names of those chunks.
+    names: Dict[int, str] = {}
+
+    def texts() -> Iterator[str]:
+        for index, (name, text) in enumerate(_iter_source(args.source, args.pattern)):
+            names[index] = name
+            yield text
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    matched = failed = 0
+    start = time.perf_counter()
+    try:
+        results = t.extract_many(
+            texts(), args.workers, args.chunksize, ordered=not args.unordered
+        )
+        if not args.unordered:
+            results = enumerate(results)
+        for index, values in results:
+            name = names.pop(index)
+            if isinstance(values, NoMatch):
+                failed += 1
+                if args.verbose:
+                    _report(f"no match: {name}")
+                continue
+            matched += 1
+            row = {
+                key: value for key, value in zip(field_names, values) if key is not None
+            }
+            if args.source_field is not None:
+                row[args.source_field] = name
+            output.write(json.dumps(row, ensure_ascii=False) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    total = matched + failed
+    _report(
+        f"extracted {matched} of {total} documents ({failed} didn't match) in "
+        f"{elapsed:.2f}s ({total / max(elapsed, 1e-9):.1f}/s)"
+    )
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Runs the templatemaker command line tool, which has two subcommands:
+
+        templatemaker learn SAMPLES -o TEMPLATE
+        templatemaker extract TEMPLATE SOURCE [-o OUTPUT]
+
+    learn learns the files in a directory, or those matching a glob, and
+    saves the template. extract streams the files in a directory, a glob or
+    a tar archive through a pool of worker processes, and writes one JSON
+    object per line for each document that matches the template. Both
+    report their throughput on stderr.
+
+    Args:
+        argv: The command line arguments; defaults to sys.argv[1:]
+
+    Returns:
+        The exit status
+    """
+    parser = argparse.ArgumentParser(
+        prog="templatemaker",
+        description="Learn templates from sample documents and extract data.",
+    )
+    parser.add_argument("--version", action="version", version=__version__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    learn = commands.add_parser("learn", help="learn a template from samples")
+    learn.add_argument("samples", help="directory or glob of sample files")
+    learn.add_argument(
+        "-o", "--output", required=True, help="file to save the template to"
+    )
+    learn.add_argument("-t", "--tolerance", type=int, default=0)
+    learn.add_argument(
+        "--html", action="store_true", help="strip scripts, styles and comments"
+    )
+    learn.add_argument("--hierarchical", action="store_true")
+    learn.add_argument("--fast-learn", action="store_true")
+    learn.add_argument("--tokenizer", choices=sorted(TOKENIZERS))
+    learn.add_argument(
+        "--fields", help="comma-separated field names to save with the template"
+    )
+
+    extract = commands.add_parser("extract", help="extract data as JSON lines")
+    extract.add_argument("template", help="template file saved by learn")
+    extract.add_argument("source", help="directory, glob or tar archive")
+    extract.add_argument(
+        "-o", "--output", default="-", help="file to write to (default: stdout)"
+    )
+    extract.add_argument(
+        "--fields",
+        help="comma-separated field names, overriding those saved with the "
+        "template; leave a name empty to skip that hole",
+    )
+    extract.add_argument(
+        "--source-field", help="also write each document's name under this key"
+    )
+    extract.add_argument(
+        "--unordered",
+        action="store_true",
+        help="write rows as soon as they're ready instead of in input order",
+    )
+    extract.add_argument(
+        "-v", "--verbose", action="store_true", help="report unmatched documents"
+    )
+
+    for command, chunksize in ((learn, 16), (extract, 64)):
+        command.add_argument("--pattern", help="glob that file names must match")
+        command.add_argument(
+            "-j", "--workers", type=int, help="number of worker processes"
+        )
+        command.add_argument(
+            "--chunksize",
+            type=int,
+            default=chunksize,
+            help="documents sent to a worker at a time",
+        )
+
+    args = parser.parse_args(argv)
+    if args.command == "learn":
+        return _cli_learn(args)
+    return _cli_extract(args)
+
+
+__version__ = "0.1.0"
+
+
+if __name__ == "__main__":
+    sys.exit(main())
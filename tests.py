@@ -10,7 +10,45 @@ except ImportError:
 
     PYTEST_AVAILABLE = False
 
-from templatemaker import Template, NoMatch
+import asyncio
+import contextlib
+import datetime
+import gc
+import io
+import json
+import os
+import pickle
+import random
+import re
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+
+from templatemaker import (
+    AlignmentCache,
+    ExtractMetrics,
+    HTMLTemplate,
+    HoleStats,
+    LearnMetrics,
+    MARKER,
+    Matcher,
+    NoMatch,
+    TOKENIZERS,
+    Template,
+    TemplateRegistry,
+    html_tokenizer,
+    iter_files,
+    longest_common_substring,
+    main,
+    make_template,
+    make_template_hierarchical,
+)
 
 
 # Helper functions
@@ -34,6 +72,285 @@ def assert_created(tolerance, expected, *inputs):
     assert t.as_text("!") == expected
 
 
+def reference_lcs(a, b):
+    """
+    The original dynamic-programming longest_common_substring(), used to
+    check that faster implementations break ties the same way.
+    """
+    matrix = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    max_length = 0
+    a_end_pos = 0
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            if a[i - 1] == b[j - 1]:
+                matrix[i][j] = matrix[i - 1][j - 1] + 1
+                if matrix[i][j] > max_length:
+                    max_length = matrix[i][j]
+                    a_end_pos = i
+    if max_length == 0:
+        return 0, -1, -1
+    a_start_pos = a_end_pos - max_length
+    return max_length, a_start_pos, b.find(a[a_start_pos:a_end_pos])
+
+
+def assert_lcs_matches_reference(seed=0, count=500):
+    """
+    Asserts that longest_common_substring() agrees with reference_lcs() on
+    random strings over a small alphabet, where ties are common.
+    """
+    rng = random.Random(seed)
+    for _ in range(count):
+        a = "".join(rng.choice("abc\x1f") for _ in range(rng.randint(0, 12)))
+        b = "".join(rng.choice("abc") for _ in range(rng.randint(0, 12)))
+        assert longest_common_substring(a, b) == reference_lcs(a, b), (a, b)
+
+
+def lcs_peak_memory_per_char(size=20000):
+    """
+    Returns the peak number of bytes allocated per character of input by a
+    single longest_common_substring() call on two similar strings.
+    """
+    rng = random.Random(size)
+    a = "".join(rng.choice("abcdefgh<>/ ") for _ in range(size))
+    b = a[: size // 2] + "XYZ" + a[size // 2 + 3 :]
+    tracemalloc.start()
+    try:
+        longest_common_substring(a, b)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak / size
+
+
+def hierarchical_text(template_str, new_str, tolerance=0):
+    """
+    Returns make_template_hierarchical() with holes rendered as "!".
+    """
+    return make_template_hierarchical(template_str, new_str, tolerance).replace(
+        MARKER, "!"
+    )
+
+
+def fragmented_pair(size):
+    """
+    Returns two strings whose template has one hole per character, which
+    the old recursive make_template() needed `size` stack frames to build.
+    """
+    chars = [chr(0x100 + i) for i in range(size)]
+    return "".join(chars), "".join(c + "-" for c in chars)
+
+
+def make_fragmented_template(size=400, recursion_limit=100):
+    """
+    Runs make_template() on fragmented_pair(size) with a recursion limit far
+    below `size`, returning the template.
+    """
+    a, b = fragmented_pair(size)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(recursion_limit)
+    try:
+        return make_template(a, b)
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def assert_engines_agree(seed=0, count=2000):
+    """
+    Asserts that the "regex" and "find" Matcher engines give the same result
+    for random brains and texts, including trailing newlines.
+    """
+    rng = random.Random(seed)
+    for _ in range(count):
+        brain = "".join(rng.choice("ab\n" + MARKER) for _ in range(rng.randint(0, 8)))
+        text = "".join(rng.choice("ab\n") for _ in range(rng.randint(0, 10)))
+        results = []
+        for engine in Matcher.ENGINES:
+            try:
+                results.append(Matcher(brain, engine).match(text))
+            except NoMatch:
+                results.append(NoMatch)
+        assert results[0] == results[1], (brain, text, results)
+
+
+def write_samples(dirname, samples, suffix=".html"):
+    """
+    Writes each sample to its own file in dirname, named so that sorting by
+    name keeps the samples in order.
+    """
+    for i, sample in enumerate(samples):
+        with open(os.path.join(dirname, "%04d%s" % (i, suffix)), "w") as f:
+            f.write(sample)
+
+
+ITEM_SAMPLES = ["<h1>Item %d</h1><p>price: %d</p>" % (i, i * 7) for i in range(20)]
+
+
+def numbered_samples():
+    """
+    An endless generator of Sample Strings with two changing values.
+    """
+    i = 0
+    while True:
+        i += 1
+        yield "<b>%d and %d</b>" % (i, i * 3)
+
+
+def site_registry(count=50):
+    """
+    Returns a TemplateRegistry of count per-site templates named "site<i>",
+    plus an HTMLTemplate named "html".
+    """
+    registry = TemplateRegistry()
+    for i in range(count):
+        registry.register(
+            "site%d" % i,
+            create_template(
+                0,
+                "<html id=%d><b>this and that</b></html>" % i,
+                "<html id=%d><b>alex and sue</b></html>" % i,
+            ),
+        )
+    t = HTMLTemplate()
+    t.learn("<p>x</p><script>1</script>")
+    t.learn("<p>y</p>")
+    registry.register("html", t)
+    return registry
+
+
+BOILERPLATE_HEAD = (
+    "<!DOCTYPE html>\n<html lang=en><head><title>Shop</title></head><body>\n"
+    "<nav>Home | Products | About us | Contact | Cart</nav>\n"
+)
+BOILERPLATE_FOOT = (
+    "<footer>Copyright 2024 Example Shop. Terms | Privacy</footer>\n</body></html>\n"
+)
+
+
+def boilerplate_page(site, value):
+    return (
+        BOILERPLATE_HEAD
+        + "<div class=s%d><b>%s</b></div>" % (site, value)
+        + BOILERPLATE_FOOT
+    )
+
+
+def boilerplate_registry(count=200):
+    """
+    Returns a TemplateRegistry of count templates named "s<i>" that share
+    all their text but a short class name.
+    """
+    registry = TemplateRegistry()
+    for i in range(count):
+        registry.register(
+            "s%d" % i,
+            create_template(0, boilerplate_page(i, "a"), boilerplate_page(i, "b")),
+        )
+    return registry
+
+
+def hole_stats_samples(count=300):
+    return [
+        "<b>%d</b><i>%s</i><u>%s</u>" % (i, "xyz"[i % 3], "same") for i in range(count)
+    ] + ["no match"]
+
+
+COLUMN_SAMPLES = [
+    "<td>%d</td><td>%s</td><td>2024-03-%02d</td><td>0%d</td><td>%s</td>"
+    % (i, i / 4, i + 1, i, "abc"[i % 3])
+    for i in range(5)
+]
+
+
+def run_main(*argv):
+    """
+    Runs the command line tool with the given arguments and returns its exit
+    status and what it wrote to stderr.
+    """
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        status = main(list(argv))
+    return status, stderr.getvalue()
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+async def arange_samples(n, delay=0):
+    """
+    An asynchronous generator of n Sample Strings, every seventh of which
+    doesn't match "<b>! and !</b>".
+    """
+    for i in range(n):
+        if delay:
+            await asyncio.sleep(delay)
+        yield (
+            "<b>%d and <script>x</script>%d</b>" % (i, i) if i % 7 else "<i>%d</i>" % i
+        )
+
+
+async def collect(aiterable):
+    return [item async for item in aiterable]
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    """
+    A thread pool that records the size of each chunk aextract() sends it and
+    the most chunks it holds at a time, and spends delay seconds on each.
+    """
+
+    def __init__(self, delay=0):
+        super().__init__(4)
+        self.delay = delay
+        self.sizes = []
+        self.in_flight = self.most_in_flight = 0
+        self._counter_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._counter_lock:
+            self.sizes.append(len(args[-1]))
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        future = super().submit(self._run, fn, *args, **kwargs)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _run(self, fn, *args, **kwargs):
+        time.sleep(self.delay)
+        return fn(*args, **kwargs)
+
+    def _finished(self, future):
+        with self._counter_lock:
+            self.in_flight -= 1
+
+
+async def read_ahead(template, n, **kwargs):
+    """
+    Extracts n Sample Strings with aextract() and returns the most texts read
+    from the source that the consumer hadn't received yet.
+    """
+    produced = 0
+
+    async def source():
+        nonlocal produced
+        async for text in arange_samples(n):
+            produced += 1
+            yield text
+
+    consumed = ahead = 0
+    async for _ in template.aextract(source(), **kwargs):
+        consumed += 1
+        ahead = max(ahead, produced - consumed)
+    return ahead
+
+
+def live_futures():
+    """Returns the number of concurrent.futures.Future objects still alive."""
+    gc.collect()
+    return sum(isinstance(o, Future) for o in gc.get_objects())
+
+
 if PYTEST_AVAILABLE:
     # Test functions for template creation using pytest
     def test_noop():
@@ -102,6 +419,18 @@ if PYTEST_AVAILABLE:
             0, "<title>!</title>", "<title>\x1f1234</title>", "<title>5678\x1f</title>"
         )
 
+    def test_lcs_tie_breaking():
+        assert longest_common_substring("ab", "ba") == (1, 0, 1)
+        assert longest_common_substring("abcxabcd", "zabcd") == (4, 4, 1)
+        assert longest_common_substring("abc", "") == (0, -1, -1)
+        assert longest_common_substring("abc", "xyz") == (0, -1, -1)
+        assert_lcs_matches_reference()
+
+    def test_lcs_memory_ceiling():
+        # The DP matrix needed len(a) * len(b) cells; the automaton needs
+        # memory proportional to len(b) only.
+        assert lcs_peak_memory_per_char() < 1024
+
     # Tests for creation with tolerance using pytest
     def test_tolerance():
         assert_created(
@@ -168,6 +497,718 @@ if PYTEST_AVAILABLE:
         with pytest.raises(NoMatch):
             t.extract("this and that")
 
+    # Tests for hierarchical alignment using pytest
+    def test_hierarchical_template():
+        t = Template(hierarchical=True)
+        t.learn("<h1>Title</h1>\n<p>this and that</p>\n<footer>x</footer>\n")
+        t.learn("<h1>Title</h1>\n<p>alex and sue</p>\n<footer>x</footer>\n")
+        assert t.as_text("!") == "<h1>Title</h1>\n<p>! and !</p>\n<footer>x</footer>\n"
+        assert t.extract("<h1>Title</h1>\n<p>a and b</p>\n<footer>x</footer>\n") == (
+            "a",
+            "b",
+        )
+
+    def test_hierarchical_edges():
+        assert hierarchical_text("", "") == ""
+        assert hierarchical_text("a\nb\n", "") == "!"
+        assert hierarchical_text("a\nb\nc\n", "a\nX\nc\n") == "a\n!\nc\n"
+        assert hierarchical_text("a\nb\nc\n", "b\nc\nd") == "!b\nc\n!"
+
+    def test_deeply_fragmented():
+        a, _ = fragmented_pair(400)
+        assert make_fragmented_template(400) == "".join(c + MARKER for c in a)
+        assert make_template("a\x1fc", "axbyc") == "a\x1fc"
+
+    # Tests for compiled matchers using pytest
+    def test_matcher_cached_per_version():
+        t = Template()
+        t.learn("<b>this and that</b>")
+        first = t.compile()
+        assert t.compile() is first
+        t.learn("<b>alex and sue</b>")
+        assert t.compile() is not first
+        assert t.extract("<b>larry and curly</b>") == ("larry", "curly")
+
+    def test_find_engine():
+        t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+        t2 = Template(engine="find", brain=t._brain)
+        assert t2.extract("<b>larry and curly</b>") == ("larry", "curly")
+        assert t2.extract("<b>larry and curly</b>\n") == ("larry", "curly")
+        with pytest.raises(NoMatch):
+            t2.extract("<b>larry or curly</b>")
+        with pytest.raises(ValueError):
+            Template(engine="glob")
+        assert_engines_agree()
+
+    # Tests for batch extraction using pytest
+    def test_extract_many():
+        t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+        texts = ["<b>larry and curly</b>", "nope", "<b>red and green</b>"]
+        results = list(t.extract_many(texts))
+        assert results[0] == ("larry", "curly")
+        assert isinstance(results[1], NoMatch)
+        assert results[2] == ("red", "green")
+        assert list(t.extract_many(iter(texts), workers=2, chunksize=1))[::2] == [
+            ("larry", "curly"),
+            ("red", "green"),
+        ]
+
+    def test_extract_many_unordered_html():
+        t = HTMLTemplate()
+        t.learn("<b>this and that</b><script>1</script>")
+        t.learn("<b>alex and sue</b>")
+        texts = ("<b>%d and <script>x</script>%d</b>" % (i, i) for i in range(50))
+        results = sorted(t.extract_many(texts, workers=2, chunksize=4, ordered=False))
+        assert results == [(i, (str(i), str(i))) for i in range(50)]
+
+    # Tests for learning from a directory using pytest
+    def test_from_directory(tmp_path, capsys):
+        write_samples(str(tmp_path), ITEM_SAMPLES)
+        write_samples(str(tmp_path), ["ignored"], suffix=".txt")
+        t = Template.from_directory(
+            str(tmp_path), pattern="*.html", sort=True, verbose=False
+        )
+        assert t.as_text("!") == "<h1>Item !</h1><p>price: !</p>"
+        assert t.version == 20
+        assert capsys.readouterr().out == ""
+
+    def test_from_directory_parallel(tmp_path):
+        write_samples(str(tmp_path), ITEM_SAMPLES)
+        for ordered in (True, False):
+            t = HTMLTemplate.from_directory(
+                str(tmp_path), workers=2, chunksize=3, ordered=ordered
+            )
+            assert isinstance(t, HTMLTemplate)
+            assert t.as_text("!") == "<h1>Item !</h1><p>price: !</p>"
+            assert t.version == 20
+
+    # Tests for the learn() fast paths using pytest
+    def test_learn_seen_fast_path():
+        t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+        assert t.learn("<b>fine and dandy</b>") is False
+        assert t.learn("<b>fine and dandy</b>") is False
+        assert t.fast_path_counts == {"seen": 1, "matched": 0}
+        assert t.version == 4
+        # A change to the template forgets what has been seen.
+        assert t.learn("<b>fine or dandy</b>") is True
+        assert t.learn("<b>fine and dandy</b>") is False
+        assert t.fast_path_counts["seen"] == 1
+
+    def test_learn_match_fast_path():
+        t = Template(fast_learn=True)
+        t.learn("x and y")
+        t.learn("x and z")
+        assert t.as_text("!") == "x and !"
+        assert t.learn("x and yzzzy") is False
+        assert t.as_text("!") == "x and !"
+        assert t.fast_path_counts == {"seen": 0, "matched": 1}
+        assert t.version == 3
+
+    # Tests for streaming training using pytest
+    def test_train_converges():
+        t, stats = Template.train(numbered_samples(), patience=5)
+        assert t.as_text("!") == "<b>! and !</b>"
+        assert stats.converged
+        assert (stats.samples, stats.unchanged_run, stats.num_holes) == (7, 5, 2)
+
+    def test_train_budgets():
+        _, stats = Template.train(numbered_samples(), patience=100, max_samples=20)
+        assert (stats.stop_reason, stats.samples) == ("max_samples", 20)
+        _, stats = Template.train(["a", "b"], patience=5)
+        assert (stats.stop_reason, stats.samples) == ("exhausted", 2)
+        _, stats = Template.train(numbered_samples(), patience=10**9, max_seconds=0)
+        assert (stats.stop_reason, stats.samples) == ("max_seconds", 1)
+
+    def test_iter_files(tmp_path):
+        write_samples(str(tmp_path), ITEM_SAMPLES)
+        files = iter_files(str(tmp_path), pattern="*.html", sort=True)
+        t, stats = Template.train(files, patience=3)
+        assert t.as_text("!") == "<h1>Item !</h1><p>price: !</p>"
+        assert stats.samples == 5
+        assert len(list(files)) == 15
+
+    # Tests for saving and loading using pytest
+    def test_save_load(tmp_path):
+        t = HTMLTemplate(tolerance=1, engine="find")
+        t.learn("<b>this and that</b>")
+        t.learn("<b>alex and sue</b>")
+        path = str(tmp_path / "t.tmpl")
+        t.save(path)
+        loaded = Template.load(path)
+        assert type(loaded) is HTMLTemplate
+        assert (loaded.version, loaded._tolerance) == (2, 1)
+        assert loaded.as_text("!") == "<b>! and !</b>"
+        assert loaded.extract("<b>x and <style></style>y</b>") == ("x", "y")
+        assert Template.loads(Template().dumps()).as_text() == ""
+        with pytest.raises(ValueError):
+            HTMLTemplate.loads(Template().dumps())
+        with pytest.raises(ValueError):
+            Template.loads(b"<b>! and !</b>")
+
+    def test_train_checkpoint(tmp_path):
+        path = str(tmp_path / "checkpoint.tmpl")
+        samples = ["<b>%d and %d</b>" % (i, i % 3) for i in range(10)]
+        _, stats = Template.train(samples, max_samples=4, checkpoint=path)
+        assert stats.samples == 4
+        t, stats = Template.train(samples, checkpoint=path, checkpoint_every=2)
+        assert (stats.samples, t.version) == (6, 10)
+        assert t.as_text("!") == Template.train(samples)[0].as_text("!")
+        assert Template.load(path).version == 10
+
+    # Tests for the template registry using pytest
+    def test_registry_match():
+        registry = site_registry()
+        assert len(registry) == 51
+        text = "<html id=7><b>a and b</b></html>"
+        assert registry.candidates(text) == ["site7"]
+        assert registry.match(text) == ("site7", ("a", "b"))
+        assert registry.match(text + "\n") == ("site7", ("a", "b"))
+        assert registry.match("<p>z<script>2</script></p>") == ("html", ("z",))
+        with pytest.raises(NoMatch):
+            registry.match("<html id=7><i>a and b</i></html>")
+
+    def test_registry_unregister():
+        registry = site_registry()
+        registry.unregister("site7")
+        assert "site7" not in registry
+        with pytest.raises(NoMatch):
+            registry.match("<html id=7><b>a and b</b></html>")
+        with pytest.raises(ValueError):
+            registry.register("empty", Template())
+
+    def test_registry_shared_boilerplate():
+        registry = boilerplate_registry()
+        assert registry.candidates(boilerplate_page(123, "x")) == ["s123"]
+        assert registry.match(boilerplate_page(7, "x")) == ("s7", ("x",))
+        # The anchors are picked again when a template shares them.
+        registry.register(
+            "copy",
+            create_template(0, boilerplate_page(7, "a"), boilerplate_page(7, "b")),
+        )
+        assert registry.candidates(boilerplate_page(7, "x")) == ["s7", "copy"]
+        registry.unregister("s7")
+        assert registry.match(boilerplate_page(7, "x")) == ("copy", ("x",))
+        registry.register("short", create_template(0, "<p>a</p>", "<p>b</p>"))
+        assert registry.candidates("<p>x</p>") == ["short"]
+
+    # Tests for tokenized alignment using pytest
+    def test_tokenizers():
+        text = '<p class="x">Hello, world</p>'
+        for tokenizer in TOKENIZERS.values():
+            assert "".join(tokenizer(text)) == text
+        assert html_tokenizer(text) == [
+            '<p class="x">',
+            "Hello",
+            ",",
+            " ",
+            "world",
+            "</p>",
+        ]
+
+    def test_tokenized_template():
+        assert make_template("12345", "12_45", tokenizer="word") == MARKER
+        assert (
+            make_template(
+                "<b>this and that</b>", "<b>alex and sue</b>", tokenizer="word"
+            )
+            == "<b>\x1f and \x1f</b>"
+        )
+        t = Template(tokenizer="html")
+        t.learn("<p class=a>Price: 10 USD</p>")
+        t.learn("<p class=b>Price: 1234 USD</p>")
+        assert t.as_text("!") == "!Price: ! USD</p>"
+        assert t.extract("<p>Price: 5 USD</p>") == ("<p>", "5")
+        assert Template.loads(t.dumps()).as_text("!") == "!Price: ! USD</p>"
+        with pytest.raises(ValueError):
+            Template(tokenizer="sentence")
+        with pytest.raises(ValueError):
+            Template(tokenizer=str.split).dumps()
+
+    # Tests for incremental hole tracking using pytest
+    def test_last_change():
+        t = Template()
+        t.learn("<b>this and that</b><br>")
+        assert t.last_change == {}
+        assert t.learn("<b>alex and sue</b><br>") is True
+        assert t.last_change == {0: "this", 1: "that"}
+        assert t.remap_values(()) == ("this", "that")
+        assert t.learn("<b>michael and scottie</b>") is True
+        assert t.as_text("!") == "<b>! and !</b>!"
+        assert t.last_change == {2: "<br>"}
+        assert t.remap_values(("alex", "sue")) == ("alex", "sue", "<br>")
+        assert t.learn("<b>fine and dandy</b>") is False
+        assert (t.last_change, t.last_remap) == ({}, None)
+
+    def test_remap_values():
+        for kwargs in ({}, {"hierarchical": True}, {"tokenizer": "word"}):
+            t = Template(**kwargs)
+            docs = ["<b>x and y</b><br>", "<b>p and q</b><br>", "<b>foo & bar</b>"]
+            t.learn(docs[0])
+            records = []
+            for doc in docs[1:]:
+                t.learn(doc)
+                records = [t.remap_values(record) for record in records]
+                records.append(t.extract(doc))
+            assert records == [t.extract(doc) for doc in docs[1:]]
+            with pytest.raises(ValueError):
+                t.remap_values(("too", "many", "values", "here", "!"))
+
+    def test_remap_values_matches_extract():
+        # The old template ends in a newline that extract() leaves out of
+        # the last value; the new one ends in a hole.
+        t = create_template(0, "<p>a</p>x\n", "<p>b</p>y\n")
+        record = t.extract("<p>a</p>x\n")
+        t.learn("<p>c</p>")
+        assert t.remap_values(record) == t.extract("<p>a</p>x\n") == ("a", "x")
+        # The document splits into the new holes in more than one way.
+        t = create_template(0, "</b><b>a ", "<b>ab<b>")
+        record = t.extract("</b><b>a ")
+        t.learn(" b ")
+        assert t.as_text("!") == "!b!"
+        assert t.remap_values(record) == t.extract("</b><b>a ") == ("</", "><b>a ")
+
+    # Tests for hole statistics using pytest
+    def test_hole_stats():
+        t = Template(brain="<b>\x1f</b><i>\x1f</i><u>\x1f</u>")
+        stats = HoleStats.collect(t, hole_stats_samples(), top_k=5)
+        assert (stats.documents, stats.nomatch) == (300, 1)
+        assert stats.pointless_holes() == [2]
+        assert stats.option_holes() == [1]
+        assert stats.varying_holes() == [0]
+        assert stats.top(1) == [("x", 100), ("y", 100), ("z", 100)]
+        assert stats.cardinality(1) == 3
+        assert abs(stats.cardinality(0) - 300) < 30
+        assert stats.length_histogram(0)[:4] == [0, 10, 290, 0]
+        with pytest.raises(ValueError):
+            stats.add(("too", "few"))
+
+    def test_hole_stats_merge():
+        t = Template(brain="<b>\x1f</b><i>\x1f</i><u>\x1f</u>")
+        samples = hole_stats_samples()
+        whole = HoleStats.collect(t, samples, top_k=5)
+        merged = HoleStats.collect(t, samples[:100], top_k=5)
+        merged.merge(HoleStats.collect(t, samples[100:], top_k=5))
+        parallel = HoleStats.collect(t, samples, workers=2, chunksize=50, top_k=5)
+        for stats in (merged, parallel):
+            assert (stats.documents, stats.nomatch) == (300, 1)
+            for hole in range(3):
+                assert stats.cardinality(hole) == whole.cardinality(hole)
+                assert stats.length_histogram(hole) == whole.length_histogram(hole)
+            assert stats.top(1) == whole.top(1)
+            assert stats.option_holes() == [1]
+
+    # Tests for columnar extraction using pytest
+    def test_extract_columns():
+        t = Template(brain="<td>\x1f</td>" * 5)
+        ids, prices, dates, codes, letters = t.extract_columns(COLUMN_SAMPLES)
+        assert (ids.typecode, list(ids)) == ("q", [0, 1, 2, 3, 4])
+        assert (prices.typecode, list(prices)) == ("d", [0, 0.25, 0.5, 0.75, 1])
+        assert dates[1] == datetime.date(2024, 3, 2)
+        assert codes == ["00", "01", "02", "03", "04"]
+        assert letters == ["a", "b", "c", "a", "b"]
+
+    def test_extract_columns_errors():
+        t = Template(brain="<td>\x1f</td>" * 5)
+        samples = COLUMN_SAMPLES + ["<td>x</td>" * 5, "no match"]
+        with pytest.raises(NoMatch):
+            t.extract_columns(samples)
+        columns = t.extract_columns(samples, errors="skip", sample_size=5)
+        # Values past the sample that don't fit fall back to strings.
+        assert columns[0] == ["0", "1", "2", "3", "4", "x"]
+        assert t.extract_columns([]) == [[]] * 5
+
+    def test_extract_columns_strict_numbers():
+        t = Template(brain="<td>\x1f</td>")
+        for odd in ("0123", "1_000", "\u0663", "nan", "inf", "1_0.5"):
+            texts = ["<td>%s</td>" % value for value in ("1", "2", "3", "4", odd)]
+            assert t.extract_columns(texts, sample_size=4) == [
+                ["1", "2", "3", "4", odd]
+            ]
+        texts = ["<td>%s</td>" % value for value in ("1", "2", "3", "4", "2.5")]
+        (column,) = t.extract_columns(texts, sample_size=4)
+        assert (column.typecode, list(column)) == ("d", [1, 2, 3, 4, 2.5])
+        texts = ["<td>2024-01-0%d</td>" % i for i in range(1, 5)] + [
+            "<td>20240105</td>"
+        ]
+        assert t.extract_columns(texts, sample_size=4)[0][4] == "20240105"
+
+    # Tests for span extraction using pytest
+    def test_extract_spans():
+        t = create_template(
+            0, "<b>this and that</b>\n<i>x</i>", "<b>alex and sue</b>\n<i>x</i>"
+        )
+        text = "<b>larry and curly</b>\r\n<i>x</i>\r\n"
+        spans = t.extract_spans(text)
+        assert [text[start:end] for start, end in spans] == ["larry", "curly"]
+        data = text.replace("larry", "lärry").encode("utf-8")
+        for view in (data, memoryview(data)):
+            spans = t.extract_spans(view)
+            assert [bytes(view[start:end]) for start, end in spans] == [
+                "lärry".encode("utf-8"),
+                b"curly",
+            ]
+        with pytest.raises(NoMatch):
+            t.extract_spans(b"<b>larry or curly</b>")
+        with pytest.raises(TypeError):
+            HTMLTemplate().extract_spans("")
+
+    # Tests for record-stream extraction using pytest
+    def test_finditer():
+        t = create_template(0, "<li>a: 1</li>", "<li>bb: 22</li>")
+        text = "<ul><li>x: 5</li>\n<li>long name: 10</li><li>oops</li><li>y: 7</li>"
+        expected = [("x", "5"), ("long name", "10"), ("oops</li><li>y", "7")]
+        for chunk_size in (1, 4, 1000):
+            records = t.finditer(io.StringIO(text), chunk_size=chunk_size)
+            assert list(records) == expected
+        assert list(t.finditer(text.encode("utf-8")))[0] == (b"x", b"5")
+        assert list(t.finditer("<li>x: 5</li><li>y: 7")) == [("x", "5")]
+
+    def test_finditer_max_record_size():
+        t = create_template(0, "<li>a: 1</li>", "<li>bb: 22</li>")
+        text = "<li>broken <li>x: 5</li>"
+        records = t.finditer(io.StringIO(text), chunk_size=2, max_record_size=16)
+        assert list(records) == [("x", "5")]
+        with pytest.raises(ValueError):
+            list(create_template(0, "a1", "b1").finditer("a1"))
+
+    def test_finditer_incomplete_record():
+        t = create_template(0, "<r>a</r>", "<r>b</r>")
+        # Every "<r>" starts a record that can't be completed, in linear time.
+        text = "<r>abcdefgh" * 100000
+        for chunk_size in (100, 65536):
+            assert list(t.finditer(io.StringIO(text), chunk_size=chunk_size)) == []
+        assert list(t.finditer(text + "</r>")) == [(text[3:],)]
+
+    # Tests for HTML cleaning using pytest
+    def test_html_clean():
+        t = HTMLTemplate()
+        text = "<p>a\r\n<SCRIPT type=x>1</script>\r<style>\n</STYLE>\nb<!-- c --></p>"
+        assert t.clean(text) == "<p>a\n\nb<!-- c --></p>"
+        # Elements that are never closed are left alone, in linear time.
+        assert t.clean("<script>" * 20000 + "x") == "<script>" * 20000 + "x"
+        t = HTMLTemplate(collapse_whitespace=True, strip_comments=True)
+        assert t.clean(text) == "<p>a\nb</p>"
+        assert t.clean("a \t<!-- x -->  b <!-- y") == "a b <!-- y"
+
+    def test_html_clean_options():
+        t = HTMLTemplate(collapse_whitespace=True, strip_comments=True)
+        t.learn("<b>this  and   that</b><!-- 1 -->")
+        t.learn("<b>alex and sue</b>")
+        loaded = Template.loads(t.dumps())
+        assert loaded.clean("<!---->x  y") == "x y"
+        assert loaded.extract("<b>x\t and y</b><!-- z -->") == ("x", "y")
+        registry = TemplateRegistry()
+        registry.register("plain", create_template(0, "<b>a or b</b>", "<b>c or d</b>"))
+        registry.register("html", t)
+        assert registry.match("<b>p  and q</b><!-- z -->") == ("html", ("p", "q"))
+
+    # Tests for template snapshots using pytest
+    def test_snapshot():
+        t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+        snapshot = t.snapshot()
+        assert t.snapshot() is snapshot
+        assert (snapshot.version, snapshot.as_text("!")) == (2, "<b>! and !</b>")
+        with pytest.raises(AttributeError):
+            snapshot.brain = ""
+        t.learn("<b>fine and dandy</b><br>")
+        # The old snapshot is unchanged, and learn() published a new one.
+        assert snapshot.extract("<b>x and y</b>") == ("x", "y")
+        assert t.snapshot().extract("<b>x and y</b>!") == ("x", "y", "!")
+        assert t.snapshot().version == 3
+        assert pickle.loads(pickle.dumps(t.snapshot())).num_holes() == 3
+        with pytest.raises(NoMatch):
+            Template().snapshot()
+
+    def test_snapshot_threads():
+        t = create_template(0, "<li>0: 0</li>", "<li>1: 1</li>")
+        snapshots = []
+
+        def read():
+            while len(snapshots) < 200:
+                snapshots.append(t.snapshot())
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        for i in range(200):
+            t.learn("<li>%d %s %d</li>" % (i, "ab"[i % 2], i))
+        reader.join()
+        for snapshot in snapshots:
+            assert snapshot.matcher.brain is snapshot.brain
+        assert t.snapshot().as_text("!") == t.as_text("!")
+        results = list(t.extract_many(["<li>x a y</li>"] * 4, workers=2))
+        assert results == [t.extract("<li>x a y</li>")] * 4
+
+    # Tests for batch learning using pytest
+    def test_learn_batch():
+        docs = ["<b>this and that</b>", "<b>alex and sue</b>", "<b>fine and dandy</b>"]
+        t = Template()
+        assert t.learn_batch(docs) is None
+        assert (t.as_text("!"), t.version) == ("<b>! and !</b>", 3)
+        for order in (docs[::-1], docs[1:] + docs[:1]):
+            t = Template()
+            t.learn_batch(order)
+            assert t.as_text("!") == "<b>! and !</b>"
+        assert t.learn_batch(["<b>x and y</b>"]) is False
+        assert t.learn_batch(["<b>x and y</b><br>", "<b>p and q</b>"]) is True
+        assert t.as_text("!") == "<b>! and !</b>!"
+        assert t.last_change == {2: ""}
+        assert t.remap_values(("alex", "sue")) == ("alex", "sue", "")
+
+    def test_learn_batch_matches_all():
+        rng = random.Random(7)
+        for tolerance in (0, 1):
+            docs = ["".join(rng.choice("ab c") for _ in range(12)) for _ in range(5)]
+            t = Template(tolerance)
+            t.learn_batch(docs)
+            for doc in docs:
+                t.extract(doc)
+            shuffled = Template(tolerance)
+            shuffled.learn_batch(sorted(docs, reverse=True))
+            assert shuffled.as_text("!") == t.as_text("!")
+
+    # Tests for the brain index using pytest
+    def test_keep_index():
+        rng = random.Random(3)
+        for tolerance in (0, 2):
+            indexed = Template(tolerance, keep_index=True)
+            plain = Template(tolerance)
+            for _ in range(30):
+                doc = "".join(rng.choice("ab cd") for _ in range(30))
+                assert indexed.learn(doc) == plain.learn(doc)
+                assert indexed.as_text("!") == plain.as_text("!")
+                assert indexed.last_change == plain.last_change
+        assert Template.loads(indexed.dumps())._keep_index is True
+
+    # Tests for the alignment cache using pytest
+    def test_alignment_cache():
+        rng = random.Random(5)
+        parts = ["<nav>home | about</nav>\n", "<footer>(c) 2024</footer>\n", "x", "y"]
+        docs = ["".join(rng.choice(parts) for _ in range(12)) for _ in range(20)]
+        cache = AlignmentCache(min_size=8)
+        for tokenizer in (None, "word"):
+            for a, b in zip(docs, docs[1:]):
+                expected = make_template(a, b, 1, tokenizer)
+                assert make_template(a, b, 1, tokenizer, cache=cache) == expected
+        plain = Template(1)
+        first = Template(1, alignment_cache=cache)
+        second = Template(1, alignment_cache=cache)
+        for doc in docs:
+            assert first.learn(doc) == second.learn(doc) == plain.learn(doc)
+            assert first.last_change == second.last_change == plain.last_change
+        assert first.as_text("!") == second.as_text("!") == plain.as_text("!")
+        info = cache.info()
+        assert info.hits > 0 and info.misses > 0 and info.evictions == 0
+        assert info.size == len(cache)
+
+    def test_alignment_cache_evictions():
+        cache = AlignmentCache(maxsize=1, min_size=0)
+        assert make_template("abcXdef", "abcYdef", cache=cache) == "abc\x1fdef"
+        info = cache.info()
+        assert info.size == 1 and info.evictions == info.misses - 1
+        cache.clear()
+        assert cache.info() == (0, 0, 0, 0, 1)
+        t = pickle.loads(pickle.dumps(Template(alignment_cache=cache)))
+        assert t.alignment_cache.maxsize == 1
+        with pytest.raises(ValueError):
+            AlignmentCache(maxsize=0)
+
+    # Tests for observers using pytest
+    def test_observer():
+        events = []
+        t = Template(fast_learn=True, observer=events.append)
+        t.learn("<b>this and that</b>")
+        t.learn("<b>alex and sue</b>")
+        t.learn("<b>alex and sue</b>")
+        assert t.extract("<b>x and y</b>") == ("x", "y")
+        with pytest.raises(NoMatch):
+            t.extract("<i>x and y</i>")
+        first, aligned, matched, hit, miss = events
+        assert isinstance(first, LearnMetrics) and isinstance(hit, ExtractMetrics)
+        assert [first.path, aligned.path, matched.path] == [
+            "first",
+            "aligned",
+            "matched",
+        ]
+        assert [first.result, aligned.result, matched.result] == [None, True, False]
+        assert aligned.num_holes == 2 and aligned.depth >= 2
+        assert aligned.lcs_calls > 0 and aligned.chars_compared >= 33
+        assert matched.lcs_calls == 0 and first.clean_seconds >= 0
+        assert hit.matched and not miss.matched and hit.length == 14
+        assert pickle.loads(pickle.dumps(t)).observer is None
+
+    # Tests for the command line tool using pytest
+    def test_main_learn_and_extract(tmp_path):
+        samples = tmp_path / "samples"
+        samples.mkdir()
+        write_samples(
+            str(samples),
+            ["<script>%d</script>" % i + s for i, s in enumerate(ITEM_SAMPLES)],
+        )
+        path = str(tmp_path / "item.tmpl")
+        status, report = run_main(
+            "learn", str(samples), "-o", path, "--html", "--fields", "item,price"
+        )
+        assert status == 0 and "learned 20 samples" in report
+        t = Template.load(path)
+        assert isinstance(t, HTMLTemplate)
+        assert t.as_text("!") == "<h1>Item !</h1><p>price: !</p>"
+
+        write_samples(str(samples), ["junk"], suffix=".txt")
+        archive = str(tmp_path / "pages.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(str(samples), arcname="pages")
+        output = str(tmp_path / "rows.jsonl")
+        status, report = run_main(
+            "extract", path, archive, "-o", output, "--source-field", "file", "-v"
+        )
+        assert status == 0
+        assert "no match: pages/0000.txt" in report
+        assert "extracted 20 of 21 documents" in report
+        rows = sorted(read_jsonl(output), key=lambda row: int(row["item"]))
+        assert rows[3] == {"item": "3", "price": "21", "file": "pages/0003.html"}
+
+        glob = os.path.join(str(samples), "*.html")
+        status, _ = run_main(
+            "extract",
+            path,
+            glob,
+            "-o",
+            output,
+            "-j",
+            "2",
+            "--chunksize",
+            "3",
+            "--fields",
+            ",price",
+        )
+        assert status == 0
+        assert read_jsonl(output) == [{"price": str(i * 7)} for i in range(20)]
+        assert run_main("extract", path, glob, "--fields", "one")[0] == 1
+
+    # Tests for asynchronous extraction using pytest
+    def test_aextract():
+        t = create_template(0, "<b>1 and 2</b>", "<b>3 and 4</b>")
+        results = asyncio.run(collect(t.aextract(arange_samples(500), chunksize=16)))
+        assert [isinstance(r, NoMatch) for r in results] == [
+            i % 7 == 0 for i in range(500)
+        ]
+        assert results[1] == ("1", "<script>x</script>1")
+        html = HTMLTemplate()
+        html.learn("<b>1 and 2</b>")
+        html.learn("<b>3 and 4</b>")
+        with ThreadPoolExecutor(2) as executor:
+            results = asyncio.run(
+                collect(
+                    html.aextract(
+                        arange_samples(30, 0.001), executor, chunksize=4, max_pending=1
+                    )
+                )
+            )
+        assert results[1:7] == [(str(i), str(i)) for i in range(1, 7)]
+        assert len(results) == 30
+
+    def test_aextract_errors():
+        async def failing():
+            yield "<b>1 and 2</b>"
+            raise RuntimeError("source failed")
+
+        t = create_template(0, "<b>1 and 2</b>", "<b>3 and 4</b>")
+        with pytest.raises(RuntimeError):
+            asyncio.run(collect(t.aextract(failing())))
+        with pytest.raises(NoMatch):
+            asyncio.run(collect(Template().aextract(arange_samples(1))))
+
+    def test_snapshot_pickle_size():
+        t = Template()
+        for i in range(20000):
+            t.learn("abc %d xyz" % i)
+        data = pickle.dumps(t.snapshot())
+        # Only the template itself is pickled, not what learn() remembers.
+        assert len(data) < 1000
+        assert pickle.loads(data).extract("abc 5 xyz\r\n") == ("5",)
+        html = HTMLTemplate(collapse_whitespace=True)
+        for i in range(1000):
+            html.learn("<b>%d <script>x</script>  %d</b>" % (i, i * 7))
+        snapshot = html.snapshot()
+        copy = pickle.loads(pickle.dumps(snapshot))
+        assert copy.extract("<b>1 <script>y</script>   2</b>") == ("1", "2")
+        # The snapshot doesn't keep the template alive.
+        ref = weakref.ref(html)
+        del html
+        gc.collect()
+        assert ref() is None
+        assert snapshot.extract("<b>3  4</b>") == ("3", "4")
+
+    def test_aextract_chunks():
+        t = create_template(0, "<b>1 and 2</b>", "<b>3 and 4</b>")
+        # A source that always has the next text ready only fills full chunks.
+        with RecordingExecutor() as executor:
+            results = asyncio.run(
+                collect(t.aextract(arange_samples(500), executor, 16, linger=1))
+            )
+        assert len(results) == 500
+        assert executor.sizes == [16] * 31 + [4]
+        # One that's idle for longer than linger doesn't hold texts back.
+        with RecordingExecutor() as executor:
+            source = arange_samples(10, 0.01)
+            asyncio.run(collect(t.aextract(source, executor, 16, linger=0.001)))
+        assert len(executor.sizes) > 1
+        # With a slow executor, the source is read at most one chunk ahead of
+        # the chunks in the executor.
+        with RecordingExecutor(delay=0.005) as executor:
+            ahead = asyncio.run(read_ahead(t, 500, executor=executor, chunksize=16))
+        assert executor.most_in_flight == 4
+        assert ahead <= 5 * 16
+
+    def test_extract_many_bounded():
+        t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+        texts = ("<b>%d and %d</b>" % (i, i) for i in range(4000))
+        before = live_futures()
+        for ordered in (True, False):
+            results = t.extract_many(texts, workers=2, chunksize=20, ordered=ordered)
+            for _ in islice(results, 1500):
+                pass
+            # Only the chunks in flight are kept, at most two per worker.
+            assert live_futures() - before <= 2 * 2
+            results.close()
+
+    def test_train_resume_options(tmp_path):
+        path = str(tmp_path / "checkpoint.tmpl")
+        samples = ["<b>%d and %d</b>" % (i, i % 3) for i in range(10)]
+        Template.train(samples, 2, max_samples=4, checkpoint=path, engine="find")
+        calls = []
+        cache = AlignmentCache()
+        t, stats = Template.train(
+            samples, 2, checkpoint=path, observer=calls.append, alignment_cache=cache
+        )
+        assert len(calls) == stats.samples == 6
+        assert t.alignment_cache is cache
+        with pytest.raises(ValueError):
+            Template.train(samples, 3, checkpoint=path)
+        with pytest.raises(ValueError):
+            Template.train(samples, 2, checkpoint=path, engine="regex")
+
+    def test_pickle_drops_digests():
+        t = Template()
+        for i in range(20000):
+            t.learn("abc %d xyz" % i)
+        data = pickle.dumps(t)
+        # The digests of unchanged Sample Strings are a cache; workers don't
+        # need them.
+        assert len(data) < 1000
+        copy = pickle.loads(data)
+        assert copy.learn("abc 5 xyz") is False
+        assert copy.extract("abc 7 xyz") == ("7",)
+
+    def test_html_unwanted_tags_re():
+        t = HTMLTemplate()
+        assert t.unwanted_tags_re.sub("", "a<style>b</style>c") == "ac"
+        # Replacing it would silently do nothing, so it isn't allowed.
+        with pytest.raises(AttributeError, match="unwanted_tags"):
+            t.unwanted_tags_re = re.compile("<iframe>.*?</iframe>")
+        with pytest.raises(TypeError, match="unwanted_tags"):
+            type("Legacy", (HTMLTemplate,), {"unwanted_tags_re": None})
+
 else:
     # Test functions for template creation using unittest
     class TestTemplateMaker(unittest.TestCase):
@@ -242,6 +1283,18 @@ else:
                 "<title>5678\x1f</title>",
             )
 
+        def test_lcs_tie_breaking(self):
+            self.assertEqual(longest_common_substring("ab", "ba"), (1, 0, 1))
+            self.assertEqual(longest_common_substring("abcxabcd", "zabcd"), (4, 4, 1))
+            self.assertEqual(longest_common_substring("abc", ""), (0, -1, -1))
+            self.assertEqual(longest_common_substring("abc", "xyz"), (0, -1, -1))
+            assert_lcs_matches_reference()
+
+        def test_lcs_memory_ceiling(self):
+            # The DP matrix needed len(a) * len(b) cells; the automaton needs
+            # memory proportional to len(b) only.
+            self.assertLess(lcs_peak_memory_per_char(), 1024)
+
     # Tests for creation with tolerance using unittest
     class TestToleranceCreation(unittest.TestCase):
         def test_tolerance(self):
@@ -311,6 +1364,845 @@ else:
             with self.assertRaises(NoMatch):
                 t.extract("this and that")
 
+    # Tests for hierarchical alignment using unittest
+    class TestHierarchicalAlignment(unittest.TestCase):
+        def test_hierarchical_template(self):
+            t = Template(hierarchical=True)
+            t.learn("<h1>Title</h1>\n<p>this and that</p>\n<footer>x</footer>\n")
+            t.learn("<h1>Title</h1>\n<p>alex and sue</p>\n<footer>x</footer>\n")
+            self.assertEqual(
+                t.as_text("!"), "<h1>Title</h1>\n<p>! and !</p>\n<footer>x</footer>\n"
+            )
+            self.assertEqual(
+                t.extract("<h1>Title</h1>\n<p>a and b</p>\n<footer>x</footer>\n"),
+                ("a", "b"),
+            )
+
+        def test_hierarchical_edges(self):
+            self.assertEqual(hierarchical_text("", ""), "")
+            self.assertEqual(hierarchical_text("a\nb\n", ""), "!")
+            self.assertEqual(hierarchical_text("a\nb\nc\n", "a\nX\nc\n"), "a\n!\nc\n")
+            self.assertEqual(hierarchical_text("a\nb\nc\n", "b\nc\nd"), "!b\nc\n!")
+
+    class TestIterativeMakeTemplate(unittest.TestCase):
+        def test_deeply_fragmented(self):
+            a, _ = fragmented_pair(400)
+            self.assertEqual(
+                make_fragmented_template(400), "".join(c + MARKER for c in a)
+            )
+            self.assertEqual(make_template("a\x1fc", "axbyc"), "a\x1fc")
+
+    # Tests for compiled matchers using unittest
+    class TestMatcher(unittest.TestCase):
+        def test_matcher_cached_per_version(self):
+            t = Template()
+            t.learn("<b>this and that</b>")
+            first = t.compile()
+            self.assertIs(t.compile(), first)
+            t.learn("<b>alex and sue</b>")
+            self.assertIsNot(t.compile(), first)
+            self.assertEqual(t.extract("<b>larry and curly</b>"), ("larry", "curly"))
+
+        def test_find_engine(self):
+            t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+            t2 = Template(engine="find", brain=t._brain)
+            self.assertEqual(t2.extract("<b>larry and curly</b>"), ("larry", "curly"))
+            self.assertEqual(t2.extract("<b>larry and curly</b>\n"), ("larry", "curly"))
+            with self.assertRaises(NoMatch):
+                t2.extract("<b>larry or curly</b>")
+            with self.assertRaises(ValueError):
+                Template(engine="glob")
+            assert_engines_agree()
+
+    # Tests for batch extraction using unittest
+    class TestExtractMany(unittest.TestCase):
+        def test_extract_many(self):
+            t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+            texts = ["<b>larry and curly</b>", "nope", "<b>red and green</b>"]
+            results = list(t.extract_many(texts))
+            self.assertEqual(results[0], ("larry", "curly"))
+            self.assertIsInstance(results[1], NoMatch)
+            self.assertEqual(results[2], ("red", "green"))
+            self.assertEqual(
+                list(t.extract_many(iter(texts), workers=2, chunksize=1))[::2],
+                [("larry", "curly"), ("red", "green")],
+            )
+
+        def test_extract_many_unordered_html(self):
+            t = HTMLTemplate()
+            t.learn("<b>this and that</b><script>1</script>")
+            t.learn("<b>alex and sue</b>")
+            texts = ("<b>%d and <script>x</script>%d</b>" % (i, i) for i in range(50))
+            results = sorted(
+                t.extract_many(texts, workers=2, chunksize=4, ordered=False)
+            )
+            self.assertEqual(results, [(i, (str(i), str(i))) for i in range(50)])
+
+    # Tests for learning from a directory using unittest
+    class TestFromDirectory(unittest.TestCase):
+        def test_from_directory(self):
+            with tempfile.TemporaryDirectory() as dirname:
+                write_samples(dirname, ITEM_SAMPLES)
+                write_samples(dirname, ["ignored"], suffix=".txt")
+                t = Template.from_directory(
+                    dirname, pattern="*.html", sort=True, verbose=False
+                )
+            self.assertEqual(t.as_text("!"), "<h1>Item !</h1><p>price: !</p>")
+            self.assertEqual(t.version, 20)
+
+        def test_from_directory_parallel(self):
+            with tempfile.TemporaryDirectory() as dirname:
+                write_samples(dirname, ITEM_SAMPLES)
+                for ordered in (True, False):
+                    t = HTMLTemplate.from_directory(
+                        dirname, workers=2, chunksize=3, ordered=ordered
+                    )
+                    self.assertIsInstance(t, HTMLTemplate)
+                    self.assertEqual(t.as_text("!"), "<h1>Item !</h1><p>price: !</p>")
+                    self.assertEqual(t.version, 20)
+
+    # Tests for the learn() fast paths using unittest
+    class TestLearnFastPath(unittest.TestCase):
+        def test_learn_seen_fast_path(self):
+            t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+            self.assertIs(t.learn("<b>fine and dandy</b>"), False)
+            self.assertIs(t.learn("<b>fine and dandy</b>"), False)
+            self.assertEqual(t.fast_path_counts, {"seen": 1, "matched": 0})
+            self.assertEqual(t.version, 4)
+            # A change to the template forgets what has been seen.
+            self.assertIs(t.learn("<b>fine or dandy</b>"), True)
+            self.assertIs(t.learn("<b>fine and dandy</b>"), False)
+            self.assertEqual(t.fast_path_counts["seen"], 1)
+
+        def test_learn_match_fast_path(self):
+            t = Template(fast_learn=True)
+            t.learn("x and y")
+            t.learn("x and z")
+            self.assertEqual(t.as_text("!"), "x and !")
+            self.assertIs(t.learn("x and yzzzy"), False)
+            self.assertEqual(t.as_text("!"), "x and !")
+            self.assertEqual(t.fast_path_counts, {"seen": 0, "matched": 1})
+            self.assertEqual(t.version, 3)
+
+    # Tests for streaming training using unittest
+    class TestTrain(unittest.TestCase):
+        def test_train_converges(self):
+            t, stats = Template.train(numbered_samples(), patience=5)
+            self.assertEqual(t.as_text("!"), "<b>! and !</b>")
+            self.assertTrue(stats.converged)
+            self.assertEqual(
+                (stats.samples, stats.unchanged_run, stats.num_holes), (7, 5, 2)
+            )
+
+        def test_train_budgets(self):
+            _, stats = Template.train(numbered_samples(), patience=100, max_samples=20)
+            self.assertEqual((stats.stop_reason, stats.samples), ("max_samples", 20))
+            _, stats = Template.train(["a", "b"], patience=5)
+            self.assertEqual((stats.stop_reason, stats.samples), ("exhausted", 2))
+            _, stats = Template.train(numbered_samples(), patience=10**9, max_seconds=0)
+            self.assertEqual((stats.stop_reason, stats.samples), ("max_seconds", 1))
+
+        def test_iter_files(self):
+            with tempfile.TemporaryDirectory() as dirname:
+                write_samples(dirname, ITEM_SAMPLES)
+                files = iter_files(dirname, pattern="*.html", sort=True)
+                t, stats = Template.train(files, patience=3)
+                self.assertEqual(t.as_text("!"), "<h1>Item !</h1><p>price: !</p>")
+                self.assertEqual(stats.samples, 5)
+                self.assertEqual(len(list(files)), 15)
+
+    # Tests for saving and loading using unittest
+    class TestSaveLoad(unittest.TestCase):
+        def test_save_load(self):
+            t = HTMLTemplate(tolerance=1, engine="find")
+            t.learn("<b>this and that</b>")
+            t.learn("<b>alex and sue</b>")
+            with tempfile.TemporaryDirectory() as dirname:
+                path = os.path.join(dirname, "t.tmpl")
+                t.save(path)
+                loaded = Template.load(path)
+            self.assertIs(type(loaded), HTMLTemplate)
+            self.assertEqual((loaded.version, loaded._tolerance), (2, 1))
+            self.assertEqual(loaded.as_text("!"), "<b>! and !</b>")
+            self.assertEqual(
+                loaded.extract("<b>x and <style></style>y</b>"), ("x", "y")
+            )
+            self.assertEqual(Template.loads(Template().dumps()).as_text(), "")
+            with self.assertRaises(ValueError):
+                HTMLTemplate.loads(Template().dumps())
+            with self.assertRaises(ValueError):
+                Template.loads(b"<b>! and !</b>")
+
+        def test_train_checkpoint(self):
+            samples = ["<b>%d and %d</b>" % (i, i % 3) for i in range(10)]
+            with tempfile.TemporaryDirectory() as dirname:
+                path = os.path.join(dirname, "checkpoint.tmpl")
+                _, stats = Template.train(samples, max_samples=4, checkpoint=path)
+                self.assertEqual(stats.samples, 4)
+                t, stats = Template.train(samples, checkpoint=path, checkpoint_every=2)
+                self.assertEqual((stats.samples, t.version), (6, 10))
+                self.assertEqual(
+                    t.as_text("!"), Template.train(samples)[0].as_text("!")
+                )
+                self.assertEqual(Template.load(path).version, 10)
+
+    # Tests for the template registry using unittest
+    class TestTemplateRegistry(unittest.TestCase):
+        def test_registry_match(self):
+            registry = site_registry()
+            self.assertEqual(len(registry), 51)
+            text = "<html id=7><b>a and b</b></html>"
+            self.assertEqual(registry.candidates(text), ["site7"])
+            self.assertEqual(registry.match(text), ("site7", ("a", "b")))
+            self.assertEqual(registry.match(text + "\n"), ("site7", ("a", "b")))
+            self.assertEqual(
+                registry.match("<p>z<script>2</script></p>"), ("html", ("z",))
+            )
+            with self.assertRaises(NoMatch):
+                registry.match("<html id=7><i>a and b</i></html>")
+
+        def test_registry_unregister(self):
+            registry = site_registry()
+            registry.unregister("site7")
+            self.assertNotIn("site7", registry)
+            with self.assertRaises(NoMatch):
+                registry.match("<html id=7><b>a and b</b></html>")
+            with self.assertRaises(ValueError):
+                registry.register("empty", Template())
+
+    class TestRegistrySharedBoilerplate(unittest.TestCase):
+        def test_registry_shared_boilerplate(self):
+            registry = boilerplate_registry()
+            self.assertEqual(registry.candidates(boilerplate_page(123, "x")), ["s123"])
+            self.assertEqual(registry.match(boilerplate_page(7, "x")), ("s7", ("x",)))
+            # The anchors are picked again when a template shares them.
+            registry.register(
+                "copy",
+                create_template(0, boilerplate_page(7, "a"), boilerplate_page(7, "b")),
+            )
+            self.assertEqual(
+                registry.candidates(boilerplate_page(7, "x")), ["s7", "copy"]
+            )
+            registry.unregister("s7")
+            self.assertEqual(registry.match(boilerplate_page(7, "x")), ("copy", ("x",)))
+            registry.register("short", create_template(0, "<p>a</p>", "<p>b</p>"))
+            self.assertEqual(registry.candidates("<p>x</p>"), ["short"])
+
+    # Tests for tokenized alignment using unittest
+    class TestTokenizers(unittest.TestCase):
+        def test_tokenizers(self):
+            text = '<p class="x">Hello, world</p>'
+            for tokenizer in TOKENIZERS.values():
+                self.assertEqual("".join(tokenizer(text)), text)
+            self.assertEqual(
+                html_tokenizer(text),
+                ['<p class="x">', "Hello", ",", " ", "world", "</p>"],
+            )
+
+        def test_tokenized_template(self):
+            self.assertEqual(make_template("12345", "12_45", tokenizer="word"), MARKER)
+            self.assertEqual(
+                make_template(
+                    "<b>this and that</b>", "<b>alex and sue</b>", tokenizer="word"
+                ),
+                "<b>\x1f and \x1f</b>",
+            )
+            t = Template(tokenizer="html")
+            t.learn("<p class=a>Price: 10 USD</p>")
+            t.learn("<p class=b>Price: 1234 USD</p>")
+            self.assertEqual(t.as_text("!"), "!Price: ! USD</p>")
+            self.assertEqual(t.extract("<p>Price: 5 USD</p>"), ("<p>", "5"))
+            self.assertEqual(
+                Template.loads(t.dumps()).as_text("!"), "!Price: ! USD</p>"
+            )
+            with self.assertRaises(ValueError):
+                Template(tokenizer="sentence")
+            with self.assertRaises(ValueError):
+                Template(tokenizer=str.split).dumps()
+
+    # Tests for incremental hole tracking using unittest
+    class TestLastChange(unittest.TestCase):
+        def test_last_change(self):
+            t = Template()
+            t.learn("<b>this and that</b><br>")
+            self.assertEqual(t.last_change, {})
+            self.assertIs(t.learn("<b>alex and sue</b><br>"), True)
+            self.assertEqual(t.last_change, {0: "this", 1: "that"})
+            self.assertEqual(t.remap_values(()), ("this", "that"))
+            self.assertIs(t.learn("<b>michael and scottie</b>"), True)
+            self.assertEqual(t.as_text("!"), "<b>! and !</b>!")
+            self.assertEqual(t.last_change, {2: "<br>"})
+            self.assertEqual(t.remap_values(("alex", "sue")), ("alex", "sue", "<br>"))
+            self.assertIs(t.learn("<b>fine and dandy</b>"), False)
+            self.assertEqual((t.last_change, t.last_remap), ({}, None))
+
+        def test_remap_values(self):
+            for kwargs in ({}, {"hierarchical": True}, {"tokenizer": "word"}):
+                t = Template(**kwargs)
+                docs = ["<b>x and y</b><br>", "<b>p and q</b><br>", "<b>foo & bar</b>"]
+                t.learn(docs[0])
+                records = []
+                for doc in docs[1:]:
+                    t.learn(doc)
+                    records = [t.remap_values(record) for record in records]
+                    records.append(t.extract(doc))
+                self.assertEqual(records, [t.extract(doc) for doc in docs[1:]])
+                with self.assertRaises(ValueError):
+                    t.remap_values(("too", "many", "values", "here", "!"))
+
+        def test_remap_values_matches_extract(self):
+            # The old template ends in a newline that extract() leaves out of
+            # the last value; the new one ends in a hole.
+            t = create_template(0, "<p>a</p>x\n", "<p>b</p>y\n")
+            record = t.extract("<p>a</p>x\n")
+            t.learn("<p>c</p>")
+            self.assertEqual(t.remap_values(record), ("a", "x"))
+            self.assertEqual(t.extract("<p>a</p>x\n"), ("a", "x"))
+            # The document splits into the new holes in more than one way.
+            t = create_template(0, "</b><b>a ", "<b>ab<b>")
+            record = t.extract("</b><b>a ")
+            t.learn(" b ")
+            self.assertEqual(t.as_text("!"), "!b!")
+            self.assertEqual(t.remap_values(record), ("</", "><b>a "))
+            self.assertEqual(t.extract("</b><b>a "), ("</", "><b>a "))
+
+    # Tests for hole statistics using unittest
+    class TestHoleStats(unittest.TestCase):
+        def test_hole_stats(self):
+            t = Template(brain="<b>\x1f</b><i>\x1f</i><u>\x1f</u>")
+            stats = HoleStats.collect(t, hole_stats_samples(), top_k=5)
+            self.assertEqual((stats.documents, stats.nomatch), (300, 1))
+            self.assertEqual(stats.pointless_holes(), [2])
+            self.assertEqual(stats.option_holes(), [1])
+            self.assertEqual(stats.varying_holes(), [0])
+            self.assertEqual(stats.top(1), [("x", 100), ("y", 100), ("z", 100)])
+            self.assertEqual(stats.cardinality(1), 3)
+            self.assertAlmostEqual(stats.cardinality(0), 300, delta=30)
+            self.assertEqual(stats.length_histogram(0)[:4], [0, 10, 290, 0])
+            with self.assertRaises(ValueError):
+                stats.add(("too", "few"))
+
+        def test_hole_stats_merge(self):
+            t = Template(brain="<b>\x1f</b><i>\x1f</i><u>\x1f</u>")
+            samples = hole_stats_samples()
+            whole = HoleStats.collect(t, samples, top_k=5)
+            merged = HoleStats.collect(t, samples[:100], top_k=5)
+            merged.merge(HoleStats.collect(t, samples[100:], top_k=5))
+            parallel = HoleStats.collect(t, samples, workers=2, chunksize=50, top_k=5)
+            for stats in (merged, parallel):
+                self.assertEqual((stats.documents, stats.nomatch), (300, 1))
+                for hole in range(3):
+                    self.assertEqual(stats.cardinality(hole), whole.cardinality(hole))
+                    self.assertEqual(
+                        stats.length_histogram(hole), whole.length_histogram(hole)
+                    )
+                self.assertEqual(stats.top(1), whole.top(1))
+                self.assertEqual(stats.option_holes(), [1])
+
+    # Tests for columnar extraction using unittest
+    class TestExtractColumns(unittest.TestCase):
+        def test_extract_columns(self):
+            t = Template(brain="<td>\x1f</td>" * 5)
+            ids, prices, dates, codes, letters = t.extract_columns(COLUMN_SAMPLES)
+            self.assertEqual((ids.typecode, list(ids)), ("q", [0, 1, 2, 3, 4]))
+            self.assertEqual(
+                (prices.typecode, list(prices)), ("d", [0, 0.25, 0.5, 0.75, 1])
+            )
+            self.assertEqual(dates[1], datetime.date(2024, 3, 2))
+            self.assertEqual(codes, ["00", "01", "02", "03", "04"])
+            self.assertEqual(letters, ["a", "b", "c", "a", "b"])
+
+        def test_extract_columns_errors(self):
+            t = Template(brain="<td>\x1f</td>" * 5)
+            samples = COLUMN_SAMPLES + ["<td>x</td>" * 5, "no match"]
+            with self.assertRaises(NoMatch):
+                t.extract_columns(samples)
+            columns = t.extract_columns(samples, errors="skip", sample_size=5)
+            # Values past the sample that don't fit fall back to strings.
+            self.assertEqual(columns[0], ["0", "1", "2", "3", "4", "x"])
+            self.assertEqual(t.extract_columns([]), [[]] * 5)
+
+        def test_extract_columns_strict_numbers(self):
+            t = Template(brain="<td>\x1f</td>")
+            for odd in ("0123", "1_000", "\u0663", "nan", "inf", "1_0.5"):
+                texts = ["<td>%s</td>" % value for value in ("1", "2", "3", "4", odd)]
+                self.assertEqual(
+                    t.extract_columns(texts, sample_size=4), [["1", "2", "3", "4", odd]]
+                )
+            texts = ["<td>%s</td>" % value for value in ("1", "2", "3", "4", "2.5")]
+            (column,) = t.extract_columns(texts, sample_size=4)
+            self.assertEqual((column.typecode, list(column)), ("d", [1, 2, 3, 4, 2.5]))
+            texts = ["<td>2024-01-0%d</td>" % i for i in range(1, 5)] + [
+                "<td>20240105</td>"
+            ]
+            self.assertEqual(t.extract_columns(texts, sample_size=4)[0][4], "20240105")
+
+    # Tests for span extraction using unittest
+    class TestExtractSpans(unittest.TestCase):
+        def test_extract_spans(self):
+            t = create_template(
+                0, "<b>this and that</b>\n<i>x</i>", "<b>alex and sue</b>\n<i>x</i>"
+            )
+            text = "<b>larry and curly</b>\r\n<i>x</i>\r\n"
+            spans = t.extract_spans(text)
+            self.assertEqual(
+                [text[start:end] for start, end in spans], ["larry", "curly"]
+            )
+            data = text.replace("larry", "lärry").encode("utf-8")
+            for view in (data, memoryview(data)):
+                spans = t.extract_spans(view)
+                self.assertEqual(
+                    [bytes(view[start:end]) for start, end in spans],
+                    [
+                        "lärry".encode("utf-8"),
+                        b"curly",
+                    ],
+                )
+            with self.assertRaises(NoMatch):
+                t.extract_spans(b"<b>larry or curly</b>")
+            with self.assertRaises(TypeError):
+                HTMLTemplate().extract_spans("")
+
+    # Tests for record-stream extraction using unittest
+    class TestFinditer(unittest.TestCase):
+        def test_finditer(self):
+            t = create_template(0, "<li>a: 1</li>", "<li>bb: 22</li>")
+            text = "<ul><li>x: 5</li>\n<li>long name: 10</li><li>oops</li><li>y: 7</li>"
+            expected = [("x", "5"), ("long name", "10"), ("oops</li><li>y", "7")]
+            for chunk_size in (1, 4, 1000):
+                records = t.finditer(io.StringIO(text), chunk_size=chunk_size)
+                self.assertEqual(list(records), expected)
+            self.assertEqual(list(t.finditer(text.encode("utf-8")))[0], (b"x", b"5"))
+            self.assertEqual(list(t.finditer("<li>x: 5</li><li>y: 7")), [("x", "5")])
+
+        def test_finditer_max_record_size(self):
+            t = create_template(0, "<li>a: 1</li>", "<li>bb: 22</li>")
+            text = "<li>broken <li>x: 5</li>"
+            records = t.finditer(io.StringIO(text), chunk_size=2, max_record_size=16)
+            self.assertEqual(list(records), [("x", "5")])
+            with self.assertRaises(ValueError):
+                list(create_template(0, "a1", "b1").finditer("a1"))
+
+        def test_finditer_incomplete_record(self):
+            t = create_template(0, "<r>a</r>", "<r>b</r>")
+            # Every "<r>" starts a record that can't be completed, in linear time.
+            text = "<r>abcdefgh" * 100000
+            for chunk_size in (100, 65536):
+                records = t.finditer(io.StringIO(text), chunk_size=chunk_size)
+                self.assertEqual(list(records), [])
+            self.assertEqual(list(t.finditer(text + "</r>")), [(text[3:],)])
+
+    # Tests for HTML cleaning using unittest
+    class TestHTMLClean(unittest.TestCase):
+        def test_html_clean(self):
+            t = HTMLTemplate()
+            text = (
+                "<p>a\r\n<SCRIPT type=x>1</script>\r<style>\n</STYLE>\nb<!-- c --></p>"
+            )
+            self.assertEqual(t.clean(text), "<p>a\n\nb<!-- c --></p>")
+            # Elements that are never closed are left alone, in linear time.
+            self.assertEqual(
+                t.clean("<script>" * 20000 + "x"), "<script>" * 20000 + "x"
+            )
+            t = HTMLTemplate(collapse_whitespace=True, strip_comments=True)
+            self.assertEqual(t.clean(text), "<p>a\nb</p>")
+            self.assertEqual(t.clean("a \t<!-- x -->  b <!-- y"), "a b <!-- y")
+
+        def test_html_clean_options(self):
+            t = HTMLTemplate(collapse_whitespace=True, strip_comments=True)
+            t.learn("<b>this  and   that</b><!-- 1 -->")
+            t.learn("<b>alex and sue</b>")
+            loaded = Template.loads(t.dumps())
+            self.assertEqual(loaded.clean("<!---->x  y"), "x y")
+            self.assertEqual(loaded.extract("<b>x\t and y</b><!-- z -->"), ("x", "y"))
+            registry = TemplateRegistry()
+            registry.register(
+                "plain", create_template(0, "<b>a or b</b>", "<b>c or d</b>")
+            )
+            registry.register("html", t)
+            self.assertEqual(
+                registry.match("<b>p  and q</b><!-- z -->"), ("html", ("p", "q"))
+            )
+
+    # Tests for template snapshots using unittest
+    class TestSnapshot(unittest.TestCase):
+        def test_snapshot(self):
+            t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+            snapshot = t.snapshot()
+            self.assertIs(t.snapshot(), snapshot)
+            self.assertEqual(
+                (snapshot.version, snapshot.as_text("!")), (2, "<b>! and !</b>")
+            )
+            with self.assertRaises(AttributeError):
+                snapshot.brain = ""
+            t.learn("<b>fine and dandy</b><br>")
+            # The old snapshot is unchanged, and learn() published a new one.
+            self.assertEqual(snapshot.extract("<b>x and y</b>"), ("x", "y"))
+            self.assertEqual(t.snapshot().extract("<b>x and y</b>!"), ("x", "y", "!"))
+            self.assertEqual(t.snapshot().version, 3)
+            self.assertEqual(pickle.loads(pickle.dumps(t.snapshot())).num_holes(), 3)
+            with self.assertRaises(NoMatch):
+                Template().snapshot()
+
+        def test_snapshot_threads(self):
+            t = create_template(0, "<li>0: 0</li>", "<li>1: 1</li>")
+            snapshots = []
+
+            def read():
+                while len(snapshots) < 200:
+                    snapshots.append(t.snapshot())
+
+            reader = threading.Thread(target=read)
+            reader.start()
+            for i in range(200):
+                t.learn("<li>%d %s %d</li>" % (i, "ab"[i % 2], i))
+            reader.join()
+            for snapshot in snapshots:
+                self.assertIs(snapshot.matcher.brain, snapshot.brain)
+            self.assertEqual(t.snapshot().as_text("!"), t.as_text("!"))
+            results = list(t.extract_many(["<li>x a y</li>"] * 4, workers=2))
+            self.assertEqual(results, [t.extract("<li>x a y</li>")] * 4)
+
+    # Tests for batch learning using unittest
+    class TestLearnBatch(unittest.TestCase):
+        def test_learn_batch(self):
+            docs = [
+                "<b>this and that</b>",
+                "<b>alex and sue</b>",
+                "<b>fine and dandy</b>",
+            ]
+            t = Template()
+            self.assertIs(t.learn_batch(docs), None)
+            self.assertEqual((t.as_text("!"), t.version), ("<b>! and !</b>", 3))
+            for order in (docs[::-1], docs[1:] + docs[:1]):
+                t = Template()
+                t.learn_batch(order)
+                self.assertEqual(t.as_text("!"), "<b>! and !</b>")
+            self.assertIs(t.learn_batch(["<b>x and y</b>"]), False)
+            self.assertIs(t.learn_batch(["<b>x and y</b><br>", "<b>p and q</b>"]), True)
+            self.assertEqual(t.as_text("!"), "<b>! and !</b>!")
+            self.assertEqual(t.last_change, {2: ""})
+            self.assertEqual(t.remap_values(("alex", "sue")), ("alex", "sue", ""))
+
+        def test_learn_batch_matches_all(self):
+            rng = random.Random(7)
+            for tolerance in (0, 1):
+                docs = [
+                    "".join(rng.choice("ab c") for _ in range(12)) for _ in range(5)
+                ]
+                t = Template(tolerance)
+                t.learn_batch(docs)
+                for doc in docs:
+                    t.extract(doc)
+                shuffled = Template(tolerance)
+                shuffled.learn_batch(sorted(docs, reverse=True))
+                self.assertEqual(shuffled.as_text("!"), t.as_text("!"))
+
+    # Tests for the brain index using unittest
+    class TestKeepIndex(unittest.TestCase):
+        def test_keep_index(self):
+            rng = random.Random(3)
+            for tolerance in (0, 2):
+                indexed = Template(tolerance, keep_index=True)
+                plain = Template(tolerance)
+                for _ in range(30):
+                    doc = "".join(rng.choice("ab cd") for _ in range(30))
+                    self.assertEqual(indexed.learn(doc), plain.learn(doc))
+                    self.assertEqual(indexed.as_text("!"), plain.as_text("!"))
+                    self.assertEqual(indexed.last_change, plain.last_change)
+            self.assertIs(Template.loads(indexed.dumps())._keep_index, True)
+
+    # Tests for the alignment cache using unittest
+    class TestAlignmentCache(unittest.TestCase):
+        def test_alignment_cache(self):
+            rng = random.Random(5)
+            parts = [
+                "<nav>home | about</nav>\n",
+                "<footer>(c) 2024</footer>\n",
+                "x",
+                "y",
+            ]
+            docs = ["".join(rng.choice(parts) for _ in range(12)) for _ in range(20)]
+            cache = AlignmentCache(min_size=8)
+            for tokenizer in (None, "word"):
+                for a, b in zip(docs, docs[1:]):
+                    expected = make_template(a, b, 1, tokenizer)
+                    self.assertEqual(
+                        make_template(a, b, 1, tokenizer, cache=cache), expected
+                    )
+            plain = Template(1)
+            first = Template(1, alignment_cache=cache)
+            second = Template(1, alignment_cache=cache)
+            for doc in docs:
+                changed = plain.learn(doc)
+                self.assertEqual(first.learn(doc), changed)
+                self.assertEqual(second.learn(doc), changed)
+                self.assertEqual(first.last_change, plain.last_change)
+                self.assertEqual(second.last_change, plain.last_change)
+            self.assertEqual(first.as_text("!"), plain.as_text("!"))
+            self.assertEqual(second.as_text("!"), plain.as_text("!"))
+            info = cache.info()
+            self.assertGreater(info.hits, 0)
+            self.assertGreater(info.misses, 0)
+            self.assertEqual(info.evictions, 0)
+            self.assertEqual(info.size, len(cache))
+
+        def test_alignment_cache_evictions(self):
+            cache = AlignmentCache(maxsize=1, min_size=0)
+            self.assertEqual(
+                make_template("abcXdef", "abcYdef", cache=cache), "abc\x1fdef"
+            )
+            info = cache.info()
+            self.assertEqual(info.size, 1)
+            self.assertEqual(info.evictions, info.misses - 1)
+            cache.clear()
+            self.assertEqual(cache.info(), (0, 0, 0, 0, 1))
+            t = pickle.loads(pickle.dumps(Template(alignment_cache=cache)))
+            self.assertEqual(t.alignment_cache.maxsize, 1)
+            with self.assertRaises(ValueError):
+                AlignmentCache(maxsize=0)
+
+    # Tests for observers using unittest
+    class TestObserver(unittest.TestCase):
+        def test_observer(self):
+            events = []
+            t = Template(fast_learn=True, observer=events.append)
+            t.learn("<b>this and that</b>")
+            t.learn("<b>alex and sue</b>")
+            t.learn("<b>alex and sue</b>")
+            self.assertEqual(t.extract("<b>x and y</b>"), ("x", "y"))
+            with self.assertRaises(NoMatch):
+                t.extract("<i>x and y</i>")
+            first, aligned, matched, hit, miss = events
+            self.assertIsInstance(first, LearnMetrics)
+            self.assertIsInstance(hit, ExtractMetrics)
+            self.assertEqual(
+                [first.path, aligned.path, matched.path],
+                ["first", "aligned", "matched"],
+            )
+            self.assertEqual(
+                [first.result, aligned.result, matched.result], [None, True, False]
+            )
+            self.assertEqual(aligned.num_holes, 2)
+            self.assertGreaterEqual(aligned.depth, 2)
+            self.assertGreater(aligned.lcs_calls, 0)
+            self.assertGreaterEqual(aligned.chars_compared, 33)
+            self.assertEqual(matched.lcs_calls, 0)
+            self.assertGreaterEqual(first.clean_seconds, 0)
+            self.assertTrue(hit.matched)
+            self.assertFalse(miss.matched)
+            self.assertEqual(hit.length, 14)
+            self.assertIsNone(pickle.loads(pickle.dumps(t)).observer)
+
+    # Tests for the command line tool using unittest
+    class TestMain(unittest.TestCase):
+        def test_main_learn_and_extract(self):
+            with tempfile.TemporaryDirectory() as dirname:
+                samples = os.path.join(dirname, "samples")
+                os.mkdir(samples)
+                write_samples(
+                    samples,
+                    ["<script>%d</script>" % i + s for i, s in enumerate(ITEM_SAMPLES)],
+                )
+                path = os.path.join(dirname, "item.tmpl")
+                status, report = run_main(
+                    "learn", samples, "-o", path, "--html", "--fields", "item,price"
+                )
+                self.assertEqual(status, 0)
+                self.assertIn("learned 20 samples", report)
+                t = Template.load(path)
+                self.assertIsInstance(t, HTMLTemplate)
+                self.assertEqual(t.as_text("!"), "<h1>Item !</h1><p>price: !</p>")
+
+                write_samples(samples, ["junk"], suffix=".txt")
+                archive = os.path.join(dirname, "pages.tar.gz")
+                with tarfile.open(archive, "w:gz") as tar:
+                    tar.add(samples, arcname="pages")
+                output = os.path.join(dirname, "rows.jsonl")
+                status, report = run_main(
+                    "extract",
+                    path,
+                    archive,
+                    "-o",
+                    output,
+                    "--source-field",
+                    "file",
+                    "-v",
+                )
+                self.assertEqual(status, 0)
+                self.assertIn("no match: pages/0000.txt", report)
+                self.assertIn("extracted 20 of 21 documents", report)
+                rows = sorted(read_jsonl(output), key=lambda row: int(row["item"]))
+                self.assertEqual(
+                    rows[3], {"item": "3", "price": "21", "file": "pages/0003.html"}
+                )
+
+                glob = os.path.join(samples, "*.html")
+                status, _ = run_main(
+                    "extract",
+                    path,
+                    glob,
+                    "-o",
+                    output,
+                    "-j",
+                    "2",
+                    "--chunksize",
+                    "3",
+                    "--fields",
+                    ",price",
+                )
+                self.assertEqual(status, 0)
+                self.assertEqual(
+                    read_jsonl(output), [{"price": str(i * 7)} for i in range(20)]
+                )
+                self.assertEqual(
+                    run_main("extract", path, glob, "--fields", "one")[0], 1
+                )
+
+    # Tests for asynchronous extraction using unittest
+    class TestAextract(unittest.TestCase):
+        def test_aextract(self):
+            t = create_template(0, "<b>1 and 2</b>", "<b>3 and 4</b>")
+            results = asyncio.run(
+                collect(t.aextract(arange_samples(500), chunksize=16))
+            )
+            self.assertEqual(
+                [isinstance(r, NoMatch) for r in results],
+                [i % 7 == 0 for i in range(500)],
+            )
+            self.assertEqual(results[1], ("1", "<script>x</script>1"))
+            html = HTMLTemplate()
+            html.learn("<b>1 and 2</b>")
+            html.learn("<b>3 and 4</b>")
+            with ThreadPoolExecutor(2) as executor:
+                results = asyncio.run(
+                    collect(
+                        html.aextract(
+                            arange_samples(30, 0.001),
+                            executor,
+                            chunksize=4,
+                            max_pending=1,
+                        )
+                    )
+                )
+            self.assertEqual(results[1:7], [(str(i), str(i)) for i in range(1, 7)])
+            self.assertEqual(len(results), 30)
+
+        def test_aextract_errors(self):
+            async def failing():
+                yield "<b>1 and 2</b>"
+                raise RuntimeError("source failed")
+
+            t = create_template(0, "<b>1 and 2</b>", "<b>3 and 4</b>")
+            with self.assertRaises(RuntimeError):
+                asyncio.run(collect(t.aextract(failing())))
+            with self.assertRaises(NoMatch):
+                asyncio.run(collect(Template().aextract(arange_samples(1))))
+
+        def test_snapshot_pickle_size(self):
+            t = Template()
+            for i in range(20000):
+                t.learn("abc %d xyz" % i)
+            data = pickle.dumps(t.snapshot())
+            # Only the template itself is pickled, not what learn() remembers.
+            self.assertLess(len(data), 1000)
+            self.assertEqual(pickle.loads(data).extract("abc 5 xyz\r\n"), ("5",))
+            html = HTMLTemplate(collapse_whitespace=True)
+            for i in range(1000):
+                html.learn("<b>%d <script>x</script>  %d</b>" % (i, i * 7))
+            snapshot = html.snapshot()
+            copy = pickle.loads(pickle.dumps(snapshot))
+            self.assertEqual(
+                copy.extract("<b>1 <script>y</script>   2</b>"), ("1", "2")
+            )
+            # The snapshot doesn't keep the template alive.
+            ref = weakref.ref(html)
+            del html
+            gc.collect()
+            self.assertIsNone(ref())
+            self.assertEqual(snapshot.extract("<b>3  4</b>"), ("3", "4"))
+
+        def test_aextract_chunks(self):
+            t = create_template(0, "<b>1 and 2</b>", "<b>3 and 4</b>")
+            # A source that always has the next text ready only fills full
+            # chunks.
+            with RecordingExecutor() as executor:
+                results = asyncio.run(
+                    collect(t.aextract(arange_samples(500), executor, 16, linger=1))
+                )
+            self.assertEqual(len(results), 500)
+            self.assertEqual(executor.sizes, [16] * 31 + [4])
+            # One that's idle for longer than linger doesn't hold texts back.
+            with RecordingExecutor() as executor:
+                source = arange_samples(10, 0.01)
+                asyncio.run(collect(t.aextract(source, executor, 16, linger=0.001)))
+            self.assertGreater(len(executor.sizes), 1)
+            # With a slow executor, the source is read at most one chunk ahead
+            # of the chunks in the executor.
+            with RecordingExecutor(delay=0.005) as executor:
+                ahead = asyncio.run(read_ahead(t, 500, executor=executor, chunksize=16))
+            self.assertEqual(executor.most_in_flight, 4)
+            self.assertLessEqual(ahead, 5 * 16)
+
+        def test_extract_many_bounded(self):
+            t = create_template(0, "<b>this and that</b>", "<b>alex and sue</b>")
+            texts = ("<b>%d and %d</b>" % (i, i) for i in range(4000))
+            before = live_futures()
+            for ordered in (True, False):
+                results = t.extract_many(
+                    texts, workers=2, chunksize=20, ordered=ordered
+                )
+                for _ in islice(results, 1500):
+                    pass
+                # Only the chunks in flight are kept, at most two per worker.
+                self.assertLessEqual(live_futures() - before, 2 * 2)
+                results.close()
+
+        def test_train_resume_options(self):
+            with tempfile.TemporaryDirectory() as dirname:
+                path = os.path.join(dirname, "checkpoint.tmpl")
+                samples = ["<b>%d and %d</b>" % (i, i % 3) for i in range(10)]
+                Template.train(
+                    samples, 2, max_samples=4, checkpoint=path, engine="find"
+                )
+                calls = []
+                cache = AlignmentCache()
+                t, stats = Template.train(
+                    samples,
+                    2,
+                    checkpoint=path,
+                    observer=calls.append,
+                    alignment_cache=cache,
+                )
+                self.assertEqual(len(calls), 6)
+                self.assertEqual(stats.samples, 6)
+                self.assertIs(t.alignment_cache, cache)
+                with self.assertRaises(ValueError):
+                    Template.train(samples, 3, checkpoint=path)
+                with self.assertRaises(ValueError):
+                    Template.train(samples, 2, checkpoint=path, engine="regex")
+
+        def test_pickle_drops_digests(self):
+            t = Template()
+            for i in range(20000):
+                t.learn("abc %d xyz" % i)
+            data = pickle.dumps(t)
+            # The digests of unchanged Sample Strings are a cache; workers
+            # don't need them.
+            self.assertLess(len(data), 1000)
+            copy = pickle.loads(data)
+            self.assertIs(copy.learn("abc 5 xyz"), False)
+            self.assertEqual(copy.extract("abc 7 xyz"), ("7",))
+
+        def test_html_unwanted_tags_re(self):
+            t = HTMLTemplate()
+            self.assertEqual(t.unwanted_tags_re.sub("", "a<style>b</style>c"), "ac")
+            # Replacing it would silently do nothing, so it isn't allowed.
+            with self.assertRaisesRegex(AttributeError, "unwanted_tags"):
+                t.unwanted_tags_re = re.compile("<iframe>.*?</iframe>")
+            with self.assertRaisesRegex(TypeError, "unwanted_tags"):
+                type("Legacy", (HTMLTemplate,), {"unwanted_tags_re": None})
+
 
 if __name__ == "__main__":
     if PYTEST_AVAILABLE: